@@ -0,0 +1,70 @@
+"""
+	Bytes served and time taken per ABFindAll, for a user with many contacts:
+	rendered in full every time (as it used to be), served from the cache,
+	and as a delta after a change.
+	
+	python -m bench.abservice [--contacts 500] [--rounds 50]
+"""
+
+import argparse
+import asyncio
+import time
+
+from core.backend import Backend
+from core.models import User, UserDetail, UserStatus, Contact, Group, Lst
+from front.msn import http
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark ABFindAll.")
+	parser.add_argument('--contacts', type = int, default = 500)
+	parser.add_argument('--rounds', type = int, default = 50)
+	args = parser.parse_args()
+	
+	loop = asyncio.new_event_loop()
+	backend = Backend(loop)
+	req = _Request(http.create_app(backend))
+	user = _make_user(args.contacts)
+	
+	full = _action(False, http._encode_ab_last_change(0))
+	delta = _action(True, http._encode_ab_last_change(user.list_version))
+	backend._log_list_change(user, http.ListChangeKind.GroupEdit, group_id = '1', value = "Renamed")
+	
+	print("{} contacts".format(args.contacts))
+	for name, action, before in (
+		("full, uncached", full, lambda: http._ab_find_cache.clear()),
+		("full, cached", full, None),
+		("delta", delta, None),
+	):
+		http._ab_find(req, backend, full, 'ABFindAll', user)
+		t0 = time.perf_counter()
+		for _ in range(args.rounds):
+			if before: before()
+			resp = http._ab_find(req, backend, action, 'ABFindAll', user)
+		dt = (time.perf_counter() - t0) / args.rounds
+		print("{:>15}: {:>8} bytes, {:>8.3f}ms".format(name, len(resp.body), dt * 1e3))
+	
+	# Stop `Backend`'s background tasks
+	tasks = asyncio.all_tasks(loop)
+	for task in tasks:
+		task.cancel()
+	loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+
+def _make_user(n):
+	user = User('00000000-0000-0000-0000-000000000000', 'me@example.com', True, UserStatus("Me"), None)
+	user.detail = UserDetail({})
+	user.detail.groups['1'] = Group('1', "Friends")
+	for i in range(n):
+		ctc_head = User('{:08d}-0000-0000-0000-000000000000'.format(i), 'contact{}@example.com'.format(i), True, UserStatus("Contact {}".format(i)), None)
+		user.detail.contacts[ctc_head.uuid] = Contact(ctc_head, {'1'}, Lst.FL | Lst.AL, UserStatus(ctc_head.status.name))
+	return user
+
+def _action(deltas, last_change):
+	# The fields `http._preprocess_soap` would find in an ABFindAll request
+	return { 'deltasOnly': ('true' if deltas else 'false'), 'lastChange': last_change }
+
+class _Request:
+	def __init__(self, app):
+		self.app = app
+
+if __name__ == '__main__':
+	main()
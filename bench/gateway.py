@@ -0,0 +1,96 @@
+"""
+	Run idle HTTP gateway clients against an in-process server, with and
+	without long polling (`settings.GATEWAY_LONG_POLL`), and report the
+	request rate per idle user and the delivery latency of events.
+	
+	python -m bench.gateway [--users 20] [--seconds 10] [--poll-interval 1] [--hold 5] [--events 5]
+	
+	Clients poll like MSN does: they wait `--poll-interval` after an empty
+	answer. With long polling, they poll again right away, since the server
+	holds empty polls open. `--events` events per second are sent to random
+	clients; their latency is measured from `send_event` to the client.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from aiohttp import ClientSession, web
+
+import settings
+from core.backend import Backend
+from core.event import ReplyEvent
+from front.msn.http import create_app
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark HTTP gateway polling.")
+	parser.add_argument('--users', type = int, default = 20)
+	parser.add_argument('--seconds', type = float, default = 10)
+	parser.add_argument('--poll-interval', type = float, default = 1)
+	parser.add_argument('--hold', type = float, default = 5)
+	parser.add_argument('--events', type = float, default = 5)
+	args = parser.parse_args()
+	
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	backend = Backend(loop)
+	for name, hold in (("polling", 0), ("long polling", args.hold)):
+		settings.GATEWAY_LONG_POLL = hold
+		(requests, latencies) = loop.run_until_complete(_run(backend, args))
+		latencies.sort()
+		print("{:>12}: {:.2f} requests/s per user; delivery latency p50 {:.1f}ms, p99 {:.1f}ms ({} events)".format(
+			name, requests / args.users / args.seconds,
+			_percentile(latencies, 50) * 1e3, _percentile(latencies, 99) * 1e3, len(latencies),
+		))
+
+async def _run(backend, args):
+	runner = web.AppRunner(create_app(backend))
+	await runner.setup()
+	site = web.TCPSite(runner, '127.0.0.1', 0)
+	await site.start()
+	port = site._server.sockets[0].getsockname()[1]
+	url = 'http://127.0.0.1:{}/gateway/gateway.dll'.format(port)
+	
+	stats = { 'requests': 0, 'latencies': [] }
+	deadline = time.time() + args.seconds
+	async with ClientSession() as http:
+		session_ids = []
+		for _ in range(args.users):
+			async with http.post(url, params = { 'Action': 'open', 'Server': 'NS', 'IP': '127.0.0.1' }) as resp:
+				session_ids.append(resp.headers['X-MSN-Messenger'].split(';')[0].split('=')[1])
+		clients = [_client(http, url, session_id, deadline, args, stats) for session_id in session_ids]
+		await asyncio.gather(_send_events(backend, session_ids, deadline, args), *clients)
+	
+	await runner.cleanup()
+	return (stats['requests'], stats['latencies'])
+
+async def _client(http, url, session_id, deadline, args, stats):
+	params = { 'Action': 'poll', 'SessionID': session_id }
+	while time.time() < deadline:
+		async with http.post(url, params = params, data = b'') as resp:
+			body = await resp.read()
+		now = time.time()
+		stats['requests'] += 1
+		for line in body.split(b'\r\n'):
+			if line.startswith(b'BNC '):
+				stats['latencies'].append(now - float(line[4:]))
+		if not body and settings.GATEWAY_LONG_POLL <= 0:
+			await asyncio.sleep(args.poll_interval)
+	
+	# Let the server answer, rather than leaving the last poll held open
+	async with http.post(url, params = params, data = b'QNG\r\n') as resp:
+		await resp.read()
+
+async def _send_events(backend, session_ids, deadline, args):
+	while time.time() < deadline - args.poll_interval:
+		await asyncio.sleep(random.expovariate(args.events))
+		sess = backend.util_get_sess_by_token(('msn-gw', random.choice(session_ids)))
+		sess.send_event(ReplyEvent(('BNC', '{:.6f}'.format(time.time()))))
+
+def _percentile(values, p):
+	if not values: return float('nan')
+	return values[min(len(values) - 1, len(values) * p // 100)]
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,62 @@
+"""
+	Startup and first-request cost of the SOAP templates: compiled lazily by each app
+	(as they used to be), precompiled once at startup, and precompiled from a warm
+	bytecode cache (`settings.JINJA_BYTECODE_CACHE_DIR`).
+	
+	python -m bench.jinja
+"""
+
+import asyncio
+import tempfile
+import time
+
+import jinja2.compiler
+
+import settings
+from core.backend import Backend
+from front.msn import http
+import util.misc
+
+# Used on the first ABFindAll/FindMembership after a restart
+_TEMPLATES = ('abservice/ABFindAllResponse.xml', 'sharing/FindMembershipResponse.xml')
+
+def main():
+	loop = asyncio.new_event_loop()
+	backend = Backend(loop)
+	
+	# As it used to be: every app got its own environment, compiling templates as they were first used
+	t0 = time.perf_counter()
+	envs = [util.misc.create_jinja_env(http.TMPL_DIR) for _ in range(2)]
+	startup = time.perf_counter() - t0
+	first = _load_templates(envs)
+	_report("lazy, per app", startup, first)
+	
+	with tempfile.TemporaryDirectory() as tmp:
+		for name, cache_dir in (("precompiled", None), ("bytecode, cold", tmp), ("bytecode, warm", tmp)):
+			settings.JINJA_BYTECODE_CACHE_DIR = cache_dir
+			http._jinja_env = None
+			t0 = time.perf_counter()
+			apps = [http.create_app(backend) for _ in range(2)]
+			startup = time.perf_counter() - t0
+			first = _load_templates([app['jinja_env'] for app in apps])
+			_report(name, startup, first)
+	
+	# Stop `Backend`'s background tasks
+	tasks = asyncio.all_tasks(loop)
+	for task in tasks:
+		task.cancel()
+	loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+
+def _load_templates(envs):
+	# Time until the templates of the first request are ready, per app
+	t0 = time.perf_counter()
+	for env in envs:
+		for name in _TEMPLATES:
+			env.get_template(name)
+	return (time.perf_counter() - t0) / len(envs)
+
+def _report(name, startup, first):
+	print("{:>15}: startup (2 apps) {:>7.1f}ms, first request {:>7.2f}ms".format(name, startup * 1e3, first * 1e3))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,388 @@
+"""
+	Replay recorded MSNP traces (see `front/msn/trace.py`) against a running server.
+	
+	python -m bench.replay trace.bin [--speed 4] [--copies 500] [--create-accounts]
+	
+	Every traced account is mapped to a benchmark account (`--account`, one per
+	account per copy) sharing `--password`. Scrubbed logins are redone against
+	the server: TWN/SSO tokens come from /NotRST.srf, MD5 hashes are computed from
+	the salt the server sends. Switchboard sessions are started with a fresh XFR
+	on the replaying NS connection of the same account, since traced SB tokens
+	can't be reused (ANS sessions are replayed as USR sessions).
+	
+	Reports throughput, reply latency (time from a command to the first reply with
+	the same trid) and the load generator's own event loop lag. With
+	`--perf-url` (a server with `settings.PERF_METRICS`) the server's loop lag is
+	reported too.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from collections import defaultdict
+
+from front.msn.trace import read_trace, Kind, SCRUBBED
+from util.perf import Histogram
+
+def main():
+	parser = argparse.ArgumentParser(description = "Replay MSNP traces against a server.")
+	parser.add_argument('trace', nargs = '+')
+	parser.add_argument('--host', default = '127.0.0.1')
+	parser.add_argument('--ns-port', type = int, default = 1863)
+	parser.add_argument('--sb-port', type = int, default = 1864)
+	parser.add_argument('--http-port', type = int, default = 8081)
+	parser.add_argument('--speed', type = float, default = 1, help = "replay N times faster than recorded")
+	parser.add_argument('--copies', type = int, default = 1, help = "replay every session N times, as different accounts")
+	parser.add_argument('--account', default = 'bench{}@bench.invalid', help = "format of benchmark account emails")
+	parser.add_argument('--password', default = 'benchpass')
+	parser.add_argument('--create-accounts', action = 'store_true', help = "create missing benchmark accounts in `settings.DB` first")
+	parser.add_argument('--perf-url', help = "e.g. http://127.0.0.1:8081/etc/perf")
+	args = parser.parse_args()
+	
+	sessions = _load_sessions(args.trace)
+	emails = _collect_emails(sessions)
+	if args.create_accounts:
+		_create_accounts(args, len(emails) * args.copies)
+	
+	replay = Replay(args, sessions, emails)
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(replay.run())
+	replay.report()
+	if args.perf_url:
+		loop.run_until_complete(_report_server(args.perf_url))
+
+class TracedSession:
+	def __init__(self, id, front):
+		self.id = id
+		self.front = front
+		self.time_open = None
+		self.time_close = None
+		# List[Tuple[time, bytes]]
+		self.frames = []
+		self.email = None
+
+def _load_sessions(paths):
+	sessions = []
+	for path in paths:
+		by_id = {}
+		for rec in read_trace(path):
+			ts = by_id.get(rec.session_id)
+			if ts is None:
+				ts = TracedSession(rec.session_id, rec.front)
+				by_id[rec.session_id] = ts
+				sessions.append(ts)
+			if ts.time_open is None:
+				ts.time_open = rec.time
+			ts.time_close = rec.time
+			if rec.kind is Kind.Incoming:
+				ts.frames.append((rec.time, rec.data))
+	for ts in sessions:
+		for _, data in ts.frames:
+			m = _split_frame(data)[0]
+			if ts.front == 'NS' and m[0] == 'USR' and len(m) > 4 and m[3] == 'I':
+				ts.email = m[4]
+				break
+			if ts.front == 'SB' and m[0] in ('USR', 'ANS') and len(m) > 2:
+				ts.email = m[2].split(';', 1)[0]
+				break
+	t0 = min((ts.time_open for ts in sessions), default = 0)
+	for ts in sessions:
+		ts.time_open -= t0
+		ts.time_close -= t0
+		ts.frames = [(t - t0, data) for t, data in ts.frames]
+	return [ts for ts in sessions if ts.email]
+
+def _collect_emails(sessions):
+	# Dict[email, index]
+	emails = {}
+	for ts in sessions:
+		if ts.email not in emails:
+			emails[ts.email] = len(emails)
+	return emails
+
+def _create_accounts(args, n):
+	from db import Session, User
+	from util.hash import hasher, hasher_md5
+	from util.misc import gen_uuid
+	
+	with Session() as sess:
+		for i in range(n):
+			email = args.account.format(i)
+			if sess.query(User.id).filter(User.email == email).one_or_none(): continue
+			sess.add(User(
+				uuid = gen_uuid(), email = email, verified = True,
+				name = email, message = '',
+				password = hasher.encode(args.password), password_md5 = hasher_md5.encode(args.password),
+				settings = {}, groups = [], contacts = [],
+			))
+
+class Replay:
+	def __init__(self, args, sessions, emails):
+		self.args = args
+		self.sessions = sessions
+		self.emails = emails
+		self.latency = Histogram()
+		self.loop_lag = Histogram()
+		self.counts = defaultdict(int)
+		# Dict[(copy, email), Client]
+		self.ns_clients = {}
+		self.time_start = None
+		self.time_end = None
+	
+	async def run(self):
+		self.time_start = time.time()
+		lag_task = asyncio.ensure_future(self._measure_loop_lag())
+		await asyncio.gather(*(
+			self._replay_session(copy, ts)
+			for copy in range(self.args.copies)
+			for ts in self.sessions
+		))
+		self.time_end = time.time()
+		lag_task.cancel()
+	
+	def map_email(self, copy, email):
+		i = self.emails.get(email)
+		if i is None: return email
+		return self.args.account.format(copy * len(self.emails) + i)
+	
+	async def _replay_session(self, copy, ts):
+		args = self.args
+		await self._sleep_until(ts.time_open)
+		email = self.map_email(copy, ts.email)
+		if ts.front == 'NS':
+			port = args.ns_port
+		else:
+			port = args.sb_port
+		try:
+			client = await Client.Connect(self, args.host, port)
+		except OSError:
+			self.counts['connect_failed'] += 1
+			return
+		self.counts['sessions'] += 1
+		if ts.front == 'NS':
+			self.ns_clients[(copy, email)] = client
+		try:
+			await self._replay_frames(copy, ts, client, email)
+			await self._sleep_until(ts.time_close)
+		except (ConnectionError, asyncio.IncompleteReadError):
+			self.counts['disconnected'] += 1
+		finally:
+			if self.ns_clients.get((copy, email)) is client:
+				del self.ns_clients[(copy, email)]
+			client.close()
+	
+	async def _replay_frames(self, copy, ts, client, email):
+		for t, data in ts.frames:
+			await self._sleep_until(t)
+			m, body = _split_frame(data)
+			m = [self._map_arg(copy, x) for x in m]
+			cmd = m[0]
+			if ts.front == 'SB' and cmd in ('USR', 'ANS'):
+				token = await self._get_sb_token(copy, email)
+				if token is None:
+					self.counts['sb_skipped'] += 1
+					return
+				m = ['USR', m[1], m[2], token]
+			elif ts.front == 'NS' and cmd == 'USR' and len(m) > 4 and m[3] == 'S' and m[4] == SCRUBBED:
+				m = await self._login_args(client, m, email)
+			if client.auth_done or ts.front == 'SB':
+				client.send(m, body)
+			else:
+				# Like real clients, wait for each reply until logged in
+				reply = await client.request(m, body)
+				if reply[0] == 'USR' and reply[2] == 'OK':
+					client.auth_done = True
+					client.auth_event.set()
+	
+	def _map_arg(self, copy, arg):
+		if arg.startswith('N='):
+			return 'N=' + self.map_email(copy, arg[2:])
+		if '@' in arg:
+			(email, *rest) = arg.split(';', 1)
+			return ';'.join([self.map_email(copy, email), *rest])
+		return arg
+	
+	async def _login_args(self, client, m, email):
+		authtype = m[2]
+		if authtype == 'MD5':
+			salt = client.md5_salt or ''
+			md5 = hashlib.md5((salt + self.args.password).encode('utf-8')).hexdigest()
+			return m[:4] + [md5]
+		token = await self._get_login_token(email)
+		return m[:4] + ['t={}'.format(token)] + m[5:]
+	
+	async def _get_login_token(self, email):
+		from aiohttp import ClientSession
+		url = 'http://{}:{}/NotRST.srf'.format(self.args.host, self.args.http_port)
+		async with ClientSession() as http:
+			async with http.post(url, headers = { 'X-User': email, 'X-Password': self.args.password }) as res:
+				return res.headers.get('X-Token', SCRUBBED)
+	
+	async def _get_sb_token(self, copy, email):
+		ns = self.ns_clients.get((copy, email))
+		if ns is None: return None
+		try:
+			await asyncio.wait_for(ns.auth_event.wait(), 30)
+		except asyncio.TimeoutError:
+			return None
+		reply = await ns.request(['XFR', ns.next_trid(), 'SB'], None)
+		if reply[0] != 'XFR' or len(reply) < 6: return None
+		return reply[5]
+	
+	async def _sleep_until(self, t):
+		delay = self.time_start + t / self.args.speed - time.time()
+		if delay > 0:
+			await asyncio.sleep(delay)
+	
+	async def _measure_loop_lag(self):
+		loop = asyncio.get_event_loop()
+		interval = 0.1
+		while True:
+			t0 = loop.time()
+			await asyncio.sleep(interval)
+			self.loop_lag.add(max(0, loop.time() - t0 - interval))
+	
+	def report(self):
+		duration = (self.time_end - self.time_start) or 1
+		c = self.counts
+		print("sessions:     {} replayed, {} connect failures, {} disconnected, {} SB skipped".format(
+			c['sessions'], c['connect_failed'], c['disconnected'], c['sb_skipped'],
+		))
+		print("duration:     {:.1f}s".format(duration))
+		print("sent:         {} frames, {:.1f}/s, {} bytes".format(c['sent'], c['sent'] / duration, c['bytes_sent']))
+		print("received:     {} frames, {:.1f}/s, {} bytes, {} errors, {} timeouts".format(
+			c['received'], c['received'] / duration, c['bytes_received'], c['errors'], c['timeouts'],
+		))
+		_print_histogram("reply latency", self.latency)
+		_print_histogram("loop lag", self.loop_lag)
+
+def _print_histogram(name, h):
+	if not h.count:
+		print("{:13} -".format(name + ':'))
+		return
+	print("{:13} p50 {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms ({} samples)".format(
+		name + ':', h.percentile(50) * 1000, h.percentile(99) * 1000, h.max * 1000, h.count,
+	))
+
+async def _report_server(url):
+	from aiohttp import ClientSession
+	async with ClientSession() as http:
+		async with http.get(url) as res:
+			data = json.loads(await res.text())
+	counters = { tuple(c['key']): c['value'] for c in data['counters'] }
+	if ('presence', 'notifications') in counters:
+		print("server presence notifications: {} sent, {} without coalescing".format(
+			counters[('presence', 'notifications')], counters[('presence', 'notifications', 'uncoalesced')],
+		))
+	for h in data['histograms']:
+		if h['key'] == ['loop', 'lag']:
+			print("server loop lag: p50 {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms".format(
+				h['p50'] * 1000, h['p99'] * 1000, h['max'] * 1000,
+			))
+
+class Client:
+	@classmethod
+	async def Connect(cls, replay, host, port):
+		(reader, writer) = await asyncio.open_connection(host, port)
+		client = cls(replay, reader, writer)
+		client._read_task = asyncio.ensure_future(client._read_loop())
+		return client
+	
+	def __init__(self, replay, reader, writer):
+		self._replay = replay
+		self._reader = reader
+		self._writer = writer
+		self._read_task = None
+		# Dict[trid, (time sent, Optional[Future])]
+		self._pending = {}
+		self._trid = 100000
+		self.closed = False
+		self.auth_done = False
+		self.auth_event = asyncio.Event()
+		self.md5_salt = None
+	
+	def next_trid(self):
+		self._trid += 1
+		return str(self._trid)
+	
+	def send(self, m, body):
+		data = ' '.join(m).encode('utf-8') + b'\r\n'
+		if body is not None:
+			data += body
+		if len(m) > 1 and m[1].isdigit() and m[1] != '0':
+			self._pending[m[1]] = (time.time(), None)
+		self._writer.write(data)
+		counts = self._replay.counts
+		counts['sent'] += 1
+		counts['bytes_sent'] += len(data)
+	
+	async def request(self, m, body):
+		if self.closed:
+			raise ConnectionError()
+		self.send(m, body)
+		fut = asyncio.get_event_loop().create_future()
+		self._pending[m[1]] = (self._pending[m[1]][0], fut)
+		try:
+			return await asyncio.wait_for(fut, REPLY_TIMEOUT)
+		except asyncio.TimeoutError:
+			self._replay.counts['timeouts'] += 1
+			raise ConnectionError()
+	
+	async def _read_loop(self):
+		counts = self._replay.counts
+		try:
+			while True:
+				line = await self._reader.readuntil(b'\r\n')
+				m = line.decode('utf-8', 'replace').split()
+				if not m: continue
+				n = len(line)
+				if m[0] in _SERVER_PAYLOAD_COMMANDS and m[-1].isdigit():
+					n += len(await self._reader.readexactly(int(m[-1])))
+				counts['received'] += 1
+				counts['bytes_received'] += n
+				if m[0].isdigit():
+					counts['errors'] += 1
+				if m[0] == 'USR' and len(m) > 4 and m[2] == 'MD5' and m[3] == 'S':
+					self.md5_salt = m[4]
+				self._on_reply(m)
+		except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+			pass
+		finally:
+			self.closed = True
+			for _, fut in self._pending.values():
+				if fut and not fut.done():
+					fut.set_exception(ConnectionError())
+	
+	def _on_reply(self, m):
+		if len(m) < 2: return
+		entry = self._pending.pop(m[1], None)
+		if entry is None: return
+		(t, fut) = entry
+		self._replay.latency.add(time.time() - t)
+		if fut and not fut.done():
+			fut.set_result(m)
+	
+	def close(self):
+		self.closed = True
+		self._writer.close()
+		if self._read_task:
+			self._read_task.cancel()
+
+REPLY_TIMEOUT = 30
+
+_SERVER_PAYLOAD_COMMANDS = {
+	'MSG', 'UBX', 'GCF', 'NOT', 'IPG', 'UBN', 'NFY', 'UUX', 'FQY',
+}
+
+def _split_frame(data):
+	i = data.index(b'\r\n')
+	m = data[:i].decode('utf-8').split()
+	body = None
+	if i + 2 < len(data) or (m[0] in ('UUX', 'MSG', 'ADL', 'FQY', 'RML', 'UUN') and m[-1].isdigit()):
+		body = data[i + 2:]
+	return m, body
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,82 @@
+"""
+	Grow a switchboard chat to many participants through `ANS`, and report
+	the cost of each join as the chat grows.
+	
+	python -m bench.roster [--size 200] [--dialect 12] [--rounds 5]
+"""
+
+import argparse
+import time
+
+from core.backend import Chat
+from core.models import User, UserStatus
+from core.session import PersistentSession
+from front.msn import msg_sb
+from front.msn.msnp import MSNP_SB_SessState, MSNPReader, MSNPWriter
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark switchboard joins.")
+	parser.add_argument('--size', type = int, default = 200)
+	parser.add_argument('--dialect', type = int, default = 12)
+	parser.add_argument('--rounds', type = int, default = 5)
+	args = parser.parse_args()
+	
+	marks = sorted({ n for n in (10, 50, 100, args.size) if n <= args.size })
+	totals = [0.0] * args.size
+	for _ in range(args.rounds):
+		for i, dt in enumerate(_grow_chat(args.size, args.dialect)):
+			totals[i] += dt
+	
+	print("{} participants, dialect {}, {} rounds".format(args.size, args.dialect, args.rounds))
+	total = 0.0
+	for i, dt in enumerate(totals):
+		total += dt / args.rounds
+		if i + 1 in marks:
+			print("{:>5} joined: {:>8.1f}us for the last join, {:>8.2f}ms in total".format(
+				i + 1, dt / args.rounds * 1e6, total * 1e3,
+			))
+
+def _grow_chat(size, dialect):
+	# Yields the time taken by each join
+	backend = _Backend()
+	for i in range(size):
+		email = 'user{}@example.com'.format(i)
+		sess = _make_session(backend, dialect)
+		backend.users[email] = User('uuid{}'.format(i), email, True, UserStatus("User {}".format(i)), None)
+		t0 = time.perf_counter()
+		msg_sb.apply(['ANS', '1', email, 'token', backend.chat.id], sess)
+		yield time.perf_counter() - t0
+
+class _Backend:
+	# Just enough of `core.backend.Backend` for `ANS`
+	def __init__(self):
+		self.chat = Chat(None)
+		self.users = {}
+	
+	def login_cal(self, sess, email, token, chatid):
+		sess.user = self.users[email]
+		self.chat.add_session(sess)
+		return self.chat, { 'dialect': sess.state.dialect, 'msn_capabilities': 0 }
+
+def _make_session(backend, dialect):
+	logger = _Logger()
+	state = MSNP_SB_SessState(MSNPReader(logger), backend)
+	state.dialect = dialect
+	return PersistentSession(state, MSNPWriter(logger, state), _Transport())
+
+class _Logger:
+	def info(self, *args):
+		pass
+
+class _Transport:
+	def __init__(self):
+		self.written = 0
+	
+	def write(self, data):
+		self.written += len(data)
+	
+	def is_closing(self):
+		return False
+
+if __name__ == '__main__':
+	main()
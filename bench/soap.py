@@ -0,0 +1,163 @@
+"""
+	Time taken to pick the ticket, action and fields out of typical SOAP requests:
+	parsed with `lxml.objectify` and searched with `_find_element` for every field
+	(as it used to be), and in one pass with `http.parse_soap`.
+	
+	python -m bench.soap [--rounds 2000]
+"""
+
+import argparse
+import base64
+import time
+
+import lxml.objectify
+
+from front.msn import http
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark SOAP request parsing.")
+	parser.add_argument('--rounds', type = int, default = 2000)
+	args = parser.parse_args()
+	
+	for name, (body, queries) in _REQUESTS.items():
+		body = body.encode('utf-8')
+		results = []
+		for parse in (_parse_old, _parse_new):
+			parse(body, queries)
+			t0 = time.perf_counter()
+			for _ in range(args.rounds):
+				parse(body, queries)
+			results.append((time.perf_counter() - t0) / args.rounds)
+		print("{:>20}: {:>6} bytes, old {:>7.1f}us, new {:>7.1f}us".format(
+			name, len(body), results[0] * 1e6, results[1] * 1e6,
+		))
+
+def _parse_old(body, queries):
+	root = lxml.objectify.fromstring(body)
+	token = http._find_element(root, 'TicketToken')
+	if token[0:2] == 't=':
+		token = token[2:22]
+	http._find_element(root, 'Header')
+	action = http._find_element(root, 'Body/*[1]')
+	for query in queries:
+		http._find_element(action, query)
+
+def _parse_new(body, queries):
+	(_, _, fields, _) = http.parse_soap(body)
+	for query in queries:
+		fields.get(query)
+
+_ENVELOPE = '''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+	<soap:Header>
+		<ABApplicationHeader xmlns="http://www.msn.com/webservices/AddressBook">
+			<ApplicationId>CFE80F9D-180F-4399-82AB-413F33A1FA11</ApplicationId>
+			<IsMigration>false</IsMigration>
+			<PartnerScenario>Initial</PartnerScenario>
+		</ABApplicationHeader>
+		<ABAuthHeader xmlns="http://www.msn.com/webservices/AddressBook">
+			<ManagedGroupRequest>false</ManagedGroupRequest>
+			<TicketToken>t=0123456789abcdefghij&amp;p=</TicketToken>
+		</ABAuthHeader>
+	</soap:Header>
+	<soap:Body>
+		{}
+	</soap:Body>
+</soap:Envelope>'''
+
+_REQUESTS = {
+	'FindMembership': (_ENVELOPE.format('''<FindMembership xmlns="http://www.msn.com/webservices/AddressBook">
+			<serviceFilter>
+				<Types>
+					<ServiceType>Messenger</ServiceType>
+					<ServiceType>Invitation</ServiceType>
+					<ServiceType>SocialNetwork</ServiceType>
+					<ServiceType>Space</ServiceType>
+					<ServiceType>Profile</ServiceType>
+				</Types>
+			</serviceFilter>
+			<View>Full</View>
+			<deltasOnly>true</deltasOnly>
+			<lastChange>2017-01-01T00:00:00.0000000-08:00</lastChange>
+		</FindMembership>'''), ['deltasOnly', 'lastChange']),
+	'AddMember': (_ENVELOPE.format('''<AddMember xmlns="http://www.msn.com/webservices/AddressBook">
+			<serviceHandle>
+				<Id>0</Id>
+				<Type>Messenger</Type>
+				<ForeignId></ForeignId>
+			</serviceHandle>
+			<memberships>
+				<Membership>
+					<MemberRole>Allow</MemberRole>
+					<Members>
+						<Member xsi:type="PassportMember">
+							<Type>Passport</Type>
+							<State>Accepted</State>
+							<PassportName>contact@example.com</PassportName>
+						</Member>
+					</Members>
+				</Membership>
+			</memberships>
+		</AddMember>'''), ['MemberRole', 'PassportName']),
+	'ABContactAdd': (_ENVELOPE.format('''<ABContactAdd xmlns="http://www.msn.com/webservices/AddressBook">
+			<abId>00000000-0000-0000-0000-000000000000</abId>
+			<contacts>
+				<Contact xmlns="http://www.msn.com/webservices/AddressBook">
+					<contactInfo>
+						<contactType>LivePending</contactType>
+						<passportName>contact@example.com</passportName>
+						<isMessengerUser>true</isMessengerUser>
+						<MessengerMemberInfo>
+							<DisplayName>contact@example.com</DisplayName>
+						</MessengerMemberInfo>
+					</contactInfo>
+				</Contact>
+			</contacts>
+			<options>
+				<EnableAllowListManagement>true</EnableAllowListManagement>
+			</options>
+		</ABContactAdd>'''), ['passportName', 'isMessengerUser', 'contactType']),
+	'ABGroupContactAdd': (_ENVELOPE.format('''<ABGroupContactAdd xmlns="http://www.msn.com/webservices/AddressBook">
+			<abId>00000000-0000-0000-0000-000000000000</abId>
+			<groupFilter>
+				<groupIds>
+					<guid>4f3cb8f2-2ed8-4ad9-8d8a-76cf7e5cc6c3</guid>
+				</groupIds>
+			</groupFilter>
+			<contacts>
+				<Contact>
+					<contactId>0c3a7a2a-2c0a-4ab4-9e0c-1ab8b0e0c0a1</contactId>
+				</Contact>
+			</contacts>
+		</ABGroupContactAdd>'''), ['guid', 'contactId', 'passportName']),
+	'ABFindAll (deltas)': (_ENVELOPE.format('''<ABFindAll xmlns="http://www.msn.com/webservices/AddressBook">
+			<abId>00000000-0000-0000-0000-000000000000</abId>
+			<abView>Full</abView>
+			<deltasOnly>true</deltasOnly>
+			<lastChange>2017-01-01T00:00:00.0000000-08:00</lastChange>
+		</ABFindAll>'''), ['deltasOnly', 'lastChange']),
+	'CreateDocument': (_ENVELOPE.format('''<CreateDocument xmlns="http://www.msn.com/webservices/storage/2008">
+			<parentHandle>
+				<RelationshipName>/UserTiles</RelationshipName>
+				<Alias>
+					<Name>0000000000000000</Name>
+					<NameSpace>MyStorage</NameSpace>
+				</Alias>
+			</parentHandle>
+			<document xsi:type="Photo">
+				<Name>?</Name>
+				<DocumentStreams>
+					<DocumentStream xsi:type="PhotoStream">
+						<DocumentStreamType>UserTileStatic</DocumentStreamType>
+						<MimeType>png</MimeType>
+						<Data>{}</Data>
+						<DataSize>0</DataSize>
+					</DocumentStream>
+				</DocumentStreams>
+			</document>
+			<relationshipName>Messenger User Tile</relationshipName>
+		</CreateDocument>'''.format(base64.b64encode(bytes(range(256)) * 60).decode('ascii'))), ['Name', 'MimeType', 'Data']),
+}
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,58 @@
+"""
+	Compare UUX payload parsing with `lxml.objectify` (as it used to be done)
+	against `front.msn.msg_ns.parse_uux`.
+	
+	python -m bench.uux [trace.bin ...] [--rounds 20000]
+	
+	Payloads are taken from the UUX commands in the given traces (see
+	`front/msn/trace.py`), or from a few built-in samples without traces.
+"""
+
+import argparse
+import time
+
+from lxml.objectify import fromstring as parse_xml
+
+from front.msn.trace import read_trace, Kind
+from front.msn.msg_ns import parse_uux
+
+SAMPLES = [
+	b'<Data><PSM></PSM><CurrentMedia></CurrentMedia><MachineGuid>{F26D1F07-95E2-403C-BC18-D4BFED493428}</MachineGuid></Data>',
+	b'<Data><PSM>out for lunch</PSM><CurrentMedia></CurrentMedia></Data>',
+	b'<Data><PSM>brb</PSM><CurrentMedia>\\0Music\\01\\0{0} - {1}\\0Song Title\\0Artist\\0\\0</CurrentMedia><MachineGuid>{F26D1F07-95E2-403C-BC18-D4BFED493428}</MachineGuid></Data>',
+	b'<Data><PSM>fish &amp; chips</PSM><CurrentMedia></CurrentMedia></Data>',
+]
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark UUX payload parsing.")
+	parser.add_argument('trace', nargs = '*')
+	parser.add_argument('--rounds', type = int, default = 20000)
+	args = parser.parse_args()
+	
+	payloads = _load_payloads(args.trace) or SAMPLES
+	print("{} payloads, {} bytes on average".format(len(payloads), sum(map(len, payloads)) // len(payloads)))
+	
+	for name, f in (('lxml.objectify', _parse_objectify), ('parse_uux', parse_uux)):
+		n = 0
+		t0 = time.perf_counter()
+		while n < args.rounds:
+			for data in payloads:
+				f(data)
+			n += len(payloads)
+		dt = time.perf_counter() - t0
+		print("{:>15}: {:>9.0f} payloads/s, {:.2f}us each".format(name, n / dt, dt / n * 1e6))
+
+def _parse_objectify(data):
+	elm = parse_xml(data.decode('utf-8'))
+	return (elm.find('PSM'), elm.find('CurrentMedia'), elm.find('MachineGuid'))
+
+def _load_payloads(paths):
+	payloads = []
+	for path in paths:
+		for rec in read_trace(path):
+			if rec.kind is not Kind.Incoming or not rec.data.startswith(b'UUX '): continue
+			payloads.append(rec.data[rec.data.index(b'\r\n') + 2:])
+	return payloads
+
+if __name__ == '__main__':
+	main()
@@ -1,4 +1,5 @@
+import sqlalchemy as sa
 import db
 
 with db.Session() as sess:
-	sess.execute('ALTER TABLE t_user ADD COLUMN password_md5 TEXT DEFAULT \'\'')
+	sess.execute(sa.text('ALTER TABLE t_user ADD COLUMN list_version INTEGER NOT NULL DEFAULT 0'))
@@ -1,13 +1,15 @@
 import asyncio, time
-from collections import defaultdict
+from collections import defaultdict, deque
 from enum import IntFlag
 
-from util.misc import gen_uuid, EMPTY_SET, run_loop
+from util.misc import gen_uuid, first_in_iterable, EMPTY_SET, run_loop
+from util.perf import metrics
+import settings
 
 from .user import UserService
 from .auth import AuthService
 from .stats import Stats
-from .models import User, Group, Lst, Contact, UserStatus
+from .models import User, Group, Lst, Contact, UserStatus, Substatus, ListChange, ListChangeKind
 from . import error, event
 
 class Ack(IntFlag):
@@ -28,6 +30,8 @@ class Backend:
 		self._user_by_uuid = {}
 		# Dict[User, UserDetail]
 		self._unsynced_db = {}
+		# Dict[User, PendingPresence], see `me_update`
+		self._pending_presence = {}
 		
 		# Dict[chatid, Chat]
 		self._chats = {}
@@ -37,6 +41,8 @@ class Backend:
 		loop.create_task(self._sync_db())
 		loop.create_task(self._clean_sessions())
 		loop.create_task(self._sync_stats())
+		if settings.PERF_METRICS:
+			loop.create_task(self._measure_loop_lag())
 	
 	def add_runner(self, runner):
 		self._runners.append(runner)
@@ -54,7 +60,9 @@ class Backend:
 			# so don't send offline notifications.
 			return
 		# User is offline, send notifications
+		self._pending_presence.pop(user, None)
 		user.detail = None
+		user.status.substatus = Substatus.FLN
 		self._sync_contact_statuses()
 		self._generic_notify(sess)
 	
@@ -98,12 +106,18 @@ class Backend:
 	
 	def _load_detail(self, user):
 		if user.detail: return user.detail
+		# Changes not saved yet would be lost by loading from the DB
+		detail = self._unsynced_db.get(user)
+		if detail: return detail
 		return self._user_service.get_detail(user.uuid)
 	
-	def _generic_notify(self, sess):
+	def _generic_notify(self, sess, changed = None):
 		# Notify relevant `Session`s of status, name, message, media
+		# `changed`: see `PresenceNotificationEvent`
+		# Returns the number of notifications sent
 		user = sess.user
-		if user is None: return
+		if user is None: return 0
+		n = 0
 		# TODO: This does a lot of work, iterating through _every_ session.
 		# If RL is set up properly, could iterate through `user.detail.contacts`.
 		for sess_other in self._sc.iter_sessions():
@@ -113,21 +127,49 @@ class Backend:
 			if user_other.detail is None: continue
 			ctc = user_other.detail.contacts.get(user.uuid)
 			if ctc is None: continue
-			sess_other.send_event(event.PresenceNotificationEvent(ctc))
+			sess_other.send_event(event.PresenceNotificationEvent(ctc, changed = changed))
+			n += 1
+		return n
 	
 	def _sync_contact_statuses(self):
 		# Recompute all `Contact.status`'s
 		for user in self._user_by_uuid.values():
 			detail = user.detail
 			if detail is None: continue
+			renamed = False
 			for ctc in detail.contacts.values():
+				name = ctc.status.name
 				ctc.compute_visible_status(user)
-	
-	def _mark_modified(self, user, *, detail = None):
+				if ctc.status.name != name:
+					renamed = True
+			if renamed:
+				# Names follow presence, so they're not in the saved list version or the
+				# list change log; AB deltas find renames themselves, see `front.msn.http`.
+				user.detail_version += 1
+	
+	def _mark_modified(self, user, *, detail = None, list_changed = True):
 		ud = user.detail or detail
 		if detail: assert ud is detail
 		assert ud is not None
 		self._unsynced_db[user] = ud
+		if list_changed:
+			user.detail_version += 1
+	
+	def _log_list_change(self, user, kind, **kwargs):
+		user.list_version += 1
+		if user.list_changes is None:
+			user.list_changes = deque(maxlen = settings.LIST_CHANGE_LOG_SIZE)
+		user.list_changes.append(ListChange(user.list_version, kind, **kwargs))
+	
+	def util_get_list_changes(self, user, since):
+		# Returns the changes made after version `since`,
+		# or `None` if they aren't all in the log (so the whole list needs to be sent).
+		if since > user.list_version: return None
+		changes = user.list_changes or ()
+		n = user.list_version - since
+		if n > len(changes): return None
+		if n == 0: return []
+		return list(changes)[-n:]
 	
 	def sb_token_create(self, sess, *, extra_data = None):
 		if extra_data is None:
@@ -135,25 +177,80 @@ class Backend:
 		extra_data['client'] = sess.client
 		return self._auth_service.create_token('sb/xfr', { 'uuid': sess.user.uuid, 'extra_data': extra_data })
 	
-	def me_update(self, sess, fields):
+	def me_update(self, sess, fields, *, force_notify = False):
+		# Clients resend unchanged values all the time, so only what
+		# actually changed is saved and sent to contacts.
+		# `force_notify`: front-specific presence data (e.g. MSNP capabilities) changed
 		user = sess.user
+		status = user.status
+		user_settings = user.detail.settings
+		was_offlineish = status.is_offlineish()
+		changed = set()
 		
-		if 'message' in fields:
-			user.status.message = fields['message']
-		if 'media' in fields:
-			user.status.media = fields['media']
-		if 'name' in fields:
-			user.status.name = fields['name']
-		if 'gtc' in fields:
-			user.detail.settings['gtc'] = fields['gtc']
-		if 'blp' in fields:
-			user.detail.settings['blp'] = fields['blp']
-		if 'substatus' in fields:
-			user.status.substatus = fields['substatus']
+		if 'message' in fields and fields['message'] != status.message:
+			status.message = fields['message']
+			changed.add('message')
+		if 'media' in fields and fields['media'] != status.media:
+			status.media = fields['media']
+			changed.add('media')
+		if 'name' in fields and fields['name'] != status.name:
+			status.name = fields['name']
+			changed.add('name')
+			self._log_list_change(user, ListChangeKind.Name, value = fields['name'])
+		if 'gtc' in fields and fields['gtc'] != user_settings.get('GTC'):
+			user_settings['GTC'] = fields['gtc']
+			changed.add('gtc')
+			self._log_list_change(user, ListChangeKind.Setting, key = 'GTC', value = fields['gtc'])
+		if 'blp' in fields and fields['blp'] != user_settings.get('BLP'):
+			user_settings['BLP'] = fields['blp']
+			changed.add('blp')
+			self._log_list_change(user, ListChangeKind.Setting, key = 'BLP', value = fields['blp'])
+		if 'substatus' in fields and fields['substatus'] != status.substatus:
+			status.substatus = fields['substatus']
+			changed.add('substatus')
 		
-		self._mark_modified(user)
+		if changed & _SAVED_FIELDS:
+			self._mark_modified(user, list_changed = bool(changed & _LIST_FIELDS))
+		
+		notify = changed & _PRESENCE_FIELDS
+		if force_notify:
+			notify.add('front_specific')
+		if not notify: return
 		self._sync_contact_statuses()
-		self._generic_notify(sess)
+		if was_offlineish and status.is_offlineish():
+			# Contacts see FLN either way
+			return
+		if was_offlineish or 'blp' in notify:
+			# Contacts who saw FLN need everything
+			notify = None
+		self._notify_presence(sess, notify)
+	
+	def _notify_presence(self, sess, changed):
+		# Clients tend to send CHG/UUX/PRP in bursts; changes within
+		# `settings.PRESENCE_COALESCE_WINDOW` of the first one are sent to contacts together.
+		# Notifications are built when sent, so they show the latest status.
+		window = settings.PRESENCE_COALESCE_WINDOW
+		if not window:
+			n = self._generic_notify(sess, changed)
+			if settings.PERF_METRICS:
+				metrics.incr(('presence', 'notifications'), n)
+				metrics.incr(('presence', 'notifications', 'uncoalesced'), n)
+			return
+		user = sess.user
+		pending = self._pending_presence.get(user)
+		if pending is None:
+			self._pending_presence[user] = PendingPresence(sess, changed)
+			self._loop.call_later(window, self._flush_presence, user)
+			return
+		pending.add(sess, changed)
+	
+	def _flush_presence(self, user):
+		pending = self._pending_presence.pop(user, None)
+		if pending is None: return
+		n = self._generic_notify(pending.sess, pending.changed)
+		if settings.PERF_METRICS:
+			metrics.incr(('presence', 'notifications'), n)
+			metrics.incr(('presence', 'notifications', 'uncoalesced'), n * pending.count)
 	
 	def me_group_add(self, sess, name, *, is_favorite = None):
 		if len(name) > MAX_GROUP_NAME_LENGTH:
@@ -161,6 +258,7 @@ class Backend:
 		user = sess.user
 		group = Group(_gen_group_id(user.detail), name, is_favorite = is_favorite)
 		user.detail.groups[group.id] = group
+		self._log_list_change(user, ListChangeKind.GroupAdd, group_id = group.id, value = name)
 		self._mark_modified(user)
 		return group
 	
@@ -174,6 +272,7 @@ class Backend:
 			raise error.GroupDoesNotExist()
 		for ctc in user.detail.contacts.values():
 			ctc.groups.discard(group_id)
+		self._log_list_change(user, ListChangeKind.GroupRemove, group_id = group_id)
 		self._mark_modified(user)
 	
 	def me_group_edit(self, sess, group_id, new_name, *, is_favorite = None):
@@ -184,9 +283,13 @@ class Backend:
 		if new_name is not None:
 			if len(new_name) > MAX_GROUP_NAME_LENGTH:
 				raise error.GroupNameTooLong()
-			g.new_name = new_name
-		if is_favorite is not None:
+			g.name = new_name
+		key = None
+		if is_favorite is not None and is_favorite != g.is_favorite:
 			g.is_favorite = is_favorite
+			# Its contacts' favorite flags change with it
+			key = 'IsFavorite'
+		self._log_list_change(user, ListChangeKind.GroupEdit, group_id = group_id, key = key, value = g.name)
 		self._mark_modified(user)
 	
 	def me_group_contact_add(self, sess, group_id, contact_uuid):
@@ -201,6 +304,9 @@ class Backend:
 		if group_id in ctc.groups:
 			raise error.ContactAlreadyOnList()
 		ctc.groups.add(group_id)
+		self._log_list_change(user, ListChangeKind.ContactAdd,
+			lst = Lst.FL, contact = ctc.head, group_id = group_id, value = ctc.status.name,
+		)
 		self._mark_modified(user)
 	
 	def me_group_contact_remove(self, sess, group_id, contact_uuid):
@@ -216,6 +322,7 @@ class Backend:
 		except KeyError:
 			if group_id == '0':
 				raise error.ContactNotOnList()
+		self._log_list_change(user, ListChangeKind.ContactRemove, lst = Lst.FL, contact = ctc.head, group_id = group_id)
 		self._mark_modified(user)
 	
 	def me_contact_add(self, sess, contact_uuid, lst, name):
@@ -232,12 +339,49 @@ class Backend:
 		self._generic_notify(sess)
 		return ctc, ctc_head
 	
+	def me_contact_add_bulk(self, sess, contacts):
+		# `contacts`: List[(email, Lst)]. Like `me_contact_add` for each list of each contact
+		# not already on it, but with one save, status update and presence notification.
+		# Returns the `Contact`s that were added to a list.
+		user = sess.user
+		detail = user.detail
+		by_email = { ctc.head.email: ctc for ctc in detail.contacts.values() }
+		unknown = [email for email, _ in contacts if email not in by_email]
+		uuid_by_email = self._user_service.get_uuids(unknown)
+		
+		added = []
+		for email, lsts in contacts:
+			ctc = by_email.get(email)
+			if ctc is None:
+				ctc_head = self._load_user_record(uuid_by_email.get(email))
+				if ctc_head is None: continue
+			else:
+				ctc_head = ctc.head
+			changed = False
+			for lst in (Lst.FL, Lst.AL, Lst.BL):
+				if not lsts & lst: continue
+				if ctc is not None and ctc.lists & lst: continue
+				ctc = self._add_to_list(user, ctc_head, lst, email, mark_modified = False)
+				if lst is Lst.FL:
+					self._add_to_list(ctc_head, user, Lst.RL, user.status.name)
+					self._notify_reverse_add(sess, ctc_head)
+				changed = True
+			if changed:
+				added.append(ctc)
+		
+		if added:
+			self._mark_modified(user)
+			self._sync_contact_statuses()
+			if not user.status.is_offlineish():
+				self._generic_notify(sess)
+		return added
+	
 	def _notify_reverse_add(self, sess, user_added):
 		user_adder = sess.user
 		# `user_added` was added to `user_adder`'s RL
 		for sess_added in self._sc.get_sessions_by_user(user_added):
 			if sess_added == sess: continue
-			sess_added.send_event(event.AddedToListEvent(Lst.RL, user_adder))
+			sess_added.send_event(event.AddedToListEvent(Lst.RL, user_adder, list_version = user_added.list_version))
 	
 	def me_contact_edit(self, sess, contact_uuid, *, is_messenger_user = None):
 		user = sess.user
@@ -246,6 +390,7 @@ class Backend:
 			raise error.ContactDoesNotExist()
 		if is_messenger_user is not None:
 			ctc.is_messenger_user = is_messenger_user
+		self._log_list_change(user, ListChangeKind.ContactEdit, contact = ctc.head)
 		self._mark_modified(user)
 	
 	def me_contact_remove(self, sess, contact_uuid, lst):
@@ -261,10 +406,34 @@ class Backend:
 		else:
 			assert lst is not Lst.RL
 			ctc.lists &= ~lst
+			self._log_list_change(user, ListChangeKind.ContactRemove, lst = lst, contact = ctc.head)
 		self._mark_modified(user)
 		self._sync_contact_statuses()
 	
-	def _add_to_list(self, user, ctc_head, lst, name):
+	def me_contact_remove_bulk(self, sess, contacts):
+		# `contacts`: List[(email, Lst)]. Like `me_contact_remove` for each list of each contact
+		# that's on it, but with one save and status update.
+		user = sess.user
+		detail = user.detail
+		by_email = { ctc.head.email: ctc for ctc in detail.contacts.values() }
+		removed = False
+		for email, lsts in contacts:
+			ctc = by_email.get(email)
+			if ctc is None: continue
+			for lst in (Lst.FL, Lst.AL, Lst.BL):
+				if not lsts & lst or not ctc.lists & lst: continue
+				if lst is Lst.FL:
+					self._remove_from_list(user, ctc.head, Lst.FL, mark_modified = False)
+					self._remove_from_list(ctc.head, user, Lst.RL)
+				else:
+					ctc.lists &= ~lst
+					self._log_list_change(user, ListChangeKind.ContactRemove, lst = lst, contact = ctc.head)
+				removed = True
+		if removed:
+			self._mark_modified(user)
+			self._sync_contact_statuses()
+	
+	def _add_to_list(self, user, ctc_head, lst, name, *, mark_modified = True):
 		# Add `ctc_head` to `user`'s `lst`
 		detail = self._load_detail(user)
 		contacts = detail.contacts
@@ -274,10 +443,12 @@ class Backend:
 		if ctc.status.name is None:
 			ctc.status.name = name
 		ctc.lists |= lst
-		self._mark_modified(user, detail = detail)
+		self._log_list_change(user, ListChangeKind.ContactAdd, lst = lst, contact = ctc_head, value = ctc.status.name)
+		if mark_modified:
+			self._mark_modified(user, detail = detail)
 		return ctc
 	
-	def _remove_from_list(self, user, ctc_head, lst):
+	def _remove_from_list(self, user, ctc_head, lst, *, mark_modified = True):
 		# Remove `ctc_head` from `user`'s `lst`
 		detail = self._load_detail(user)
 		contacts = detail.contacts
@@ -286,7 +457,9 @@ class Backend:
 		ctc.lists &= ~lst
 		if not ctc.lists:
 			del contacts[ctc_head.uuid]
-		self._mark_modified(user, detail = detail)
+		self._log_list_change(user, ListChangeKind.ContactRemove, lst = lst, contact = ctc_head)
+		if mark_modified:
+			self._mark_modified(user, detail = detail)
 	
 	def me_pop_boot_others(self, sess):
 		for sess_other in self._sc.get_sessions_by_user(sess.user):
@@ -328,6 +501,9 @@ class Backend:
 	def util_get_uuid_from_email(self, email):
 		return self._user_service.get_uuid(email)
 	
+	def util_get_uuids_from_emails(self, emails):
+		return self._user_service.get_uuids(emails)
+	
 	def util_set_sess_token(self, sess, token):
 		self._sc.set_nc_by_token(sess, token)
 	
@@ -337,6 +513,27 @@ class Backend:
 	def util_get_sessions_by_user(self, user):
 		return self._sc.get_sessions_by_user(user)
 	
+	def util_iter_sessions(self):
+		return self._sc.iter_sessions()
+	
+	def util_get_online_contacts(self, user):
+		# Returns (Contact, Session) for each contact of `user` that's online and visible to them
+		contacts = user.detail.contacts
+		online_users = self._sc.get_online_users()
+		result = []
+		if len(contacts) <= len(online_users):
+			for ctc in contacts.values():
+				if ctc.status.is_offlineish(): continue
+				ctc_sess = first_in_iterable(self._sc.get_sessions_by_user(ctc.head))
+				if ctc_sess is None: continue
+				result.append((ctc, ctc_sess))
+		else:
+			for ctc_head, ctc_sessions in online_users.items():
+				ctc = contacts.get(ctc_head.uuid)
+				if ctc is None or ctc.status.is_offlineish(): continue
+				result.append((ctc, first_in_iterable(ctc_sessions)))
+		return result
+	
 	def notify_call(self, caller_uuid, callee_email, chatid):
 		caller = self._user_by_uuid.get(caller_uuid)
 		if caller is None: raise error.ServerError()
@@ -391,7 +588,7 @@ class Backend:
 						closed.append(sess)
 						continue
 					if isinstance(sess, PollingSession):
-						if now >= sess.time_last_connect + sess.timeout:
+						if sess.overflowed or now >= sess.time_last_connect + sess.timeout:
 							sess.close()
 							closed.append(sess)
 			except Exception:
@@ -409,6 +606,31 @@ class Backend:
 			except Exception:
 				import traceback
 				traceback.print_exc()
+	
+	async def _measure_loop_lag(self):
+		# How late a sleep wakes up is how long everything else kept the loop busy
+		interval = 0.1
+		while True:
+			t0 = self._loop.time()
+			await asyncio.sleep(interval)
+			metrics.observe(('loop', 'lag'), max(0, self._loop.time() - t0 - interval))
+
+class PendingPresence:
+	__slots__ = ('sess', 'changed', 'count')
+	
+	def __init__(self, sess, changed):
+		self.sess = sess
+		self.changed = changed
+		self.count = 1
+	
+	def add(self, sess, changed):
+		# The session that made the last change doesn't get notified of it
+		self.sess = sess
+		if self.changed is None or changed is None:
+			self.changed = None
+		else:
+			self.changed = self.changed | changed
+		self.count += 1
 
 class _SessionCollection:
 	def __init__(self):
@@ -429,6 +651,10 @@ class _SessionCollection:
 	def iter_sessions(self):
 		yield from self._sessions
 	
+	def get_online_users(self):
+		# Dict[User, Set[Session]], only users with sessions
+		return self._sessions_by_user
+	
 	def set_nc_by_token(self, sess, token: str):
 		self._sess_by_token[token] = sess
 		self._tokens_by_sess[sess].add(sess)
@@ -449,7 +675,10 @@ class _SessionCollection:
 				self._sess_by_token.pop(token, None)
 		self._sessions.discard(sess)
 		if sess.user in self._sessions_by_user:
-			self._sessions_by_user[sess.user].discard(sess)
+			sessions = self._sessions_by_user[sess.user]
+			sessions.discard(sess)
+			if not sessions:
+				del self._sessions_by_user[sess.user]
 
 class Chat:
 	def __init__(self, stats):
@@ -461,14 +690,31 @@ class Chat:
 	def add_session(self, sess):
 		self._users_by_sess[sess] = sess.user
 	
-	def send_message_to_everyone(self, sess_sender, data):
-		self._stats.on_message_sent(sess_sender.user, sess_sender.client)
-		self._stats.on_user_active(sess_sender.user, sess_sender.client)
+	def send_message_to_everyone(self, sess_sender, data, *, control = False):
+		# Returns `(failed, pending)`: whether the message didn't reach some recipient,
+		# and the recipients it's held up for (see `Session.delivery_status`).
+		# `control` messages (e.g. typing notifications) aren't counted in stats.
+		if not control:
+			self._stats.on_message_sent(sess_sender.user, sess_sender.client)
+			self._stats.on_user_active(sess_sender.user, sess_sender.client)
 		su_sender = self._users_by_sess[sess_sender]
+		msg = event.ChatMessage(su_sender, data)
+		received_by_client = defaultdict(int)
+		failed = False
+		pending = []
 		for sess in self._users_by_sess.keys():
 			if sess == sess_sender: continue
-			sess.send_event(event.ChatMessage(su_sender, data))
-			self._stats.on_message_received(sess.user, sess.client)
+			sess.send_event(msg)
+			status = sess.delivery_status()
+			if status is None:
+				pending.append(sess)
+			elif not status:
+				failed = True
+			received_by_client[sess.client] += 1
+		if not control:
+			for client, n in received_by_client.items():
+				self._stats.on_messages_received(client, n)
+		return (failed, pending)
 	
 	def get_roster(self, sess):
 		roster = []
@@ -478,16 +724,19 @@ class Chat:
 		return roster
 	
 	def send_participant_joined(self, sess):
-		for sc, _ in self.get_roster(self):
-			sc.send_event(event.ChatParticipantJoined(sess))
+		# One event for everyone, so fronts can encode it once
+		evt = event.ChatParticipantJoined(sess)
+		for sc in self._users_by_sess.keys():
+			if sc == sess: continue
+			sc.send_event(evt)
 	
 	def on_leave(self, sess):
 		su = self._users_by_sess.pop(sess, None)
 		if su is None: return
 		# Notify others that `sess` has left
-		for sess1, su1 in self._users_by_sess.items():
-			if sess1 == sess: continue
-			sess1.send_event(event.ChatParticipantLeft(su))
+		evt = event.ChatParticipantLeft(su)
+		for sess1 in self._users_by_sess.keys():
+			sess1.send_event(evt)
 
 def _gen_group_id(detail):
 	id = 1
@@ -498,3 +747,7 @@ def _gen_group_id(detail):
 	return s
 
 MAX_GROUP_NAME_LENGTH = 61
+# `Backend.me_update` fields stored in the DB; in contact lists; seen by contacts
+_SAVED_FIELDS = frozenset(('message', 'name', 'gtc', 'blp'))
+_LIST_FIELDS = frozenset(('name', 'gtc', 'blp'))
+_PRESENCE_FIELDS = frozenset(('message', 'media', 'name', 'blp', 'substatus'))
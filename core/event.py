@@ -1,11 +1,15 @@
 class PresenceNotificationEvent:
-	def __init__(self, contact):
+	def __init__(self, contact, *, changed = None):
 		self.contact = contact
+		# `changed`: names of `Backend.me_update` fields that changed, or `None` if unknown
+		self.changed = changed
 
 class AddedToListEvent:
-	def __init__(self, lst, user):
+	def __init__(self, lst, user, *, list_version = None):
 		self.lst = lst
 		self.user = user
+		# `list_version`: of the list `user` was added to
+		self.list_version = list_version
 
 class InvitedToChatEvent:
 	def __init__(self, chatid, token, caller):
@@ -16,20 +20,31 @@ class InvitedToChatEvent:
 class ChatParticipantJoined:
 	def __init__(self, sess):
 		self.sess = sess
+		# See `ChatMessage.encoded`
+		self.encoded = {}
 
 class ChatParticipantLeft:
 	def __init__(self, user):
 		self.user = user
+		# See `ChatMessage.encoded`
+		self.encoded = {}
 
 class ChatMessage:
 	def __init__(self, user_sender, data):
 		self.user_sender = user_sender
 		self.data = data
+		# One event is sent to all recipients; fronts can cache their encoding of it here
+		self.encoded = {}
 
 class ReplyEvent:
 	def __init__(self, data):
 		self.data = data
 
+class EncodedReplyEvent:
+	# `data`: bytes, already encoded for the session's protocol
+	def __init__(self, data):
+		self.data = data
+
 class POPBootEvent:
 	def __init__(self):
 		pass
@@ -1,7 +1,7 @@
 from enum import Enum, IntFlag
 
 class User:
-	def __init__(self, uuid, email, verified, status, date_created):
+	def __init__(self, uuid, email, verified, status, date_created, *, list_version = 0):
 		self.uuid = uuid
 		self.email = email
 		self.verified = verified
@@ -9,6 +9,13 @@ class User:
 		self.status = status
 		self.detail = None
 		self.date_created = date_created
+		# Incremented whenever `detail` changes in a way visible in a contact list
+		# (lists, groups, names, settings). Lives here so it survives `detail` reloads.
+		self.detail_version = 0
+		# Serial number of the contact list as seen by MSNP2-9 clients; saved in the DB.
+		self.list_version = list_version
+		# Deque[ListChange], the most recent changes that led up to `list_version`
+		self.list_changes = None
 
 class Contact:
 	def __init__(self, user, groups, lists, status, *, is_messenger_user = None):
@@ -58,6 +65,24 @@ class UserDetail:
 		self.groups = {}
 		self.contacts = {}
 
+class ListChange:
+	# `kind` is a `ListChangeKind`; the other fields are `None` where they don't apply:
+	# - `ContactAdd`/`ContactRemove`: `lst`, `contact` (`User`), `group_id`, `value` (name on add)
+	# - `ContactEdit`: `contact` (for changes not sent by MSNP SYN, e.g. `is_messenger_user`)
+	# - `GroupAdd`/`GroupEdit`: `group_id`, `value` (name); `GroupRemove`: `group_id`
+	# - `GroupEdit` also has `key` 'IsFavorite' if that was toggled
+	# - `Setting`: `key` ('GTC', 'BLP'), `value`; `Name`: `value`
+	__slots__ = ('version', 'kind', 'lst', 'contact', 'group_id', 'key', 'value')
+	
+	def __init__(self, version, kind, *, lst = None, contact = None, group_id = None, key = None, value = None):
+		self.version = version
+		self.kind = kind
+		self.lst = lst
+		self.contact = contact
+		self.group_id = group_id
+		self.key = key
+		self.value = value
+
 class Group:
 	def __init__(self, id, name, *, is_favorite = None):
 		self.id = id
@@ -79,6 +104,16 @@ class Substatus(Enum):
 	LUN = object()
 	HDN = object()
 
+class ListChangeKind(Enum):
+	ContactAdd = object()
+	ContactRemove = object()
+	ContactEdit = object()
+	GroupAdd = object()
+	GroupRemove = object()
+	GroupEdit = object()
+	Setting = object()
+	Name = object()
+
 class Lst(IntFlag):
 	FL = 0x01
 	AL = 0x02
@@ -1,4 +1,10 @@
+import asyncio
 import time
+from collections import deque
+
+import settings
+from util.perf import metrics
+
 from . import event
 
 class Session:
@@ -14,6 +20,15 @@ class Session:
 	def send_reply(self, *data):
 		self.send_event(event.ReplyEvent(data))
 	
+	def delivery_status(self):
+		# Whether events sent so far have been passed on to a live connection:
+		# `True`/`False`, or `None` if they're held up (see `wait_delivered`)
+		return not self.closed
+	
+	async def wait_delivered(self, timeout):
+		# Waits at most `timeout` seconds for held up events; returns the final `delivery_status`
+		return not self.closed
+	
 	def close(self):
 		if self.closed: return
 		try:
@@ -26,17 +41,47 @@ class PersistentSession(Session):
 		super().__init__(state)
 		self.writer = writer
 		self.transport = transport
+		# Cleared while the transport's write buffer is over its high-water mark;
+		# only created once that first happens.
+		self._writable = None
 	
 	def send_event(self, outgoing_event):
 		self.writer.write(outgoing_event)
 		self.transport.write(self.writer.flush())
 	
+	def pause_writing(self):
+		if self._writable is None:
+			self._writable = asyncio.Event()
+		self._writable.clear()
+	
+	def resume_writing(self):
+		if self._writable is not None:
+			self._writable.set()
+	
+	def delivery_status(self):
+		if self.closed or self.transport.is_closing():
+			return False
+		if self._writable is not None and not self._writable.is_set():
+			return None
+		return True
+	
+	async def wait_delivered(self, timeout):
+		writable = self._writable
+		if writable is not None:
+			try:
+				await asyncio.wait_for(writable.wait(), timeout)
+			except asyncio.TimeoutError:
+				return False
+		return bool(self.delivery_status())
+	
 	def get_peername(self):
 		return self.transport.get_extra_info('peername')
 	
 	def close(self):
 		self.transport.close()
 		super().close()
+		# Wake up `wait_delivered`
+		self.resume_writing()
 
 class PollingSession(Session):
 	def __init__(self, state, logger, writer, hostname):
@@ -45,12 +90,97 @@ class PollingSession(Session):
 		self.writer = writer
 		self.hostname = hostname
 		self.peername = None
-		self.queue = [] # type: List[OutgoingEvent]
+		# Events are encoded as they're sent; `_PresenceFrames` can be superseded, see `_queue_presence`
+		self.queue = deque() # type: Deque[Union[bytes, _PresenceFrames]]
+		self.queue_bytes = 0
+		# Dict[contact uuid, _PresenceFrames]
+		self._presence_queued = {}
+		# Set when `queue_bytes` went over `settings.GATEWAY_QUEUE_MAX_BYTES`;
+		# nothing more is queued, and the session is closed.
+		self.overflowed = False
 		self.time_last_connect = 0
 		self.timeout = 30
+		# Set when the queue is handed to the client, see `wait_delivered`
+		self._polled = None
+		# Set when something is queued while a request is held open, see `wait_for_events`
+		self._queued = None
+		self._time_first_queued = None
 	
 	def send_event(self, outgoing_event):
-		self.queue.append(outgoing_event)
+		if self.overflowed: return
+		writer = self.writer
+		writer.write(outgoing_event)
+		data = writer.flush()
+		if not data: return
+		if not self.queue:
+			self._time_first_queued = time.time()
+		if isinstance(outgoing_event, event.PresenceNotificationEvent):
+			self._queue_presence(outgoing_event, data)
+		else:
+			self.queue.append(data)
+		self.queue_bytes += len(data)
+		if self.queue_bytes > settings.GATEWAY_QUEUE_MAX_BYTES:
+			# Client isn't keeping up; `Backend._clean_sessions` closes the session
+			self.overflowed = True
+			self.queue.clear()
+			self._presence_queued.clear()
+			self.queue_bytes = 0
+		if self._queued is not None:
+			self._queued.set()
+	
+	def _queue_presence(self, outgoing_event, data):
+		# A contact's presence notification replaces one still queued, unless it's
+		# for only some of the fields the queued one was.
+		uuid = outgoing_event.contact.head.uuid
+		changed = outgoing_event.changed
+		queued = self._presence_queued.get(uuid)
+		if queued is not None and (changed is None or (queued.changed is not None and queued.changed <= changed)):
+			self.queue_bytes -= len(queued.data)
+			queued.data = b''
+		frames = _PresenceFrames(data, changed)
+		self._presence_queued[uuid] = frames
+		self.queue.append(frames)
+	
+	async def wait_for_events(self, timeout):
+		# Holds a request with nothing to send open for at most `timeout` seconds,
+		# until something is queued or `wake` is called.
+		if self.queue: return
+		queued = asyncio.Event()
+		self._queued = queued
+		try:
+			await asyncio.wait_for(queued.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+		finally:
+			if self._queued is queued:
+				self._queued = None
+	
+	def wake(self):
+		if self._queued is not None:
+			self._queued.set()
+	
+	def delivery_status(self):
+		if self.closed or self.overflowed:
+			return False
+		if self._queued is not None:
+			# A request is being held open, it'll be answered right away
+			return True
+		# Queued events are picked up by the next poll; a client that
+		# polled recently is taken to be alive.
+		if time.time() - self.time_last_connect < settings.MSG_DELIVERY_TIMEOUT:
+			return True
+		return None
+	
+	async def wait_delivered(self, timeout):
+		if self.closed:
+			return False
+		if self._polled is None:
+			self._polled = asyncio.Event()
+		try:
+			await asyncio.wait_for(self._polled.wait(), timeout)
+		except asyncio.TimeoutError:
+			return False
+		return not self.closed
 	
 	def get_peername(self):
 		return self.peername
@@ -61,14 +191,28 @@ class PollingSession(Session):
 		self.logger.log_connect()
 	
 	def on_disconnect(self):
-		writer = self.writer
-		for outgoing_event in self.queue:
-			writer.write(outgoing_event)
-		self.queue = []
-		data = writer.flush()
+		queue = self.queue
+		data = b''
+		if queue:
+			if settings.PERF_METRICS:
+				metrics.observe(('gateway', 'delivery'), time.time() - self._time_first_queued)
+			data = b''.join(x if type(x) is bytes else x.data for x in queue)
+			queue.clear()
+			self._presence_queued.clear()
+			self.queue_bytes = 0
+		if self._polled is not None:
+			self._polled.set()
+			self._polled = None
 		self.logger.log_disconnect()
 		return data
 
+class _PresenceFrames:
+	__slots__ = ('data', 'changed')
+	
+	def __init__(self, data, changed):
+		self.data = data
+		self.changed = changed
+
 class SessionState:
 	def __init__(self):
 		self.front_specific = {}
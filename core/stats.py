@@ -41,11 +41,11 @@ class Stats:
 	def on_message_sent(self, user, client):
 		self._collect('messages_sent', user, client)
 	
-	def on_message_received(self, user, client):
-		self._collect('messages_received', user, client)
+	def on_messages_received(self, client, n):
+		# Counted per client only, so no user needed
+		self._collect('messages_received', None, client, n)
 	
-	def _collect(self, stat, user, client):
-		assert user is not None
+	def _collect(self, stat, user, client, n = 1):
 		assert client is not None
 		if self.by_client is None:
 			self.by_client = {}
@@ -55,13 +55,14 @@ class Stats:
 			bc[client_id] = {}
 		bhc = bc[client_id]
 		if stat == 'users_active':
+			assert user is not None
 			if stat not in bhc:
 				bhc[stat] = HyperLogLog(12)
 			bhc[stat].add(user.email)
 		else:
 			if stat not in bhc:
 				bhc[stat] = 0
-			bhc[stat] += 1
+			bhc[stat] += n
 	
 	def flush(self):
 		hour = _current_hour()
@@ -42,6 +42,12 @@ class UserService:
 			tmp = sess.query(DBUser.uuid).filter(DBUser.email == email).one_or_none()
 			return tmp and tmp[0]
 	
+	def get_uuids(self, emails):
+		# Returns Dict[email, uuid] for those of `emails` that exist, in one query
+		if not emails: return {}
+		with Session() as sess:
+			return dict(sess.query(DBUser.email, DBUser.uuid).filter(DBUser.email.in_(emails)).all())
+	
 	def get(self, uuid):
 		if uuid is None: return None
 		if uuid not in self._cache_by_uuid:
@@ -53,7 +59,10 @@ class UserService:
 			dbuser = sess.query(DBUser).filter(DBUser.uuid == uuid).one_or_none()
 			if dbuser is None: return None
 			status = UserStatus(dbuser.name, dbuser.message)
-			return User(dbuser.uuid, dbuser.email, dbuser.verified, status, dbuser.date_created)
+			return User(
+				dbuser.uuid, dbuser.email, dbuser.verified, status, dbuser.date_created,
+				list_version = dbuser.list_version,
+			)
 	
 	def get_detail(self, uuid):
 		with Session() as sess:
@@ -80,6 +89,7 @@ class UserService:
 				dbuser = sess.query(DBUser).filter(DBUser.uuid == user.uuid).one()
 				dbuser.name = user.status.name
 				dbuser.message = user.status.message
+				dbuser.list_version = user.list_version
 				dbuser.settings = detail.settings
 				dbuser.groups = [{
 					'id': g.id, 'name': g.name,
@@ -32,6 +32,7 @@ class User(Base):
 	settings = sa.Column(JSONType, nullable = False)
 	groups = sa.Column(JSONType, nullable = False)
 	contacts = sa.Column(JSONType, nullable = False)
+	list_version = sa.Column(sa.Integer, nullable = False, default = 0)
 
 class Sound(Base):
 	__tablename__ = 't_sound'
@@ -6,44 +6,63 @@ from util.misc import Logger
 from .msnp import MSNPReader, MSNPWriter
 
 def register(loop, backend, *, http_port = None, devmode = False):
+	import settings
 	from util.misc import AIOHTTPRunner, ProtocolRunner
 	from .http import create_app
 	from .msnp import MSNP_NS_SessState, MSNP_SB_SessState
 	
 	assert http_port, "Please specify `http_port`."
 	
+	trace_recorder = None
+	if settings.MSNP_TRACE_PATH:
+		from .trace import TraceRecorder
+		trace_recorder = TraceRecorder(settings.MSNP_TRACE_PATH)
+		loop.create_task(_flush_trace(trace_recorder))
+	
 	if devmode:
 		http_host = '0.0.0.0'
 	else:
 		http_host = '127.0.0.1'
 	
-	backend.add_runner(ProtocolRunner('0.0.0.0', 1863, ListenerMSNP, args = ['NS', backend, MSNP_NS_SessState]))
-	backend.add_runner(ProtocolRunner('0.0.0.0', 1864, ListenerMSNP, args = ['SB', backend, MSNP_SB_SessState]))
-	backend.add_runner(AIOHTTPRunner(http_host, http_port, create_app(backend)))
+	backend.add_runner(ProtocolRunner('0.0.0.0', 1863, ListenerMSNP, args = ['NS', backend, MSNP_NS_SessState, trace_recorder]))
+	backend.add_runner(ProtocolRunner('0.0.0.0', 1864, ListenerMSNP, args = ['SB', backend, MSNP_SB_SessState, trace_recorder]))
+	backend.add_runner(AIOHTTPRunner(http_host, http_port, create_app(backend, trace_recorder = trace_recorder)))
 	if devmode:
 		from dev import autossl
 		ssl_context = autossl.create_context()
-		backend.add_runner(AIOHTTPRunner(http_host, 443, create_app(backend), ssl = ssl_context))
+		backend.add_runner(AIOHTTPRunner(http_host, 443, create_app(backend, trace_recorder = trace_recorder), ssl = ssl_context))
+
+async def _flush_trace(trace_recorder):
+	while True:
+		await asyncio.sleep(5)
+		trace_recorder.flush()
 
 class ListenerMSNP(asyncio.Protocol):
-	def __init__(self, logger_prefix, backend, sess_state_factory):
+	def __init__(self, logger_prefix, backend, sess_state_factory, trace_recorder = None):
 		super().__init__()
 		self.logger_prefix = logger_prefix
 		self.backend = backend
 		self.sess_state_factory = sess_state_factory
+		self.trace_recorder = trace_recorder
 		self.transport = None
 		self.logger = None
+		self.tracer = None
 		self.sess = None
 	
 	def connection_made(self, transport):
 		self.transport = transport
 		self.logger = Logger(self.logger_prefix, transport)
-		sess_state = self.sess_state_factory(MSNPReader(self.logger), self.backend)
-		self.sess = PersistentSession(sess_state, MSNPWriter(self.logger, sess_state), transport)
+		if self.trace_recorder:
+			self.tracer = self.trace_recorder.open_session(self.logger_prefix)
+		sess_state = self.sess_state_factory(MSNPReader(self.logger, tracer = self.tracer), self.backend)
+		self.sess = PersistentSession(sess_state, MSNPWriter(self.logger, sess_state, tracer = self.tracer), transport)
 		self.logger.log_connect()
 	
 	def connection_lost(self, exc):
 		self.logger.log_disconnect()
+		if self.tracer:
+			self.tracer.close()
+			self.tracer = None
 		self.sess.close()
 		self.sess = None
 		self.logger = None
@@ -51,3 +70,9 @@ class ListenerMSNP(asyncio.Protocol):
 	
 	def data_received(self, data):
 		self.sess.state.data_received(data, self.sess)
+	
+	def pause_writing(self):
+		self.sess.pause_writing()
+	
+	def resume_writing(self):
+		self.sess.resume_writing()
@@ -1,30 +1,35 @@
+import asyncio
 from datetime import datetime, timedelta
 from urllib.parse import unquote
 import lxml
+import lxml.etree
 import secrets
 import base64
+import functools
+import gzip
+import hashlib
 import os
 import time
+from time import perf_counter
 from markupsafe import Markup
 from aiohttp import web
 
 import settings
 from core import models
+from core.models import ListChangeKind
 import util.misc
+from util.misc import LRUCache
+from util.perf import metrics
 
 LOGIN_PATH = '/login'
 TMPL_DIR = 'front/msn/tmpl'
 PP = 'Passport1.4 '
 
-def create_app(backend):
+def create_app(backend, *, trace_recorder = None):
 	app = web.Application()
 	app['backend'] = backend
-	app['jinja_env'] = util.misc.create_jinja_env(TMPL_DIR, {
-		'date_format': _date_format,
-		'cid_format': _cid_format,
-		'bool_to_str': _bool_to_str,
-		'contact_is_favorite': _contact_is_favorite,
-	})
+	app['trace_recorder'] = trace_recorder
+	app['jinja_env'] = _get_jinja_env()
 	
 	# MSN >= 5
 	app.router.add_get('/nexus-mock', handle_nexus)
@@ -61,12 +66,32 @@ def create_app(backend):
 	app.router.add_route('OPTIONS', '/gateway/gateway.dll', handle_http_gateway)
 	app.router.add_post('/gateway/gateway.dll', handle_http_gateway)
 	app.router.add_get('/etc/debug', handle_debug)
+	if settings.PERF_METRICS:
+		app.router.add_get('/etc/perf', handle_perf)
 	app.router.add_route('*', '/{path:.*}', handle_other)
 	
 	app.on_response_prepare.append(on_response_prepare)
 	
 	return app
 
+def _get_jinja_env():
+	# Templates are compiled once at startup and shared by every app (devmode creates two);
+	# changes to them are only picked up without a restart in DEBUG (or by `render_cached`).
+	global _jinja_env
+	if _jinja_env is None:
+		t0 = perf_counter()
+		_jinja_env = util.misc.create_jinja_env(TMPL_DIR, {
+			'date_format': _date_format,
+			'cid_format': _cid_format,
+			'bool_to_str': _bool_to_str,
+			'contact_is_favorite': _contact_is_favorite,
+		}, bytecode_cache_dir = settings.JINJA_BYTECODE_CACHE_DIR, auto_reload = settings.DEBUG)
+		util.misc.precompile_jinja_env(_jinja_env)
+		metrics.observe(('jinja', 'precompile'), perf_counter() - t0)
+	return _jinja_env
+
+_jinja_env = None
+
 async def on_response_prepare(req, res):
 	if not settings.DEBUG:
 		return
@@ -109,26 +134,44 @@ async def handle_http_gateway(req):
 		session_id = util.misc.gen_uuid()
 		
 		logger = Logger('GW-{}'.format(server_type), session_id)
-		reader = MSNPReader(logger)
+		tracer = None
+		if req.app['trace_recorder']:
+			tracer = req.app['trace_recorder'].open_session(('NS' if server_type == 'NS' else 'SB'), gateway = True)
+		reader = MSNPReader(logger, tracer = tracer)
 		if server_type == 'NS':
 			sess_state = MSNP_NS_SessState(reader, backend)
 		else:
 			sess_state = MSNP_SB_SessState(reader, backend)
 		
-		sess = PollingSession(sess_state, logger, MSNPWriter(logger, sess_state), server_ip)
+		sess = PollingSession(sess_state, logger, MSNPWriter(logger, sess_state, tracer = tracer), server_ip)
 		backend.util_set_sess_token(sess, ('msn-gw', session_id))
 	sess = backend.util_get_sess_by_token(('msn-gw', session_id))
 	if not sess or sess.closed:
 		return web.Response(status = 400, text = '')
+	if sess.overflowed:
+		sess.close()
+		return web.Response(status = 400, text = '')
 	
+	# Answer any request still held open, the client's moved on
+	sess.wake()
 	sess.on_connect(req.transport)
 	
 	# Read incoming messages
-	sess.state.data_received(await req.read(), sess)
+	data = await req.read()
+	sess.state.data_received(data, sess)
+	
+	if not data and query.get('Action') == 'poll' and settings.GATEWAY_LONG_POLL > 0:
+		# Nothing to do but poll: hold the request until there's something to send
+		await sess.wait_for_events(settings.GATEWAY_LONG_POLL)
 	
 	# Write outgoing messages
 	body = sess.on_disconnect()
 	
+	if settings.PERF_METRICS:
+		metrics.incr(('gateway', 'requests'))
+		if not body:
+			metrics.incr(('gateway', 'requests', 'empty'))
+	
 	return web.Response(headers = {
 		'Access-Control-Allow-Origin': '*',
 		'Access-Control-Allow-Methods': 'POST',
@@ -140,13 +183,31 @@ async def handle_http_gateway(req):
 async def handle_debug(req):
 	return render(req, 'debug.html')
 
+async def handle_perf(req):
+	from core.session import PollingSession
+	from .misc import throttled_users
+	data = metrics.to_json()
+	# Bytes queued per gateway session
+	queued = [
+		sess.queue_bytes for sess in req.app['backend'].util_iter_sessions()
+		if isinstance(sess, PollingSession)
+	]
+	data['gateway'] = {
+		'sessions': len(queued),
+		'queued_bytes': sum(queued),
+		'max_queued_bytes': max(queued, default = 0),
+	}
+	data['throttled_users'] = [
+		{ 'email': email, 'counts': counts }
+		for email, counts in reversed(throttled_users.items())
+	]
+	return web.json_response(data)
+
 async def handle_abservice(req):
-	header, action, ns_sess, token = await _preprocess_soap(req)
+	header, action, fields, ns_sess, token = await _preprocess_soap(req)
 	if ns_sess is None:
 		return web.Response(status = 403, text = '')
 	action_str = _get_tag_localname(action)
-	if _find_element(action, 'deltasOnly'):
-		return render(req, 'abservice/Fault.fullsync.xml', { 'faultactor': action_str })
 	now_str = datetime.utcnow().isoformat()[0:19] + 'Z'
 	user = ns_sess.user
 	detail = user.detail
@@ -156,6 +217,8 @@ async def handle_abservice(req):
 	backend = req.app['backend']
 	
 	try:
+		if action_str in _AB_FIND_TEMPLATES:
+			return _ab_find(req, backend, fields, action_str, user)
 		if action_str == 'FindMembership':
 			return render(req, 'sharing/FindMembershipResponse.xml', {
 				'cachekey': cachekey,
@@ -166,43 +229,23 @@ async def handle_abservice(req):
 				'now': now_str,
 			})
 		if action_str == 'AddMember':
-			lst = models.Lst.Parse(str(_find_element(action, 'MemberRole')))
-			email = _find_element(action, 'PassportName')
+			lst = models.Lst.Parse(fields.get('MemberRole'))
+			email = fields.get('PassportName')
 			contact_uuid = backend.util_get_uuid_from_email(email)
 			backend.me_contact_add(ns_sess, contact_uuid, lst, email)
 			return render(req, 'sharing/AddMemberResponse.xml')
 		if action_str == 'DeleteMember':
-			lst = models.Lst.Parse(str(_find_element(action, 'MemberRole')))
-			email = _find_element(action, 'PassportName')
+			lst = models.Lst.Parse(fields.get('MemberRole'))
+			email = fields.get('PassportName')
 			if email:
 				contact_uuid = backend.util_get_uuid_from_email(email)
 			else:
-				contact_uuid = str(_find_element(action, 'MembershipId')).split('/')[1]
+				contact_uuid = fields.get('MembershipId', '').split('/')[1]
 			backend.me_contact_remove(ns_sess, contact_uuid, lst)
 			return render(req, 'sharing/DeleteMemberResponse.xml')
 		
-		if action_str == 'ABFindAll':
-			return render(req, 'abservice/ABFindAllResponse.xml', {
-				'cachekey': cachekey,
-				'host': settings.LOGIN_HOST,
-				'user': user,
-				'detail': detail,
-				'Lst': models.Lst,
-				'list': list,
-				'now': now_str,
-			})
-		if action_str == 'ABFindContactsPaged':
-			return render(req, 'abservice/ABFindContactsPagedResponse.xml', {
-				'cachekey': cachekey,
-				'host': settings.LOGIN_HOST,
-				'user': user,
-				'detail': detail,
-				'Lst': models.Lst,
-				'list': list,
-				'now': now_str,
-			})
 		if action_str == 'ABContactAdd':
-			email = _find_element(action, 'passportName')
+			email = fields.get('passportName')
 			contact_uuid = backend.util_get_uuid_from_email(email)
 			backend.me_contact_add(ns_sess, contact_uuid, models.Lst.FL, email)
 			return render(req, 'abservice/ABContactAddResponse.xml', {
@@ -210,23 +253,23 @@ async def handle_abservice(req):
 				'host': settings.LOGIN_HOST,
 			})
 		if action_str == 'ABContactDelete':
-			contact_uuid = _find_element(action, 'contactId')
+			contact_uuid = fields.get('contactId')
 			backend.me_contact_remove(ns_sess, contact_uuid, models.Lst.FL)
 			return render(req, 'abservice/ABContactDeleteResponse.xml', {
 				'cachekey': cachekey,
 				'host': settings.LOGIN_HOST,
 			})
 		if action_str == 'ABContactUpdate':
-			contact_uuid = _find_element(action, 'contactId')
-			is_messenger_user = _find_element(action, 'isMessengerUser')
+			contact_uuid = fields.get('contactId')
+			is_messenger_user = _parse_bool(fields.get('isMessengerUser'))
 			backend.me_contact_edit(ns_sess, contact_uuid, is_messenger_user = is_messenger_user)
 			return render(req, 'abservice/ABContactUpdateResponse.xml', {
 				'cachekey': cachekey,
 				'host': settings.LOGIN_HOST,
 			})
 		if action_str == 'ABGroupAdd':
-			name = _find_element(action, 'name')
-			is_favorite = _find_element(action, 'IsFavorite')
+			name = fields.get('name')
+			is_favorite = _parse_bool(fields.get('IsFavorite'))
 			group = backend.me_group_add(ns_sess, name, is_favorite = is_favorite)
 			return render(req, 'abservice/ABGroupAddResponse.xml', {
 				'cachekey': cachekey,
@@ -234,24 +277,24 @@ async def handle_abservice(req):
 				'group_id': group.id,
 			})
 		if action_str == 'ABGroupUpdate':
-			group_id = str(_find_element(action, 'groupId'))
-			name = _find_element(action, 'name')
-			is_favorite = _find_element(action, 'IsFavorite')
+			group_id = fields.get('groupId')
+			name = fields.get('name')
+			is_favorite = _parse_bool(fields.get('IsFavorite'))
 			backend.me_group_edit(ns_sess, group_id, name, is_favorite = is_favorite)
 			return render(req, 'abservice/ABGroupUpdateResponse.xml', {
 				'cachekey': cachekey,
 				'host': settings.LOGIN_HOST,
 			})
 		if action_str == 'ABGroupDelete':
-			group_id = str(_find_element(action, 'guid'))
+			group_id = fields.get('guid')
 			backend.me_group_remove(ns_sess, group_id)
 			return render(req, 'abservice/ABGroupDeleteResponse.xml', {
 				'cachekey': cachekey,
 				'host': settings.LOGIN_HOST,
 			})
 		if action_str == 'ABGroupContactAdd':
-			group_id = str(_find_element(action, 'guid'))
-			contact_uuid = _find_element(action, 'contactId')
+			group_id = fields.get('guid')
+			contact_uuid = fields.get('contactId')
 			backend.me_group_contact_add(ns_sess, group_id, contact_uuid)
 			return render(req, 'abservice/ABGroupContactAddResponse.xml', {
 				'cachekey': cachekey,
@@ -259,8 +302,8 @@ async def handle_abservice(req):
 				'contact_uuid': contact_uuid,
 			})
 		if action_str == 'ABGroupContactDelete':
-			group_id = str(_find_element(action, 'guid'))
-			contact_uuid = _find_element(action, 'contactId')
+			group_id = fields.get('guid')
+			contact_uuid = fields.get('contactId')
 			backend.me_group_contact_remove(ns_sess, group_id, contact_uuid)
 			return render(req, 'abservice/ABGroupContactDeleteResponse.xml', {
 				'cachekey': cachekey,
@@ -277,8 +320,142 @@ async def handle_abservice(req):
 	
 	return _unknown_soap(req, header, action)
 
+_AB_FIND_TEMPLATES = {
+	'ABFindAll': 'abservice/ABFindAllResponse.xml',
+	'ABFindContactsPaged': 'abservice/ABFindContactsPagedResponse.xml',
+}
+# Dict[(User.uuid, action), ((User.detail_version, User.list_version), bytes, names)]
+_ab_find_cache = LRUCache(1000)
+# Dict[User.uuid, Dict[contact uuid, name]], the names in the last AB sent to each user.
+# Contacts' names change with their presence rather than the list, so deltas compare against these.
+_ab_sent_names = LRUCache(1000)
+
+def _ab_find(req, backend, fields, action_str, user):
+	# Full address books are only rendered again after the contact list changes;
+	# deltas come from the list change log, see `_encode_ab_last_change`.
+	detail = user.detail
+	changes = None
+	if _parse_bool(fields.get('deltasOnly') or fields.get('DeltasOnly')):
+		since = _decode_ab_last_change(fields.get('lastChange') or fields.get('LastChanged'))
+		if since is not None:
+			changes = backend.util_get_list_changes(user, since)
+		if changes is None:
+			return render_cached(req, 'abservice/Fault.fullsync.xml', { 'faultactor': action_str }, action_str)
+	
+	if changes is None:
+		key = (user.uuid, action_str)
+		cached = _ab_find_cache.get(key)
+		version = (user.detail_version, user.list_version)
+		if cached is not None and cached[0] == version:
+			if settings.PERF_METRICS:
+				metrics.incr(('abservice', action_str, 'cached'))
+			_ab_sent_names.put(user.uuid, cached[2])
+			return _ab_find_response(action_str, cached[1])
+		contacts = [ctc for ctc in detail.contacts.values() if ctc.lists & models.Lst.FL]
+		groups = list(detail.groups.values())
+		deleted_contact_ids = deleted_group_ids = ()
+		names = _get_ab_contact_names(contacts)
+	else:
+		fl_contacts = [ctc for ctc in detail.contacts.values() if ctc.lists & models.Lst.FL]
+		(contacts, deleted_contact_ids, groups, deleted_group_ids) = _get_ab_changes(
+			detail, changes, fl_contacts, _ab_sent_names.get(user.uuid),
+		)
+		names = _get_ab_contact_names(fl_contacts)
+	_ab_sent_names.put(user.uuid, names)
+	
+	t0 = perf_counter()
+	data = req.app['jinja_env'].get_template(_AB_FIND_TEMPLATES[action_str]).render(
+		cachekey = secrets.token_urlsafe(172),
+		host = settings.LOGIN_HOST,
+		user = user,
+		detail = detail,
+		groups = groups,
+		contacts = contacts,
+		deleted_group_ids = deleted_group_ids,
+		deleted_contact_ids = deleted_contact_ids,
+		last_change = _encode_ab_last_change(user.list_version),
+		create_date = _date_format(user.date_created) or _encode_ab_last_change(0),
+	).encode('utf-8')
+	if settings.PERF_METRICS:
+		metrics.observe(('abservice', action_str, 'render'), perf_counter() - t0)
+		metrics.incr(('abservice', action_str, ('full' if changes is None else 'delta')))
+	
+	if changes is None:
+		_ab_find_cache.put(key, (version, data, names))
+	return _ab_find_response(action_str, data)
+
+def _ab_find_response(action_str, data):
+	if settings.PERF_METRICS:
+		metrics.incr(('abservice', action_str, 'bytes'), len(data))
+	return web.Response(content_type = 'text/xml', charset = 'utf-8', body = data)
+
+def _get_ab_contact_names(contacts):
+	return { ctc.head.uuid: ctc.status.name for ctc in contacts }
+
+def _get_ab_changes(detail, changes, fl_contacts, sent_names):
+	# Returns the contacts and groups `changes` touched: (contacts, deleted contact ids, groups, deleted group ids).
+	# The AB only has contacts on FL; ones only on other lists are left out.
+	# Contacts on FL whose name isn't the one in `sent_names` (all of them, if it's `None`) are included too.
+	fl_contact_ids = set()
+	edited_contact_ids = set()
+	group_ids = set()
+	for change in changes:
+		kind = change.kind
+		if kind is ListChangeKind.ContactAdd or kind is ListChangeKind.ContactRemove:
+			if change.lst is models.Lst.FL:
+				fl_contact_ids.add(change.contact.uuid)
+		elif kind is ListChangeKind.ContactEdit:
+			edited_contact_ids.add(change.contact.uuid)
+		elif kind is ListChangeKind.GroupAdd or kind is ListChangeKind.GroupRemove or kind is ListChangeKind.GroupEdit:
+			group_ids.add(change.group_id)
+			if change.key == 'IsFavorite':
+				for ctc in detail.contacts.values():
+					if change.group_id in ctc.groups:
+						edited_contact_ids.add(ctc.head.uuid)
+	
+	for ctc in fl_contacts:
+		if sent_names is None or sent_names.get(ctc.head.uuid) != ctc.status.name:
+			edited_contact_ids.add(ctc.head.uuid)
+	
+	contacts = []
+	deleted_contact_ids = []
+	for uuid in fl_contact_ids | edited_contact_ids:
+		ctc = detail.contacts.get(uuid)
+		if ctc is not None and ctc.lists & models.Lst.FL:
+			contacts.append(ctc)
+		elif uuid in fl_contact_ids:
+			# Was on FL, isn't anymore
+			deleted_contact_ids.append(uuid)
+	groups = []
+	deleted_group_ids = []
+	for group_id in group_ids:
+		group = detail.groups.get(group_id)
+		if group is not None:
+			groups.append(group)
+		else:
+			deleted_group_ids.append(group_id)
+	return (contacts, deleted_contact_ids, groups, deleted_group_ids)
+
+# AB `lastChange`s are `User.list_version` as seconds after `_AB_EPOCH`, so the
+# `lastChange` a client sends with a delta request says which changes it's missing.
+_AB_EPOCH = datetime(2005, 1, 1)
+
+def _encode_ab_last_change(version):
+	return _date_format(_AB_EPOCH + timedelta(seconds = version))
+
+def _decode_ab_last_change(s):
+	if not s: return None
+	try:
+		d = datetime.strptime(str(s)[0:19], '%Y-%m-%dT%H:%M:%S')
+	except ValueError:
+		return None
+	if d < _AB_EPOCH: return None
+	return int((d - _AB_EPOCH).total_seconds())
+
 async def handle_storageservice(req):
-	header, action, ns_sess, token = await _preprocess_soap(req)
+	header, action, fields, ns_sess, token = await _preprocess_soap(req, max_size = settings.SOAP_MAX_STORAGE_BODY_SIZE)
+	if ns_sess is None:
+		return web.Response(status = 403, text = '')
 	action_str = _get_tag_localname(action)
 	now_str = datetime.utcnow().isoformat()[0:19] + 'Z'
 	timestamp = time.time()
@@ -320,7 +497,7 @@ async def handle_storageservice(req):
 			'pptoken1': token,
 		})
 	if action_str == 'CreateDocument':
-		return await handle_create_document(req, action, user, cid, token, timestamp)
+		return await handle_create_document(req, fields, user, cid, token, timestamp)
 	if action_str == 'CreateRelationships':
 		# TODO: CreateRelationships
 		return render(req, 'storageservice/CreateRelationshipsResponse.xml', {
@@ -337,29 +514,82 @@ def _unknown_soap(req, header, action, *, expected = False):
 	action_str = _get_tag_localname(action)
 	if not expected and settings.DEBUG:
 		print("Unknown SOAP:", action_str)
-		print(_xml_to_string(header))
+		if header is not None:
+			print(_xml_to_string(header))
 		print(_xml_to_string(action))
-	return render(req, 'Fault.unsupported.xml', { 'faultactor': action_str })
+	return render_cached(req, 'Fault.unsupported.xml', { 'faultactor': action_str }, action_str)
 
 def _xml_to_string(xml):
 	return lxml.etree.tostring(xml, pretty_print = True).decode('utf-8')
 
-async def _preprocess_soap(req):
-	from lxml.objectify import fromstring as parse_xml
+async def _preprocess_soap(req, *, max_size = None):
+	# Returns (header, action, fields, session, token), see `parse_soap`
+	if max_size is None:
+		max_size = settings.SOAP_MAX_BODY_SIZE
+	body = await _read_limited(req, max_size)
+	try:
+		(header, action, fields, token) = parse_soap(body)
+	except (lxml.etree.XMLSyntaxError, ValueError):
+		raise web.HTTPBadRequest()
+	backend_sess = (req.app['backend'].util_get_sess_by_token(token) if token else None)
+	return header, action, fields, backend_sess, token
+
+def parse_soap(body):
+	# Parses a SOAP request in one pass over the Header (for the ticket) and the action.
+	# Returns (header, action, fields, token); `fields` maps the local names of
+	# the action's leaf elements to their text, the first one found winning.
+	root = lxml.etree.fromstring(body, _SOAP_PARSER)
 	
-	body = await req.read()
-	root = parse_xml(body)
+	header = None
+	action = None
+	for elm in root:
+		if not isinstance(elm.tag, str): continue
+		name = elm.tag.rpartition('}')[2]
+		if name == 'Header':
+			header = elm
+		elif name == 'Body' and len(elm):
+			action = elm[0]
+	if action is None:
+		raise ValueError("No SOAP action")
 	
-	token = _find_element(root, 'TicketToken')
-	if token[0:2] == 't=':
+	token = None
+	if header is not None:
+		for elm in header.iter('{*}TicketToken'):
+			token = elm.text
+			break
+	if token and token[0:2] == 't=':
 		token = token[2:22]
 	
-	backend_sess = req.app['backend'].util_get_sess_by_token(token)
-	
-	header = _find_element(root, 'Header')
-	action = _find_element(root, 'Body/*[1]')
+	fields = {}
+	for elm in action.iter():
+		if len(elm) or not isinstance(elm.tag, str): continue
+		name = elm.tag.rpartition('}')[2]
+		if name not in fields:
+			fields[name] = elm.text or ''
 	
-	return header, action, backend_sess, token
+	return header, action, fields, token
+
+_SOAP_PARSER = lxml.etree.XMLParser(resolve_entities = False, no_network = True)
+
+async def _read_limited(req, max_size):
+	if req.content_length is not None and req.content_length > max_size:
+		raise web.HTTPRequestEntityTooLarge(max_size = max_size, actual_size = req.content_length)
+	# Chunked bodies have no length up front; stop reading as soon as they go over
+	body = bytearray()
+	while True:
+		chunk = await req.content.readany()
+		if not chunk: break
+		body += chunk
+		if len(body) > max_size:
+			raise web.HTTPRequestEntityTooLarge(max_size = max_size, actual_size = len(body))
+	return bytes(body)
+
+def _parse_bool(s):
+	if s is None: return None
+	s = s.strip().lower()
+	if s == 'true': return True
+	if s == 'false': return False
+	return None
 
 def _get_tag_localname(elm):
 	return lxml.etree.QName(elm.tag).localname
@@ -373,8 +603,10 @@ def _find_element(xml, query):
 	return thing
 
 async def handle_msgrconfig(req):
-	msgr_config = _get_msgr_config()
-	return web.Response(status = 200, content_type = 'text/xml', text = msgr_config)
+	cached = _get_cached_body('MsgrConfig', _MSGR_CONFIG_PATHS, _get_msgr_config)
+	return _cached_response(req, cached)
+
+_MSGR_CONFIG_PATHS = (TMPL_DIR + '/MsgrConfigEnvelope.xml', TMPL_DIR + '/MsgrConfig.xml')
 
 def _get_msgr_config():
 	with open(TMPL_DIR + '/MsgrConfigEnvelope.xml') as fh:
@@ -383,10 +615,90 @@ def _get_msgr_config():
 		config = fh.read()
 	return envelope.format(MsgrConfig = config)
 
+def render_cached(req, tmpl_name, ctxt, key):
+	# Like `render`, for templates whose output only depends on `key` (which includes `ctxt`'s values)
+	jinja_env = req.app['jinja_env']
+	cached = _get_cached_body(
+		(tmpl_name, key), (os.path.join(TMPL_DIR, tmpl_name),),
+		# Straight from the loader: outside DEBUG, `get_template` keeps returning the template
+		# as it was at startup, and this only runs when the file has changed.
+		lambda: jinja_env.loader.load(jinja_env, tmpl_name, jinja_env.globals).render(**ctxt),
+	)
+	return _cached_response(req, cached)
+
+def _get_cached_body(key, paths, build):
+	# Returns the `_CachedBody` for `key`, from `build()` (a str), until one of the files in `paths`
+	# is modified; that's checked at most every `settings.STATIC_RESPONSE_POLL` seconds.
+	cached = _cached_bodies.get(key)
+	now = time.monotonic()
+	if cached is not None:
+		if now - cached.time_checked < settings.STATIC_RESPONSE_POLL:
+			return cached
+		cached.time_checked = now
+		mtimes = _get_mtimes(paths)
+		if mtimes == cached.mtimes:
+			return cached
+	else:
+		mtimes = _get_mtimes(paths)
+	cached = _CachedBody(build().encode('utf-8'), mtimes, now)
+	_cached_bodies.put(key, cached)
+	if settings.PERF_METRICS:
+		metrics.incr(('http', 'cached_body', 'build'))
+	return cached
+
+def _get_mtimes(paths):
+	return tuple(os.stat(path).st_mtime_ns for path in paths)
+
+class _CachedBody:
+	__slots__ = ('body', 'gzipped', 'etag', 'mtimes', 'time_checked')
+	
+	def __init__(self, body, mtimes, time_checked):
+		self.body = body
+		self.gzipped = None
+		if len(body) >= _GZIP_MIN_SIZE:
+			self.gzipped = gzip.compress(body, 9)
+		self.etag = _make_etag(body)
+		self.mtimes = mtimes
+		self.time_checked = time_checked
+
+def _cached_response(req, cached, *, content_type = 'text/xml'):
+	headers = { 'ETag': cached.etag }
+	if cached.gzipped is not None:
+		headers['Vary'] = 'Accept-Encoding'
+	if req.method == 'GET' and cached.etag in req.headers.get('If-None-Match', ''):
+		return web.Response(status = 304, headers = headers)
+	body = cached.body
+	if cached.gzipped is not None and _accepts_gzip(req):
+		body = cached.gzipped
+		headers['Content-Encoding'] = 'gzip'
+	return web.Response(status = 200, content_type = content_type, charset = 'utf-8', body = body, headers = headers)
+
+def _make_etag(body):
+	return '"{}"'.format(hashlib.blake2b(body, digest_size = 8).hexdigest())
+
+def _accepts_gzip(req):
+	for coding in req.headers.get('Accept-Encoding', '').replace(' ', '').lower().split(','):
+		(coding, _, q) = coding.partition(';q=')
+		if coding != 'gzip': continue
+		try:
+			return float(q or 1) > 0
+		except ValueError:
+			return False
+	return False
+
+# Smaller bodies aren't worth compressing
+_GZIP_MIN_SIZE = 1024
+# Dict[key, _CachedBody]; fault keys come from requests, so this is bounded
+_cached_bodies = LRUCache(200)
+
 async def handle_nexus(req):
-	return web.Response(status = 200, headers = {
-		'PassportURLs': 'DALogin=https://{}{}'.format(settings.LOGIN_HOST, LOGIN_PATH),
-	})
+	return web.Response(status = 200, headers = _get_nexus_headers(settings.LOGIN_HOST))
+
+@functools.lru_cache()
+def _get_nexus_headers(login_host):
+	return {
+		'PassportURLs': 'DALogin=https://{}{}'.format(login_host, LOGIN_PATH),
+	}
 
 async def handle_login(req):
 	email, pwd = _extract_pp_credentials(req.headers.get('Authorization'))
@@ -488,51 +800,156 @@ async def handle_rst(req):
 def _get_storage_path(uuid):
 	return 'storage/dp/{}/{}'.format(uuid[0:1], uuid[0:2])
 
-async def handle_create_document(req, action, user, cid, token, timestamp):
-	from PIL import Image
+async def handle_create_document(req, fields, user, cid, token, timestamp):
+	streamtype = fields.get('DocumentStreamType')
 	
-	# get image data
-	name = _find_element(action, 'Name')
-	streamtype = _find_element(action, 'DocumentStreamType')
-
 	if (streamtype == 'UserTileStatic'):
-		mime = _find_element(action, 'MimeType')
-		data = _find_element(action, 'Data')
-		data = base64.b64decode(data)
+		loop = asyncio.get_running_loop()
+		try:
+			(data, digest) = await loop.run_in_executor(None, _decode_usertile, fields.get('Data') or '')
+		except ValueError:
+			raise web.HTTPBadRequest()
+		if not data:
+			raise web.HTTPBadRequest()
+		if len(data) > settings.USERTILE_MAX_BYTES:
+			raise web.HTTPRequestEntityTooLarge(max_size = settings.USERTILE_MAX_BYTES, actual_size = len(data))
+		
+		ext = await _store_usertile_content(digest, data)
+		if ext is None:
+			raise web.HTTPBadRequest()
+		await loop.run_in_executor(None, _link_usertiles, user.uuid, _get_usertile_content_path(digest), ext)
+		_forget_usertiles(user.uuid)
+	
+	return render(req, 'storageservice/CreateDocumentResponse.xml', {
+		'user': user,
+		'cid': cid,
+		'pptoken1': token,
+		'timestamp': timestamp,
+	})
 
-		# store display picture as file
-		path = _get_storage_path(user.uuid)
+def _decode_usertile(data):
+	data = base64.b64decode(data)
+	return data, hashlib.sha256(data).hexdigest()
 
-		if not os.path.exists(path):
-			os.makedirs(path)
+async def _store_usertile_content(digest, data):
+	# Display pictures are stored once per content, see `_make_usertile`; identical ones
+	# uploaded at the same time share the work. Returns the extension, or `None` if it isn't a valid image.
+	ext = _usertile_content_exts.get(digest)
+	if ext is not None:
+		if settings.PERF_METRICS:
+			metrics.incr(('storage', 'usertile', 'duplicate'))
+		return ext
+	job = _usertile_jobs.get(digest)
+	if job is None:
+		if len(_usertile_jobs) >= settings.USERTILE_MAX_PENDING:
+			raise web.HTTPServiceUnavailable()
+		job = asyncio.ensure_future(_run_usertile_job(digest, data))
+		_usertile_jobs[digest] = job
+	return await asyncio.shield(job)
 
-		image_path = '{path}/{uuid}.{mime}'.format(
-			path = path,
-			uuid = user.uuid,
-			mime = mime
-		)
+async def _run_usertile_job(digest, data):
+	loop = asyncio.get_running_loop()
+	path = _get_usertile_content_path(digest)
+	t0 = perf_counter()
+	try:
+		ext = await loop.run_in_executor(None, _find_usertile_content, path)
+		if ext is None:
+			ext = await loop.run_in_executor(_get_usertile_pool(), _make_usertile, path, data, settings.USERTILE_MAX_PIXELS)
+			if settings.PERF_METRICS:
+				metrics.observe(('storage', 'usertile', 'process'), perf_counter() - t0, error = (ext is None))
+		elif settings.PERF_METRICS:
+			metrics.incr(('storage', 'usertile', 'duplicate'))
+	finally:
+		del _usertile_jobs[digest]
+	if ext is not None:
+		_usertile_content_exts.put(digest, ext)
+	return ext
 
-		fp = open(image_path, 'wb')
-		fp.write(data)
-		fp.close()
+def _get_usertile_pool():
+	global _usertile_pool
+	if _usertile_pool is None:
+		from concurrent.futures import ProcessPoolExecutor
+		_usertile_pool = ProcessPoolExecutor(max_workers = settings.USERTILE_WORKERS)
+	return _usertile_pool
 
-		image = Image.open(image_path)
-		thumb = image.resize((21, 21))
+def _make_usertile(path, data, max_pixels):
+	# Runs in `_usertile_pool`. Checks the image, and stores it as `{path}.{ext}` along with
+	# every smaller size (`{path}_{size}.{ext}`) from the one decode. Returns `ext`, or `None` if it's invalid.
+	import io
+	from PIL import Image
+	
+	try:
+		image = Image.open(io.BytesIO(data))
+		fmt = image.format
+		if fmt not in _USERTILE_FORMATS:
+			return None
+		if image.width * image.height > max_pixels:
+			return None
+		image.load()
+		resized = { size: image.resize(dims) for size, dims in _USERTILE_SIZES.items() }
+	except (OSError, ValueError, Image.DecompressionBombError):
+		return None
+	ext = fmt.lower()
+	
+	os.makedirs(os.path.dirname(path), exist_ok = True)
+	for size, thumb in resized.items():
+		out = io.BytesIO()
+		thumb.save(out, format = fmt)
+		_write_file_atomic('{}_{}.{}'.format(path, size, ext), out.getvalue())
+	# Written last: its presence means the rest is there, see `_find_usertile_content`
+	_write_file_atomic('{}.{}'.format(path, ext), data)
+	return ext
 
-		thumb_path = '{path}/{uuid}_thumb.{mime}'.format(
-			path=path,
-			uuid=user.uuid,
-			mime=mime
-		)
+def _find_usertile_content(path):
+	(dir, _, prefix) = path.rpartition('/')
+	prefix += '.'
+	try:
+		names = os.listdir(dir)
+	except FileNotFoundError:
+		return None
+	for name in names:
+		if name.startswith(prefix) and not name.endswith('.tmp'):
+			return name[len(prefix):]
+	return None
 
-		thumb.save(thumb_path)
+def _link_usertiles(uuid, content_path, ext):
+	# The user's tiles (see `_find_usertile`) are hard links to the stored content
+	path = _get_storage_path(uuid)
+	os.makedirs(path, exist_ok = True)
+	names = { '{}.{}'.format(uuid, ext): '{}.{}'.format(content_path, ext) }
+	for size in _USERTILE_SIZES:
+		names['{}_{}.{}'.format(uuid, size, ext)] = '{}_{}.{}'.format(content_path, size, ext)
+	for name, src in names.items():
+		tmp_path = os.path.join(path, name + '.tmp')
+		try:
+			os.link(src, tmp_path)
+		except FileExistsError:
+			os.remove(tmp_path)
+			os.link(src, tmp_path)
+		os.replace(tmp_path, os.path.join(path, name))
+	# Tiles of another image type
+	prefixes = (uuid + '.', *('{}_{}.'.format(uuid, size) for size in _USERTILE_SIZES))
+	for name in os.listdir(path):
+		if name.startswith(prefixes) and name not in names:
+			os.remove(os.path.join(path, name))
 
-	return render(req, 'storageservice/CreateDocumentResponse.xml', {
-		'user': user,
-		'cid': cid,
-		'pptoken1': token,
-		'timestamp': timestamp,
-	})
+def _write_file_atomic(path, data):
+	tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+	with open(tmp_path, 'wb') as fh:
+		fh.write(data)
+	os.replace(tmp_path, path)
+
+def _get_usertile_content_path(digest):
+	return 'storage/dp/sha256/{}/{}'.format(digest[0:2], digest)
+
+# Sizes the clients ask for besides the original, see `handle_usertile`
+_USERTILE_SIZES = { 'thumb': (21, 21) }
+_USERTILE_FORMATS = { 'PNG', 'JPEG', 'GIF', 'BMP' }
+# Dict[sha256, ext]
+_usertile_content_exts = LRUCache(10000)
+# Dict[sha256, Future]
+_usertile_jobs = {}
+_usertile_pool = None
 
 def _extract_pp_credentials(auth_str):
 	if auth_str is None:
@@ -587,19 +1004,77 @@ def _contact_is_favorite(user_detail, ctc):
 		if groups[group_id].is_favorite: return True
 	return False
 
-async def handle_usertile(req, small=False):
+async def handle_usertile(req, small = False):
 	uuid = req.match_info['uuid']
-	storage_path = _get_storage_path(uuid)
+	tile = _get_usertile(uuid, small)
+	if tile is None:
+		raise web.HTTPNotFound
+	
+	if tile.size > settings.USERTILE_CACHE_MAX_BYTES:
+		# Sent straight from the file; aiohttp answers conditional requests with its own ETag
+		return web.FileResponse(tile.path, headers = { 'Content-Type': tile.content_type })
+	
+	cached = _usertile_data.get(tile.path)
+	if cached is None:
+		try:
+			data = await asyncio.get_running_loop().run_in_executor(None, _read_file, tile.path)
+		except FileNotFoundError:
+			_usertile_index.pop((uuid, small))
+			raise web.HTTPNotFound
+		cached = (data, _make_etag(data))
+		_usertile_data.put(tile.path, cached)
+	(data, etag) = cached
+	
+	headers = { 'ETag': etag }
+	if etag in req.headers.get('If-None-Match', ''):
+		return web.Response(status = 304, headers = headers)
+	return web.Response(status = 200, content_type = tile.content_type, body = data, headers = headers)
 
+def _get_usertile(uuid, small):
+	# Storage is only looked at the first time a tile is asked for; `_forget_usertiles` is called when it changes
+	key = (uuid, small)
+	tile = _usertile_index.get(key)
+	if tile is None:
+		tile = _find_usertile(uuid, small) or _NO_USERTILE
+		_usertile_index.put(key, tile)
+	if tile is _NO_USERTILE:
+		return None
+	return tile
+
+def _find_usertile(uuid, small):
+	storage_path = _get_storage_path(uuid)
+	# Other users' tiles are stored in the same directory
+	prefix = uuid + ('_thumb.' if small else '.')
 	try:
-		ext = os.listdir(storage_path)[0].split('.')[-1]
+		names = os.listdir(storage_path)
+	except FileNotFoundError:
+		return None
+	for name in names:
+		if not name.startswith(prefix) or name.endswith('.tmp'): continue
+		path = os.path.join(storage_path, name)
+		return _Usertile(path, 'image/{}'.format(name[len(prefix):]), os.path.getsize(path))
+	return None
 
-		if small:
-			image_path = os.path.join(storage_path, "{uuid}_thumb.{ext}".format(**locals()))
-		else:
-			image_path = os.path.join(storage_path, "{uuid}.{ext}".format(**locals()))
+def _forget_usertiles(uuid):
+	for small in (False, True):
+		tile = _usertile_index.pop((uuid, small))
+		if tile is not None and tile is not _NO_USERTILE:
+			_usertile_data.pop(tile.path)
 
-		with open(image_path, 'rb') as file:
-			return web.Response(status=200, content_type="image/{ext}".format(**locals()), body=file.read())
-	except FileNotFoundError:
-		raise web.HTTPNotFound
+def _read_file(path):
+	with open(path, 'rb') as fh:
+		return fh.read()
+
+class _Usertile:
+	__slots__ = ('path', 'content_type', 'size')
+	
+	def __init__(self, path, content_type, size):
+		self.path = path
+		self.content_type = content_type
+		self.size = size
+
+_NO_USERTILE = object()
+# Dict[(uuid, small), Union[_Usertile, _NO_USERTILE]]
+_usertile_index = LRUCache(10000)
+# Dict[path, (data, ETag)]
+_usertile_data = LRUCache(settings.USERTILE_CACHE_SIZE)
@@ -11,11 +11,17 @@
 	POST /esnd/snd/put[?uf=1] -> put
 """
 
-from aiohttp.web import Response
+import asyncio
+import os
+import re
+import shutil
+import tempfile
+from aiohttp.web import Response, FileResponse
 from os import path, makedirs
 from collections import namedtuple
 from random import randrange
 
+import settings
 from db import Sound, Session
 
 PATH_BUILTINS = path.join('storage', 'sound', 'builtins')
@@ -33,14 +39,11 @@ def builtin(request):
 		:return file content or 0 if file is not found
 		:rtype: aiohttp.web.Response
 	"""
-	file_name = request.rel_url.query['code'] + '.mp3'
-	file_path = path.join(PATH_BUILTINS, file_name)
-	
-	try:
-		with open(file_path, 'rb') as file:
-			return Response(status = 200, content_type = 'audio/mpeg', body = file.read())
-	except FileNotFoundError:
+	code = request.rel_url.query['code']
+	if not _is_valid_name(code):
 		return Response(status = 200, body = '0')
+	
+	return _file_response(path.join(PATH_BUILTINS, code + '.mp3'))
 
 def check(request):
 	"""
@@ -54,7 +57,7 @@ def check(request):
 	"""
 	file_hash = request.rel_url.query['hash']
 	
-	result = int(path.exists(_get_file_path(file_hash)))
+	result = int(file_hash in _get_index().hashes)
 	
 	return Response(status = 200, body = str(result))
 
@@ -70,34 +73,19 @@ async def put(request):
 		:rtype: aiohttp.web.Response
 	"""
 	data = await request.post()
+	overwrite = (request.rel_url.query.get('uf') == '1')
 	
 	with data['file'].file as f:
-		f.seek(-128, 2) # metadata offset
-		metadata = _parse_metadata(f.read())
-		
-		file_path = _get_file_path(metadata.hash)
-		
-		try:
-			output = open(file_path, 'xb')
-		except FileNotFoundError:
-			makedirs(path.dirname(file_path))
-			output = open(file_path, 'xb')
-		except FileExistsError:
-			if request.rel_url.query.get('uf') == 1:
-				output = open(file_path, 'wb')
-			else:
-				return Response(status = 200, body = '0')
-		
-		f.seek(0)
-		
-		with output as o:
-			o.write(f.read())
+		metadata = await asyncio.get_running_loop().run_in_executor(None, _store_file, f, overwrite)
 	
-	assert path.exists(file_path)
+	if metadata is None:
+		return Response(status = 200, body = '0')
 	
 	with Session() as session:
 		session.merge(Sound(**metadata._asdict()))
 	
+	_get_index().add(metadata)
+	
 	return Response(status = 200, body = '1')
 
 def get(request):
@@ -111,12 +99,10 @@ def get(request):
 		:rtype: aiohttp.web.Response
 	"""
 	file_hash = request.rel_url.query['hash']
-	
-	try:
-		with open(_get_file_path(file_hash), 'rb') as f:
-			return Response(status = 200, content_type = 'audio/mpeg', body = f.read())
-	except FileNotFoundError:
+	if not _is_valid_name(file_hash):
 		return Response(status = 200, body = '0')
+	
+	return _file_response(_get_file_path(file_hash))
 
 def random(request):
 	"""
@@ -128,31 +114,171 @@ def random(request):
 		:return: file content or 0 if file is not found
 		:rtype: aiohttp.web.Response
 	"""
-	category = request.rel_url.query.get('catId')
-	language = request.rel_url.query.get('lngId')
+	try:
+		category = _parse_id(request.rel_url.query.get('catId'))
+		language = _parse_id(request.rel_url.query.get('lngId'))
+	except ValueError:
+		return Response(status = 200, body = '0')
 	
-	with Session() as session:
-		query = session.query(Sound).filter(Sound.is_public == True)
-		
-		if category:
-			query = query.filter(Sound.category == category)
-		
-		if language:
-			query = query.filter(Sound.language == language)
-		
-		try:
-			offset = randrange(0, query.count())
-		except ValueError:
-			return Response(status = 200, body = '0')
+	file_hash = _get_index().choose(category, language)
+	if file_hash is None:
+		return Response(status = 200, body = '0')
+	
+	# A different sound every time, so the response isn't cached
+	return _file_response(_get_file_path(file_hash), cache_control = 'no-cache')
+
+def _parse_id(s):
+	"""
+		:type s: string
+		:return category/language id, or None if not given (any)
+		:rtype: int
+	"""
+	if not s:
+		return None
+	return int(s)
+
+class _SoundIndex:
+	"""
+		All sounds in `t_sound`, kept in memory so `check` and `random` don't query it.
+		Public sounds are in a list per (category, language), where either can be None
+		for "any", so a random one can be picked without counting and skipping rows.
+	"""
+	
+	def __init__(self):
+		self.hashes = set()
+		# Dict[hash, (category, language)], public sounds only
+		self._public = {}
+		# Dict[(category, language), List[hash]]
+		self._buckets = {}
+	
+	def add(self, sound):
+		"""
+			Add a sound, or update it if it's already there
+			
+			:type sound: Metadata, or a row with the same attributes
+		"""
+		file_hash = sound.hash
+		self.hashes.add(file_hash)
+		current = self._public.get(file_hash)
+		new = ((sound.category, sound.language) if sound.is_public else None)
+		if current == new:
+			return
+		buckets = self._buckets
+		if current is not None:
+			# Only when a sound is uploaded again with different metadata
+			del self._public[file_hash]
+			for key in _bucket_keys(*current):
+				buckets[key].remove(file_hash)
+		if new is not None:
+			self._public[file_hash] = new
+			for key in _bucket_keys(*new):
+				bucket = buckets.get(key)
+				if bucket is None:
+					bucket = buckets[key] = []
+				bucket.append(file_hash)
+	
+	def choose(self, category, language):
+		"""
+			:type category: int
+			:type language: int
+			:return hash of a random public sound, or None if there's none
+			:rtype: string
+		"""
+		bucket = self._buckets.get((category, language))
+		if not bucket:
+			return None
+		return bucket[randrange(len(bucket))]
+
+def _bucket_keys(category, language):
+	return ((category, language), (category, None), (None, language), (None, None))
+
+def _get_index():
+	"""
+		Load the sound index from the database the first time it's needed
 		
-		sound = query.offset(offset).limit(1).one()
+		:rtype: _SoundIndex
+	"""
+	global _index
+	if _index is None:
+		index = _SoundIndex()
+		with Session() as session:
+			for sound in session.query(Sound.hash, Sound.category, Sound.language, Sound.is_public):
+				index.add(sound)
+		_index = index
+	return _index
+
+_index = None
+
+def _file_response(file_path, *, cache_control = None):
+	"""
+		Send a sound file without reading it into memory; aiohttp handles Range and
+		conditional requests. Files only change when replaced (`put?uf=1`), which
+		changes their ETag, so the default is to let clients keep them for a while.
 		
-		file_path = _get_file_path(sound.hash)
+		:type file_path: string
+		:rtype: aiohttp.web.StreamResponse
+	"""
+	if not path.isfile(file_path):
+		return Response(status = 200, body = '0')
+	
+	if cache_control is None:
+		cache_control = 'public, max-age={}'.format(settings.SOUND_CACHE_MAX_AGE)
+	
+	return FileResponse(file_path, headers = {
+		'Content-Type': 'audio/mpeg',
+		'Cache-Control': cache_control,
+	})
+
+def _store_file(f, overwrite):
+	"""
+		Copy an uploaded sound file to its place (by hash), through a temporary
+		file renamed into place so it's never seen half-written. Runs off the event loop.
 		
-		assert path.exists(file_path)
+		:type f: file object
+		:type overwrite: bool
+		:return metadata, or None if the file exists (and isn't to be overwritten) or is invalid
+		:rtype: Metadata
+	"""
+	if f.seek(0, 2) < 128:
+		return None
+	f.seek(-128, 2) # metadata offset
+	metadata = _parse_metadata(f.read())
+	if not _is_valid_name(metadata.hash):
+		return None
+	
+	file_path = _get_file_path(metadata.hash)
+	if not overwrite and path.exists(file_path):
+		return None
+	
+	makedirs(path.dirname(file_path), exist_ok = True)
+	f.seek(0)
+	with tempfile.NamedTemporaryFile(dir = path.dirname(file_path), suffix = '.tmp', delete = False) as output:
+		shutil.copyfileobj(f, output)
+	
+	try:
+		if overwrite:
+			os.replace(output.name, file_path)
+		else:
+			# Fails if another upload of the same sound got there first
+			os.link(output.name, file_path)
+	except FileExistsError:
+		return None
+	finally:
+		if path.exists(output.name):
+			os.remove(output.name)
+	
+	return metadata
+
+def _is_valid_name(s):
+	"""
+		Whether a sound hash or builtin code is safe to use in a file path
 		
-		with open(file_path, 'rb') as f:
-			return Response(status = 200, content_type = 'audio/mpeg', body = f.read())
+		:type s: string
+		:rtype: bool
+	"""
+	return _VALID_NAME.fullmatch(s) is not None
+
+_VALID_NAME = re.compile(r'[A-Za-z0-9_-]+')
 
 def _get_file_path(file_hash):
 	"""
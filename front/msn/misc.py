@@ -1,16 +1,99 @@
+import asyncio
+from time import perf_counter
 from urllib.parse import quote
-from util.misc import first_in_iterable
+from util.misc import first_in_iterable, LRUCache, TokenBucket
+from util.perf import metrics
 
 from core import error
+from core.session import PollingSession
+import settings
+
+# Dict[email, Dict[command, int]]: how often each account was throttled, served at /etc/perf.
+# Recorded whether or not `settings.PERF_METRICS` is on; only the most recent accounts are kept.
+throttled_users = LRUCache(1000)
 
 class MSNPHandlers:
-	def __init__(self):
+	def __init__(self, front, *, rate_limits = None, rate_limits_deferred = None):
+		# `rate_limits`: Dict[command, (per second, burst)], for each session.
+		# Commands over the limit get `Err.ChangingTooRapidly`, except those in `rate_limits_deferred`,
+		# which are applied once allowed; if more arrive in the meantime, only the latest is.
+		self._front = front
 		self._map = { 'OUT': _m_out }
+		# Only time commands when asked to, so `apply` stays a dict lookup and a call
+		self._metrics = (metrics if settings.PERF_METRICS else None)
+		self._rate_limits = rate_limits or {}
+		self._rate_limits_deferred = rate_limits_deferred or set()
 	
 	def apply(self, msg, sess):
 		handler = self._map.get(msg[0])
-		if handler:
+		if handler is None:
+			return
+		if msg[0] in self._rate_limits and not self._check_rate_limit(msg, sess):
+			return
+		self._dispatch(handler, msg, sess)
+	
+	def _dispatch(self, handler, msg, sess):
+		if self._metrics is None:
 			handler(sess, *msg[1:])
+			return
+		self._apply_timed(handler, msg, sess)
+	
+	def _check_rate_limit(self, msg, sess):
+		# Returns whether `msg` can be applied now
+		cmd = msg[0]
+		state = sess.state
+		bucket = state.rate_buckets.get(cmd)
+		if bucket is None:
+			bucket = TokenBucket(*self._rate_limits[cmd])
+			state.rate_buckets[cmd] = bucket
+		
+		deferred = (cmd in self._rate_limits_deferred)
+		if deferred:
+			# PRP sets different properties
+			key = ((cmd, msg[2]) if cmd == 'PRP' and len(msg) > 2 else cmd)
+			if key in state.deferred_msgs:
+				# Don't let an earlier message be applied after this one
+				state.deferred_msgs[key] = msg
+				return False
+		if bucket.take():
+			return True
+		
+		if self._metrics is not None:
+			self._metrics.incr(('msnp', 'throttled', cmd))
+		if sess.user is not None:
+			counts = throttled_users.get(sess.user.email)
+			if counts is None:
+				counts = {}
+				throttled_users.put(sess.user.email, counts)
+			counts[cmd] = counts.get(cmd, 0) + 1
+		if deferred:
+			state.deferred_msgs[key] = msg
+			asyncio.get_event_loop().call_later(bucket.wait_time(), self._apply_deferred, sess, bucket, key)
+		elif len(msg) > 1:
+			sess.send_reply(Err.ChangingTooRapidly, msg[1])
+		return False
+	
+	def _apply_deferred(self, sess, bucket, key):
+		if sess.closed: return
+		msg = sess.state.deferred_msgs.pop(key, None)
+		if msg is None: return
+		bucket.take()
+		self._dispatch(self._map[msg[0]], msg, sess)
+	
+	def _apply_timed(self, handler, msg, sess):
+		front = self._front
+		if isinstance(sess, PollingSession):
+			front = 'GW-' + front
+		key = ('msnp', front, sess.state.dialect, msg[0])
+		failed = False
+		t0 = perf_counter()
+		try:
+			handler(sess, *msg[1:])
+		except:
+			failed = True
+			raise
+		finally:
+			self._metrics.observe(key, perf_counter() - t0, error = failed)
 	
 	def __call__(self, f):
 		msg = f.__name__[3:].upper()
@@ -21,7 +104,42 @@ def _m_out(sess):
 	sess.send_reply('OUT')
 	sess.close()
 
-def build_msnp_presence_notif(trid, ctc, dialect, backend):
+class Slot:
+	# Placeholder for an argument of an `MSNPTemplate`
+	def __init__(self, name):
+		self.name = name
+
+class MSNPTemplate:
+	# A list of MSNP messages encoded ahead of time, except for their `Slot`s,
+	# which are filled in by `render`. Messages can't have payloads.
+	
+	def __init__(self, msgs):
+		parts = []
+		buf = []
+		for m in msgs:
+			args = [x for x in m if x is not None]
+			for i, x in enumerate(args):
+				if i > 0:
+					buf.append(' ')
+				if isinstance(x, Slot):
+					parts.append(''.join(buf).encode('utf-8'))
+					parts.append(x.name)
+					buf = []
+				else:
+					buf.append(str(x).replace(' ', '%20'))
+			buf.append('\r\n')
+		parts.append(''.join(buf).encode('utf-8'))
+		self._parts = parts
+		self.count = len(msgs)
+	
+	def render(self, **values):
+		values = { k: str(v).replace(' ', '%20').encode('utf-8') for k, v in values.items() }
+		return b''.join(
+			(values[p] if isinstance(p, str) else p)
+			for p in self._parts
+		)
+
+def build_msnp_presence_notif(trid, ctc, dialect, backend, changed = None):
 	status = ctc.status
 	is_offlineish = status.is_offlineish()
 	if is_offlineish and trid is not None:
@@ -40,22 +158,46 @@ def build_msnp_presence_notif(trid, ctc, dialect, backend):
 			yield ('FLN', head.email, networkid)
 		return
 	
-	if trid: frst = ('ILN', trid)
-	else: frst = ('NLN',)
-	rst = []
 	ctc_sess = first_in_iterable(backend.util_get_sessions_by_user(head))
-	if dialect >= 8:
-		rst.append(ctc_sess.state.front_specific.get('msn_capabilities') or 0)
-	if dialect >= 9:
-		rst.append(encode_msnobj(ctc_sess.state.front_specific.get('msn_msnobj') or '<msnobj/>'))
+	yield from _build_presence_online(trid, ctc, ctc_sess, dialect, changed)
+
+def build_msnp_iln_block(trid, online_contacts, dialect):
+	# `online_contacts`: (Contact, Session) pairs, see `Backend.util_get_online_contacts`.
+	# Returns the ILNs (and UBXs) of those still online, encoded as one block.
+	msgs = []
+	for ctc, ctc_sess in online_contacts:
+		if ctc.status.is_offlineish(): continue
+		msgs.extend(_build_presence_online(trid, ctc, ctc_sess, dialect))
+	return encode_msnp_block(msgs)
+
+def _build_presence_online(trid, ctc, ctc_sess, dialect, changed = None):
+	# `changed`: see `PresenceNotificationEvent`; only the messages showing those are built
+	status = ctc.status
+	head = ctc.head
 	
-	if dialect >= 18:
-		yield (*frst, status.substatus.name, encode_email_networkid(head.email, networkid), status.name, *rst)
+	if dialect >= 14:
+		networkid = 1
 	else:
-		yield (*frst, status.substatus.name, head.email, networkid, status.name, *rst)
+		networkid = None
+	
+	if changed is None or changed - _UBX_FIELDS:
+		if trid: frst = ('ILN', trid)
+		else: frst = ('NLN',)
+		rst = []
+		if dialect >= 8:
+			rst.append(ctc_sess.state.front_specific.get('msn_capabilities') or 0)
+		if dialect >= 9:
+			rst.append(encode_msnobj(ctc_sess.state.front_specific.get('msn_msnobj') or '<msnobj/>'))
+		
+		if dialect >= 18:
+			yield (*frst, status.substatus.name, encode_email_networkid(head.email, networkid), status.name, *rst)
+		else:
+			yield (*frst, status.substatus.name, head.email, networkid, status.name, *rst)
 	
 	if dialect < 11:
 		return
+	if changed is not None and not changed & _UBX_FIELDS:
+		return
 	
 	ubx_payload = '<Data><PSM>{}</PSM><CurrentMedia>{}</CurrentMedia></Data>'.format(
 		status.message or '', status.media or ''
@@ -66,6 +208,63 @@ def build_msnp_presence_notif(trid, ctc, dialect, backend):
 	elif dialect >= 11:
 		yield ('UBX', head.email, networkid, ubx_payload)
 
+# Fields of `Backend.me_update` sent in UBX rather than NLN
+_UBX_FIELDS = frozenset(('message', 'media'))
+
+def encode_msnp_block(msgs):
+	# Same encoding as `MSNPWriter`, for sending many messages as one `EncodedReplyEvent`
+	buf = []
+	for m in msgs:
+		data = None
+		if isinstance(m[-1], bytes):
+			data = m[-1]
+			m = (*m[:-1], len(data))
+		buf.append(' '.join(str(x).replace(' ', '%20') for x in m if x is not None).encode('utf-8'))
+		buf.append(b'\r\n')
+		if data is not None:
+			buf.append(data)
+	return b''.join(buf)
+
+def build_msnp_joi(sess, dialect):
+	# JOI(s) announcing `sess` to the others in its chat
+	user = sess.user
+	state = sess.state
+	extra = ()
+	if dialect >= 13:
+		extra = (state.front_specific.get('msn_capabilities') or 0,)
+	msgs = []
+	pop_id = getattr(state, 'pop_id', None)
+	if dialect >= 18 and pop_id:
+		msgs.append(('JOI', '{};{}'.format(user.email, pop_id), user.status.name, *extra))
+	msgs.append(('JOI', user.email, user.status.name, *extra))
+	return msgs
+
+def build_msnp_iro_block(trid, roster, dialect):
+	# IROs for all of `roster` (see `Chat.get_roster`), as one block
+	l = len(roster)
+	buf = []
+	for i, (sc, su) in enumerate(roster):
+		buf.append('IRO {} {} {} '.format(trid, i + 1, l).encode('utf-8'))
+		buf.append(_get_roster_entry(sc, su, dialect))
+	return b''.join(buf)
+
+def _get_roster_entry(sess, user, dialect):
+	# The part of an IRO describing `sess`, cached on it per dialect
+	cache = sess.state.front_specific.get('msn_roster_entries')
+	if cache is None:
+		cache = {}
+		sess.state.front_specific['msn_roster_entries'] = cache
+	name = user.status.name
+	cached = cache.get(dialect)
+	if cached is not None and cached[0] == name:
+		return cached[1]
+	extra = ()
+	if dialect >= 13:
+		extra = (sess.state.front_specific.get('msn_capabilities') or 0,)
+	entry = encode_msnp_block([(user.email, name, *extra)])
+	cache[dialect] = (name, entry)
+	return entry
+
 def encode_email_networkid(email, networkid):
 	return '{}:{}'.format(networkid or 1, email)
 
@@ -84,8 +283,10 @@ class Err:
 	PrincipalNotInGroup = 225
 	GroupNameTooLong = 229
 	GroupZeroUnremovable = 230
+	InvalidXML = 240
 	InternalServerError = 500
 	CommandDisabled = 502
+	ChangingTooRapidly = 800
 	AuthFail = 911
 	
 	@classmethod
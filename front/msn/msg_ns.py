@@ -1,13 +1,22 @@
+import asyncio
+import re
 from datetime import datetime
+from lxml.etree import fromstring as parse_xml_etree
 from lxml.objectify import fromstring as parse_xml
+from xml.sax.saxutils import quoteattr
 
-from core import session
-from core.models import Substatus, Lst
+from core import session, event
+from core.models import Substatus, Lst, ListChangeKind
 from core.client import Client
+from util.misc import LRUCache
+import settings
 
-from .misc import build_msnp_presence_notif, MSNPHandlers, encode_msnobj, Err
+from .misc import build_msnp_iln_block, MSNPHandlers, MSNPTemplate, Slot, encode_msnobj, Err
 
-_handlers = MSNPHandlers()
+_handlers = MSNPHandlers('NS',
+	rate_limits = settings.MSNP_NS_RATE_LIMITS,
+	rate_limits_deferred = { 'CHG', 'UUX', 'PRP' },
+)
 apply = _handlers.apply
 
 MSNP_DIALECTS = ['MSNP{}'.format(d) for d in (
@@ -168,63 +177,134 @@ def _util_usr_final(sess, trid, token):
 def _m_syn(sess, trid, *extra):
 	user = sess.user
 	dialect = sess.state.dialect
+	
+	if dialect < 10:
+		#>>> SYN trid ser
+		ser = user.list_version
+		since = int(extra[0])
+		# 0 is what clients without a cached list send, and what every user's list
+		# was at before versions were kept; they always get the whole list.
+		changes = (sess.state.backend.util_get_list_changes(user, since) if since > 0 else None)
+		if changes is not None:
+			# Client has an older version of the list cached; send only what changed since
+			sess.send_reply('SYN', trid, ser)
+			for change in changes:
+				m = _build_list_change(change, user, dialect)
+				if m is None: continue
+				sess.send_reply(*m)
+			return
+	else:
+		ser = None
+	
+	# Contact lists are only re-rendered after they change; see `User.detail_version`
+	key = (user.uuid, _syn_dialect_bucket(dialect))
+	version = user.detail_version
+	cached = _syn_cache.get(key)
+	if cached is None or cached[0] != version:
+		cached = (version, MSNPTemplate(_build_syn(user, dialect)))
+		_syn_cache.put(key, cached)
+	tmpl = cached[1]
+	
+	sess.send_event(event.EncodedReplyEvent(tmpl.render(trid = trid, ser = ser)))
+
+def _syn_dialect_bucket(dialect):
+	# Dialects whose SYN responses are identical share a bucket
+	if dialect < 6: return 5
+	if dialect < 8: return 7
+	if dialect < 10: return 9
+	if dialect < 12: return 11
+	return 12
+
+def _build_syn(user, dialect):
 	detail = user.detail
 	contacts = detail.contacts
 	groups = detail.groups
 	settings = detail.settings
+	trid = _SLOT_TRID
+	ser = _SLOT_SER
+	msgs = []
 	
 	if dialect < 10:
-		sess.state.syn_ser = int(extra[0])
-		ser = _ser(sess.state)
 		if dialect < 6:
-			sess.send_reply('SYN', trid, ser)
+			msgs.append(('SYN', trid, ser))
 			for lst in (Lst.FL, Lst.AL, Lst.BL, Lst.RL):
 				cs = [c for c in contacts.values() if c.lists & lst]
 				if cs:
 					for i, c in enumerate(cs):
-						sess.send_reply('LST', trid, lst.name, ser, len(cs), i + 1, c.head.email, c.status.name)
+						msgs.append(('LST', trid, lst.name, ser, len(cs), i + 1, c.head.email, c.status.name))
 				else:
-					sess.send_reply('LST', trid, lst.name, ser, 0, 0)
-			sess.send_reply('GTC', trid, ser, settings.get('GTC', 'A'))
-			sess.send_reply('BLP', trid, ser, settings.get('BLP', 'AL'))
+					msgs.append(('LST', trid, lst.name, ser, 0, 0))
+			msgs.append(('GTC', trid, ser, settings.get('GTC', 'A')))
+			msgs.append(('BLP', trid, ser, settings.get('BLP', 'AL')))
 		elif dialect < 8:
-			sess.send_reply('SYN', trid, ser)
+			msgs.append(('SYN', trid, ser))
 			num_groups = len(groups) + 1
-			sess.send_reply('LSG', trid, ser, 1, num_groups, '0', "Other Contacts", 0)
+			msgs.append(('LSG', trid, ser, 1, num_groups, '0', "Other Contacts", 0))
 			for i, g in enumerate(groups.values()):
-				sess.send_reply('LSG', trid, ser, i + 2, num_groups, g.id, g.name, 0)
+				msgs.append(('LSG', trid, ser, i + 2, num_groups, g.id, g.name, 0))
 			for lst in (Lst.FL, Lst.AL, Lst.BL, Lst.RL):
 				cs = [c for c in contacts.values() if c.lists & lst]
 				if cs:
 					for i, c in enumerate(cs):
 						gs = ((','.join(c.groups) or '0') if lst == Lst.FL else None)
-						sess.send_reply('LST', trid, lst.name, ser, i + 1, len(cs), c.head.email, c.status.name, gs)
+						msgs.append(('LST', trid, lst.name, ser, i + 1, len(cs), c.head.email, c.status.name, gs))
 				else:
-					sess.send_reply('LST', trid, lst.name, ser, 0, 0)
-			sess.send_reply('GTC', trid, ser, settings.get('GTC', 'A'))
-			sess.send_reply('BLP', trid, ser, settings.get('BLP', 'AL'))
+					msgs.append(('LST', trid, lst.name, ser, 0, 0))
+			msgs.append(('GTC', trid, ser, settings.get('GTC', 'A')))
+			msgs.append(('BLP', trid, ser, settings.get('BLP', 'AL')))
 		else:
 			num_groups = len(groups) + 1
-			sess.send_reply('SYN', trid, ser, len(contacts), num_groups)
-			sess.send_reply('GTC', settings.get('GTC', 'A'))
-			sess.send_reply('BLP', settings.get('BLP', 'AL'))
-			sess.send_reply('LSG', '0', "Other Contacts", 0)
+			msgs.append(('SYN', trid, ser, len(contacts), num_groups))
+			msgs.append(('GTC', settings.get('GTC', 'A')))
+			msgs.append(('BLP', settings.get('BLP', 'AL')))
+			msgs.append(('LSG', '0', "Other Contacts", 0))
 			for g in groups.values():
-				sess.send_reply('LSG', g.id, g.name, 0)
+				msgs.append(('LSG', g.id, g.name, 0))
 			for c in contacts.values():
-				sess.send_reply('LST', c.head.email, c.status.name, c.lists, ','.join(c.groups) or '0')
+				msgs.append(('LST', c.head.email, c.status.name, c.lists, ','.join(c.groups) or '0'))
 	else:
-		sess.send_reply('SYN', trid, TIMESTAMP, TIMESTAMP, len(contacts), len(groups))
-		sess.send_reply('GTC', settings.get('GTC', 'A'))
-		sess.send_reply('BLP', settings.get('BLP', 'AL'))
-		sess.send_reply('PRP', 'MFN', user.status.name)
+		msgs.append(('SYN', trid, TIMESTAMP, TIMESTAMP, len(contacts), len(groups)))
+		msgs.append(('GTC', settings.get('GTC', 'A')))
+		msgs.append(('BLP', settings.get('BLP', 'AL')))
+		msgs.append(('PRP', 'MFN', user.status.name))
 		
 		for g in groups.values():
-			sess.send_reply('LSG', g.name, g.id)
+			msgs.append(('LSG', g.name, g.id))
 		for c in contacts.values():
-			sess.send_reply('LST', 'N={}'.format(c.head.email), 'F={}'.format(c.status.name), 'C={}'.format(c.head.uuid),
+			msgs.append(('LST', 'N={}'.format(c.head.email), 'F={}'.format(c.status.name), 'C={}'.format(c.head.uuid),
 				c.lists, (None if dialect < 12 else 1), ','.join(c.groups)
-			)
+			))
+	
+	return msgs
+
+def _build_list_change(change, user, dialect):
+	# The same commands that would have been sent if the client was online for the change
+	kind = change.kind
+	ser = change.version
+	if kind is ListChangeKind.ContactAdd:
+		# Before groups, adding to one is just another add to FL
+		if change.group_id and dialect < 7: return None
+		return ('ADD', 0, change.lst.name, ser, change.contact.email, change.value or change.contact.email, change.group_id)
+	if kind is ListChangeKind.ContactRemove:
+		if change.group_id and dialect < 7: return None
+		return ('REM', 0, change.lst.name, ser, change.contact.email, change.group_id)
+	if dialect >= 7:
+		if kind is ListChangeKind.GroupAdd:
+			return ('ADG', 0, ser, change.value, change.group_id, 0)
+		if kind is ListChangeKind.GroupRemove:
+			return ('RMG', 0, ser, change.group_id)
+		if kind is ListChangeKind.GroupEdit:
+			return ('REG', 0, ser, change.group_id, change.value, 0)
+	if kind is ListChangeKind.Setting:
+		return (change.key, 0, ser, change.value)
+	if kind is ListChangeKind.Name:
+		return ('REA', 0, ser, user.email, change.value)
+	return None
+
+_SLOT_TRID = Slot('trid')
+_SLOT_SER = Slot('ser')
+# Dict[(User.uuid, dialect bucket), (User.detail_version, MSNPTemplate)]
+_syn_cache = LRUCache(5000)
 
 @_handlers
 def _m_gcf(sess, trid, filename):
@@ -236,22 +316,50 @@ def _m_png(sess):
 
 @_handlers
 def _m_uux(sess, trid, data):
-	elm = parse_xml(data.decode('utf-8'))
+	#>>> UUX trid length
+	#>>> <Data><PSM>...</PSM><CurrentMedia>...</CurrentMedia><MachineGuid>{...}</MachineGuid></Data>
+	if len(data) > settings.MSNP_MAX_PAYLOAD_SIZES['UUX']:
+		sess.send_reply(Err.InvalidParameter, trid)
+		return
+	try:
+		elms = parse_uux(data)
+	except Exception:
+		sess.send_reply(Err.InvalidParameter, trid)
+		return
 	
-	psm = elm.find('PSM')
-	cm = elm.find('CurrentMedia')
-	if psm or cm:
-		sess.state.backend.me_update(sess, {
-			'message': str(elm.find('PSM')),
-			'media': str(elm.find('CurrentMedia')),
-		})
+	fields = {}
+	if 'PSM' in elms:
+		fields['message'] = elms['PSM']
+	if 'CurrentMedia' in elms:
+		fields['media'] = elms['CurrentMedia']
+	if fields:
+		sess.state.backend.me_update(sess, fields)
 	
-	mg = elm.find('MachineGuid')
+	mg = elms.get('MachineGuid')
 	if mg:
-		sess.state.pop_id = str(mg)[1:-1]
+		sess.state.pop_id = mg[1:-1]
 	
 	sess.send_reply('UUX', trid, 0)
 
+def parse_uux(data):
+	# Returns Dict[tag, text] of the children of <Data>.
+	# UUX is sent often, and almost always as a flat list of elements with
+	# plain text, so that's parsed with regexes; anything else goes to lxml.
+	m = _UUX_FLAT.fullmatch(data)
+	if m is None or b'&' in data:
+		return _parse_uux_xml(data)
+	return {
+		tag.decode('utf-8'): text.decode('utf-8')
+		for tag, text in _UUX_ELEMENT.findall(m.group(1))
+	}
+
+_UUX_FLAT = re.compile(rb'\s*<Data>((?:\s*(?:<(\w+)>[^<]*</\2>|<\w+/>))*)\s*</Data>\s*')
+_UUX_ELEMENT = re.compile(rb'<(\w+)(?:/>|>([^<]*)</\1>)')
+
+def _parse_uux_xml(data):
+	elm = parse_xml(data)
+	return { child.tag: (child.text or '') for child in elm.iterchildren() }
+
 @_handlers
 def _m_url(sess, trid, *ignored):
 	sess.send_reply('URL', trid, '/unused1', '/unused2', 1)
@@ -264,7 +372,7 @@ def _m_adg(sess, trid, name, ignored = None):
 	except Exception as ex:
 		sess.send_reply(Err.GetCodeForException(ex), trid)
 		return
-	sess.send_reply('ADG', trid, _ser(sess.state), name, group.id, 0)
+	sess.send_reply('ADG', trid, _ser(sess), name, group.id, 0)
 
 @_handlers
 def _m_rmg(sess, trid, group_id):
@@ -282,7 +390,7 @@ def _m_rmg(sess, trid, group_id):
 		sess.send_reply(Err.GetCodeForException(ex), trid)
 		return
 	
-	sess.send_reply('RMG', trid, _ser(sess.state) or 1, group_id)
+	sess.send_reply('RMG', trid, _ser(sess) or 1, group_id)
 
 @_handlers
 def _m_reg(sess, trid, group_id, name, ignored = None):
@@ -293,7 +401,7 @@ def _m_reg(sess, trid, group_id, name, ignored = None):
 		sess.send_reply(Err.GetCodeForException(ex), trid)
 		return
 	if sess.state.dialect < 10:
-		sess.send_reply('REG', trid, _ser(sess.state), group_id, name, 0)
+		sess.send_reply('REG', trid, _ser(sess), group_id, name, 0)
 	else:
 		sess.send_reply('REG', trid, 1, name, group_id, 0)
 
@@ -341,7 +449,7 @@ def _add_common(sess, trid, lst_name, contact_uuid, name = None, group_id = None
 		else:
 			sess.send_reply('ADC', trid, lst_name, 'N={}'.format(ctc_head.email))
 	else:
-		sess.send_reply('ADD', trid, lst_name, _ser(sess.state), ctc_head.email, name, group_id)
+		sess.send_reply('ADD', trid, lst_name, _ser(sess), ctc_head.email, name, group_id)
 
 @_handlers
 def _m_rem(sess, trid, lst_name, usr, group_id = None):
@@ -367,7 +475,7 @@ def _m_rem(sess, trid, lst_name, usr, group_id = None):
 	except Exception as ex:
 		sess.send_reply(Err.GetCodeForException(ex), trid)
 		return
-	sess.send_reply('REM', trid, lst_name, _ser(sess.state), usr, group_id)
+	sess.send_reply('REM', trid, lst_name, _ser(sess), usr, group_id)
 
 @_handlers
 def _m_gtc(sess, trid, value):
@@ -377,24 +485,30 @@ def _m_gtc(sess, trid, value):
 	# "Alert me when other people add me ..." Y/N
 	#>>> GTC 152 N
 	sess.state.backend.me_update(sess, { 'gtc': value })
-	sess.send_reply('GTC', trid, _ser(sess.state), value)
+	sess.send_reply('GTC', trid, _ser(sess), value)
 
 @_handlers
 def _m_blp(sess, trid, value):
 	# Check "Only people on my Allow List ..." AL/BL
 	#>>> BLP 143 BL
 	sess.state.backend.me_update(sess, { 'blp': value })
-	sess.send_reply('BLP', trid, _ser(sess.state), value)
+	sess.send_reply('BLP', trid, _ser(sess), value)
 
 @_handlers
 def _m_chg(sess, trid, sts_name, capabilities = None, msnobj = None):
 	#>>> CHG 120 BSY 1073791020 <msnobj .../>
 	capabilities = capabilities or 0
+	front_specific = sess.state.front_specific
+	# Contacts get these along with the status
+	front_changed = (
+		front_specific.get('msn_capabilities') != capabilities
+		or front_specific.get('msn_msnobj') != msnobj
+	)
+	front_specific['msn_capabilities'] = capabilities
+	front_specific['msn_msnobj'] = msnobj
 	sess.state.backend.me_update(sess, {
 		'substatus': getattr(Substatus, sts_name),
-	})
-	sess.state.front_specific['msn_capabilities'] = capabilities
-	sess.state.front_specific['msn_msnobj'] = msnobj
+	}, force_notify = front_changed)
 	sess.send_reply('CHG', trid, sts_name, capabilities, encode_msnobj(msnobj))
 	
 	# Send ILNs
@@ -402,11 +516,18 @@ def _m_chg(sess, trid, sts_name, capabilities = None, msnobj = None):
 	if state.iln_sent:
 		return
 	state.iln_sent = True
-	user = sess.user
-	dialect = state.dialect
-	for ctc in user.detail.contacts.values():
-		for m in build_msnp_presence_notif(trid, ctc, dialect, sess.state.backend):
-			sess.send_reply(*m)
+	online_contacts = state.backend.util_get_online_contacts(sess.user)
+	_send_iln_chunks(sess, trid, online_contacts, 0)
+
+def _send_iln_chunks(sess, trid, online_contacts, start):
+	# Large lists are sent over several loop iterations, so one login doesn't hold up everything else
+	if sess.closed: return
+	end = start + settings.ILN_CHUNK_SIZE
+	data = build_msnp_iln_block(trid, online_contacts[start:end], sess.state.dialect)
+	if data:
+		sess.send_event(event.EncodedReplyEvent(data))
+	if end < len(online_contacts):
+		asyncio.get_event_loop().call_soon(_send_iln_chunks, sess, trid, online_contacts, end)
 
 @_handlers
 def _m_rea(sess, trid, email, name):
@@ -415,7 +536,7 @@ def _m_rea(sess, trid, email, name):
 		return
 	if email == sess.user.email:
 		sess.state.backend.me_update(sess, { 'name': name })
-	sess.send_reply('REA', trid, _ser(sess.state), email, name)
+	sess.send_reply('REA', trid, _ser(sess), email, name)
 
 @_handlers
 def _m_snd(sess, trid, email):
@@ -452,27 +573,97 @@ def _m_xfr(sess, trid, dest):
 		extra += (1,)
 	sess.send_reply('XFR', trid, dest, 'm1.escargot.log1p.xyz:1864', 'CKI', token, *extra)
 
-# These four commands appear to be useless:
 @_handlers
 def _m_adl(sess, trid, data):
+	#>>> ADL trid length
+	#>>> <ml l="1"><d n="example.com"><c n="bob" l="3" t="1" /></d></ml>
+	state = sess.state
+	if state.dialect < 13:
+		sess.send_reply(Err.CommandDisabled, trid)
+		return
+	try:
+		contacts = _parse_ml('ADL', data)
+	except Exception:
+		sess.send_reply(Err.InvalidXML, trid)
+		return
+	
+	state.backend.me_contact_add_bulk(sess, contacts)
 	sess.send_reply('ADL', trid, 'OK')
+	
+	if not state.iln_sent:
+		# The first CHG sends everything
+		return
+	subscribed = { email for email, lsts in contacts if lsts & Lst.FL }
+	online_contacts = [
+		(ctc, ctc_sess) for ctc, ctc_sess in state.backend.util_get_online_contacts(sess.user)
+		if ctc.head.email in subscribed
+	]
+	data = build_msnp_iln_block(None, online_contacts, state.dialect)
+	if data:
+		sess.send_event(event.EncodedReplyEvent(data))
+
 @_handlers
 def _m_rml(sess, trid, data):
+	#>>> RML trid length
+	#>>> <ml><d n="example.com"><c n="bob" l="1" t="1" /></d></ml>
+	state = sess.state
+	if state.dialect < 13:
+		sess.send_reply(Err.CommandDisabled, trid)
+		return
+	try:
+		contacts = _parse_ml('RML', data)
+	except Exception:
+		sess.send_reply(Err.InvalidXML, trid)
+		return
+	state.backend.me_contact_remove_bulk(sess, contacts)
 	sess.send_reply('RML', trid, 'OK')
+
 @_handlers
 def _m_fqy(sess, trid, data):
-	sess.send_reply('FQY', trid, b'')
+	#>>> FQY trid length
+	#>>> <ml><d n="example.com"><c n="bob" /></d></ml>
+	try:
+		contacts = _parse_ml('FQY', data)
+	except Exception:
+		sess.send_reply(Err.InvalidXML, trid)
+		return
+	uuid_by_email = sess.state.backend.util_get_uuids_from_emails([email for email, _ in contacts])
+	by_domain = {}
+	for email in uuid_by_email:
+		(name, domain) = email.rsplit('@', 1)
+		by_domain.setdefault(domain, []).append(name)
+	out = ['<ml>']
+	for domain, names in by_domain.items():
+		out.append('<d n={}>'.format(quoteattr(domain)))
+		for name in names:
+			out.append('<c n={} t="1" />'.format(quoteattr(name)))
+		out.append('</d>')
+	out.append('</ml>')
+	sess.send_reply('FQY', trid, ''.join(out).encode('utf-8'))
+
+def _parse_ml(cmd, data):
+	# Returns List[(email, Lst)] from an ADL/RML/FQY payload
+	if len(data) > settings.MSNP_MAX_PAYLOAD_SIZES[cmd]:
+		raise ValueError("Membership list too long")
+	ml = parse_xml_etree(data)
+	contacts = []
+	for d in ml.iterfind('d'):
+		domain = d.get('n')
+		for c in d.iterfind('c'):
+			contacts.append(('{}@{}'.format(c.get('n'), domain), Lst(int(c.get('l') or 0))))
+	return contacts
+
 @_handlers
 def _m_uun(sess, trid, email, arg0, data):
 	sess.send_reply('UUN', trid, 'OK')
 
 # Utils
 
-def _ser(state):
-	if state.dialect >= 10:
+def _ser(sess):
+	# MSNP2-9 replies to list changes with the new version of the list
+	if sess.state.dialect >= 10:
 		return None
-	state.syn_ser += 1
-	return state.syn_ser
+	return sess.user.list_version
 
 def _encode_payload(tmpl, **kwargs):
 	return tmpl.format(**kwargs).replace('\n', '\r\n').encode('utf-8')
@@ -1,6 +1,14 @@
-from .misc import Err, MSNPHandlers
+import asyncio
+from time import monotonic, perf_counter
 
-_handlers = MSNPHandlers()
+import settings
+from util.perf import metrics
+
+from core import event
+
+from .misc import Err, MSNPHandlers, build_msnp_iro_block
+
+_handlers = MSNPHandlers('SB')
 apply = _handlers.apply
 
 # State = Auth
@@ -50,12 +58,8 @@ def _m_ans(sess, trid, arg, token, sessid):
 	# When you receive a chat from one contact, the server need to send:
 	# IRO trID 1 2 email@address.com status capabilities
 	# IRO trID 2 2 email@address.com;{xxxxxx-xxxx-xxxx-xxxxxxxxxx} status capabilities
-	l = len(roster)
-	for i, (sc, su) in enumerate(roster):
-		extra = ()
-		if dialect >= 13:
-			extra = (sc.state.front_specific.get('msn_capabilities') or 0,)
-		sess.send_reply('IRO', trid, i + 1, l, su.email, su.status.name, *extra)
+	if roster:
+		sess.send_event(event.EncodedReplyEvent(build_msnp_iro_block(trid, roster, dialect)))
 	sess.send_reply('ANS', trid, 'OK')
 
 # State = Live
@@ -76,17 +80,60 @@ def _m_cal(sess, trid, callee_email):
 @_handlers
 def _m_msg(sess, trid, ack, data):
 	#>>> MSG trid [UNAD] len
-	sess.state.chat.send_message_to_everyone(sess, data)
+	state = sess.state
+	typing = _is_typing_notification(data)
+	if typing:
+		# Clients keep sending these while the user types; one per interval is enough
+		now = monotonic()
+		if now - state.time_last_typing < settings.SB_TYPING_INTERVAL:
+			if settings.PERF_METRICS:
+				metrics.incr(('sb', 'typing', 'dropped'))
+			_reply_delivery(sess, trid, ack, True)
+			return
+		state.time_last_typing = now
+	else:
+		# The next typing notice starts a new run of typing, so it goes through
+		state.time_last_typing = float('-inf')
+	(failed, pending) = state.chat.send_message_to_everyone(sess, data, control = typing)
 	
-	# TODO: Implement ACK/NAK
+	if failed or not pending:
+		# Common case: every recipient's connection took the message right away
+		if settings.PERF_METRICS:
+			metrics.observe(('sb', 'delivery'), 0, error = failed)
+		_reply_delivery(sess, trid, ack, not failed)
+		return
 	if ack == 'U':
 		return
-	any_failed = False
-	if any_failed: # ADN
+	asyncio.ensure_future(_wait_delivery(sess, trid, ack, pending))
+
+async def _wait_delivery(sess, trid, ack, pending):
+	t0 = perf_counter()
+	results = await asyncio.gather(*(
+		sc.wait_delivered(settings.MSG_DELIVERY_TIMEOUT) for sc in pending
+	))
+	ok = all(results)
+	if settings.PERF_METRICS:
+		metrics.observe(('sb', 'delivery'), perf_counter() - t0, error = not ok)
+	if sess.closed: return
+	_reply_delivery(sess, trid, ack, ok)
+
+def _reply_delivery(sess, trid, ack, ok):
+	if not ok and settings.PERF_METRICS:
+		metrics.incr(('sb', 'nak'))
+	if ack == 'U':
+		return
+	if not ok: # ADN
 		sess.send_reply('NAK', trid)
 	elif ack != 'N': # AD
 		sess.send_reply('ACK', trid)
 
+def _is_typing_notification(data):
+	# Looks only at the MIME header for `Content-Type: text/x-msmsgscontrol`
+	end = data.find(b'\r\n\r\n')
+	if end < 0:
+		end = len(data)
+	return data.find(b'text/x-msmsgscontrol', 0, end) >= 0
+
 def _decode_email_pop(s):
 	# Split `foo@email.com;{uuid}` into (email, pop_id)
 	parts = s.split(';', 1)
@@ -1,25 +1,35 @@
-import io
 from typing import List
 from urllib.parse import unquote
 
+import settings
 from core.session import Session, SessionState
 from core import event
 
 from . import msg_ns, msg_sb
-from .misc import build_msnp_presence_notif
+from .misc import build_msnp_presence_notif, build_msnp_joi, encode_msnp_block
 
 class MSNPWriter:
-	def __init__(self, logger, sess_state: SessionState):
+	def __init__(self, logger, sess_state: SessionState, *, tracer = None):
 		self._logger = logger
-		self._buf = io.BytesIO()
+		# Encoded messages aren't joined until `flush`, so pre-encoded
+		# data written on its own can be passed on without copying.
+		self._chunks = []
 		self._sess_state = sess_state
+		self._tracer = tracer
 	
 	def write(self, outgoing_event):
 		if isinstance(outgoing_event, event.ReplyEvent):
 			self._write(outgoing_event.data)
 			return
+		if isinstance(outgoing_event, event.EncodedReplyEvent):
+			data = outgoing_event.data
+			self._logger.info('<<<', '[{} bytes pre-encoded]'.format(len(data)))
+			self._write_encoded(data)
+			return
 		if isinstance(outgoing_event, event.PresenceNotificationEvent):
-			for m in build_msnp_presence_notif(None, outgoing_event.contact, self._sess_state.dialect, self._sess_state.backend):
+			for m in build_msnp_presence_notif(
+				None, outgoing_event.contact, self._sess_state.dialect, self._sess_state.backend, outgoing_event.changed,
+			):
 				self._write(m)
 			return
 		if isinstance(outgoing_event, event.AddedToListEvent):
@@ -29,7 +39,7 @@ class MSNPWriter:
 			name = (user.status.name or email)
 			dialect = self._sess_state.dialect
 			if dialect < 10:
-				m = ('ADD', 0, lst.name, email, name)
+				m = ('ADD', 0, lst.name, outgoing_event.list_version, email, name)
 			else:
 				m = ('ADC', 0, lst.name, 'N={}'.format(email), 'F={}'.format(name))
 			self._write(m)
@@ -48,23 +58,40 @@ class MSNPWriter:
 			return
 		if isinstance(outgoing_event, event.ChatParticipantLeft):
 			user = outgoing_event.user
-			self._write(['BYE', user.email])
+			encoded = outgoing_event.encoded.get('msnp')
+			if encoded is None:
+				chunks = []
+				_msnp_encode(['BYE', user.email], chunks, _NULL_LOGGER)
+				encoded = chunks[0]
+				outgoing_event.encoded['msnp'] = encoded
+			self._logger.info('<<<', 'BYE', user.email)
+			self._write_encoded(encoded)
 			return
 		if isinstance(outgoing_event, event.ChatParticipantJoined):
+			# Sent to everyone else in the chat; encoded once per dialect
 			sess = outgoing_event.sess
-			user = sess.user
-			extra = ()
 			dialect = self._sess_state.dialect
-			if dialect >= 13:
-				extra = (self._sess_state.front_specific.get('msn_capabilities') or 0,)
-			if dialect >= 18 and sess.state.pop_id and sess.state is not self._sess_state:
-				self._write(['JOI', '{};{}'.format(user.email, sess.state.pop_id), user.status.name, *extra])
-			self._write(['JOI', user.email, user.status.name, *extra])
+			key = ('msnp', dialect)
+			encoded = outgoing_event.encoded.get(key)
+			if encoded is None:
+				encoded = encode_msnp_block(build_msnp_joi(sess, dialect))
+				outgoing_event.encoded[key] = encoded
+			self._logger.info('<<<', 'JOI', sess.user.email)
+			self._write_encoded(encoded)
 			return
 		if isinstance(outgoing_event, event.ChatMessage):
+			# The same event goes to every recipient, so it's only encoded once per dialect
 			user = outgoing_event.user_sender
 			data = outgoing_event.data
-			self._write(['MSG', user.email, user.status.name, data])
+			key = ('msnp', self._sess_state.dialect)
+			encoded = outgoing_event.encoded.get(key)
+			if encoded is None:
+				chunks = []
+				_msnp_encode(['MSG', user.email, user.status.name, data], chunks, _NULL_LOGGER)
+				encoded = b''.join(chunks)
+				outgoing_event.encoded[key] = encoded
+			self._logger.info('<<<', 'MSG', user.email, user.status.name, len(data))
+			self._write_encoded(encoded)
 			return
 		if isinstance(outgoing_event, event.POPBootEvent):
 			self._write(['OUT', 'OTH'])
@@ -79,79 +106,113 @@ class MSNPWriter:
 		raise Exception("Unknown outgoing_event", outgoing_event)
 	
 	def _write(self, m):
-		_msnp_encode(m, self._buf, self._logger)
+		_msnp_encode(m, self._chunks, self._logger)
+		if self._tracer is not None:
+			self._tracer.record_outgoing(m)
+	
+	def _write_encoded(self, data):
+		self._chunks.append(data)
+		if self._tracer is not None:
+			self._tracer.record_outgoing_encoded(data)
 	
 	def flush(self):
-		data = self._buf.getvalue()
-		if data:
-			self._buf = io.BytesIO()
-		return data
+		chunks = self._chunks
+		if not chunks:
+			return b''
+		self._chunks = []
+		if len(chunks) == 1:
+			return chunks[0]
+		return b''.join(chunks)
 
 class MSNPReader:
-	def __init__(self, logger):
+	def __init__(self, logger, *, tracer = None):
 		self.logger = logger
-		self._data = b''
-		self._i = 0
+		# Received data not yet parsed; grows in place, and parsed data is only removed
+		# once per `data_received`, so large payloads arriving in pieces aren't copied over and over.
+		self._buf = bytearray()
+		# Command (and payload length) already parsed from `_buf`, waiting for the rest of its payload
+		self._pending = None
+		self._tracer = tracer
 	
 	def __iter__(self):
 		return self
 	
 	def data_received(self, data):
-		if self._data:
-			self._data += data
-		else:
-			self._data = data
-		while self._data:
-			m = self._read_msnp()
-			if m is None: break
-			yield m
-	
-	def _read_msnp(self):
+		buf = self._buf
+		buf += data
+		i = 0
 		try:
-			m, body, e = _msnp_try_decode(self._data, self._i)
-		except AssertionError:
-			return None
-		except Exception:
-			print("ERR _read_msnp", self._i, self._data)
-			raise
+			while i < len(buf):
+				(m, i) = self._read_msnp(i)
+				if m is None: break
+				yield m
+		finally:
+			del buf[:i]
+	
+	def _read_msnp(self, i):
+		# Returns (message or `None` if incomplete, index of the unparsed rest of `_buf`)
+		buf = self._buf
+		pending = self._pending
+		while pending is None:
+			e = buf.find(b'\n', i)
+			if e < 0:
+				if len(buf) - i > MAX_COMMAND_LENGTH:
+					raise ProtocolError("Command too long")
+				return (None, i)
+			e += 1
+			try:
+				m = buf[i:e].decode('utf-8').split()
+			except UnicodeDecodeError:
+				raise ProtocolError("Bad encoding")
+			i = e
+			if not m: continue
+			n = None
+			if m[0] in _PAYLOAD_COMMANDS:
+				n = _parse_payload_length(m)
+			pending = (m, n)
+		
+		(m, n) = pending
+		body = None
+		if n is not None:
+			if len(buf) - i < n:
+				# Don't parse the command again when the rest of the payload arrives
+				self._pending = pending
+				return (None, i)
+			with memoryview(buf) as view:
+				body = bytes(view[i:i + n])
+			i += n
+		self._pending = None
 		
-		self._data = self._data[e:]
-		self._i = 0
 		_truncated_log(self.logger, '>>>', m)
+		if self._tracer is not None:
+			self._tracer.record_incoming(m, body)
 		m = [unquote(x) for x in m]
 		if body:
 			m.append(body)
-		return m
-	
-	def _read_raw(self, n):
-		i = self._i
-		e = i + n
-		assert e <= len(self._data)
-		self._i += n
-		return self._data[i:e]
+		return (m, i)
 
-def _msnp_try_decode(d, i) -> (List[str], int):
-	# Try to parse an MSNP message from buffer `d` starting at index `i`
-	# Returns (parsed message, end index)
-	e = d.find(b'\n', i)
-	assert e >= 0
-	e += 1
-	m = d[i:e].decode('utf-8').strip()
-	assert len(m) > 1
-	m = m.split()
-	body = None
-	if m[0] in _PAYLOAD_COMMANDS:
+def _parse_payload_length(m):
+	# Removes the payload length from `m` and checks it against `settings.MSNP_MAX_PAYLOAD_SIZES`
+	try:
 		n = int(m.pop())
-		assert e+n <= len(d)
-		body = d[e:e+n]
-		e += n
-	return m, body, e
+	except (IndexError, ValueError):
+		raise ProtocolError("Bad payload length", m)
+	if not 0 <= n <= settings.MSNP_MAX_PAYLOAD_SIZES.get(m[0], n):
+		raise ProtocolError("Payload too large", m[0], n)
+	return n
+
+class ProtocolError(Exception):
+	# Data received can't be parsed, or exceeds limits; the connection is closed
+	pass
+
+# Longest command line (without payload) accepted
+MAX_COMMAND_LENGTH = 16384
 
 _PAYLOAD_COMMANDS = {
 	'UUX', 'MSG', 'ADL', 'FQY', 'RML', 'UUN'
 }
 
-def _msnp_encode(m: List[object], buf, logger) -> None:
+def _msnp_encode(m: List[object], chunks: List[bytes], logger) -> None:
 	m = list(m)
 	data = None
 	if isinstance(m[-1], bytes):
@@ -159,11 +220,15 @@ def _msnp_encode(m: List[object], buf, logger) -> None:
 		m[-1] = len(data)
 	m = tuple(str(x).replace(' ', '%20') for x in m if x is not None)
 	_truncated_log(logger, '<<<', m)
-	w = buf.write
-	w(' '.join(m).encode('utf-8'))
-	w(b'\r\n')
+	chunks.append(' '.join(m).encode('utf-8') + b'\r\n')
 	if data is not None:
-		w(data)
+		chunks.append(data)
+
+class _NullLogger:
+	def info(self, *args):
+		pass
+
+_NULL_LOGGER = _NullLogger()
 
 class MSNP_SessState(SessionState):
 	def __init__(self, reader, backend):
@@ -171,10 +236,17 @@ class MSNP_SessState(SessionState):
 		self.reader = reader
 		self.backend = backend
 		self.dialect = None
+		# Dict[command, TokenBucket] and Dict[key, message], see `MSNPHandlers`
+		self.rate_buckets = {}
+		self.deferred_msgs = {}
 	
 	def data_received(self, data: bytes, sess: Session) -> None:
-		for incoming_event in self.reader.data_received(data):
-			self.apply_incoming_event(incoming_event, sess)
+		try:
+			for incoming_event in self.reader.data_received(data):
+				self.apply_incoming_event(incoming_event, sess)
+		except ProtocolError as ex:
+			self.reader.logger.info('ERR', *ex.args)
+			sess.close()
 	
 	def apply_incoming_event(self, incoming_event, sess: Session) -> None:
 		raise NotImplementedError('MSNP_SessState.apply_incoming_event')
@@ -183,7 +255,6 @@ class MSNP_NS_SessState(MSNP_SessState):
 	def __init__(self, reader, backend):
 		super().__init__(reader, backend)
 		self.usr_email = None
-		self.syn_ser = None
 		self.iln_sent = False
 		self.pop_id = None
 	
@@ -201,6 +272,8 @@ class MSNP_SB_SessState(MSNP_SessState):
 		super().__init__(reader, backend)
 		self.chat = None
 		self.pop_id = None
+		# `time.monotonic` of the last typing notification relayed, see `msg_sb._m_msg`
+		self.time_last_typing = float('-inf')
 	
 	def apply_incoming_event(self, incoming_event, sess) -> None:
 		msg_sb.apply(incoming_event, sess)
@@ -0,0 +1,179 @@
+"""
+	MSNP session traces
+	
+	A trace file is `MAGIC` followed by records of `_RECORD` + `length` bytes of data.
+	`data` is the MSNP frame as sent on the wire (minus secrets, see `scrub`),
+	or empty for `Kind.Open`/`Kind.Close` records.
+	
+	Recording is enabled with `settings.MSNP_TRACE_PATH`; see `bench/replay.py`
+	for replaying traces against a server.
+"""
+
+import struct
+import time
+from collections import namedtuple
+from enum import IntEnum
+
+MAGIC = b'MSNPTRC1'
+# time, session id, flags, length
+_RECORD = struct.Struct('<dIBI')
+# Replaces passwords, tokens and hashes
+SCRUBBED = '*'
+
+class Kind(IntEnum):
+	Incoming = 0
+	Outgoing = 1
+	Open = 2
+	Close = 3
+
+_FRONTS = ('NS', 'SB')
+_FLAG_GATEWAY = 0x10
+
+TraceRecord = namedtuple('TraceRecord', ['time', 'session_id', 'front', 'gateway', 'kind', 'data'])
+
+class TraceRecorder:
+	def __init__(self, path, *, time = None):
+		self._time = time or _time_builtin
+		self._fh = open(path, 'ab', buffering = 1 << 16)
+		if self._fh.tell() == 0:
+			self._fh.write(MAGIC)
+		self._next_id = 1
+	
+	def open_session(self, front, *, gateway = False):
+		tracer = SessionTracer(self, self._next_id, front, gateway)
+		self._next_id += 1
+		tracer.record(Kind.Open, b'')
+		return tracer
+	
+	def write(self, session_id, flags, data):
+		self._fh.write(_RECORD.pack(self._time(), session_id, flags, len(data)))
+		self._fh.write(data)
+	
+	def flush(self):
+		self._fh.flush()
+	
+	def close(self):
+		self._fh.close()
+
+class SessionTracer:
+	__slots__ = ('_recorder', 'id', 'front', '_flags')
+	
+	def __init__(self, recorder, id, front, gateway):
+		self._recorder = recorder
+		self.id = id
+		self.front = front
+		self._flags = _FRONTS.index(front) << 2
+		if gateway:
+			self._flags |= _FLAG_GATEWAY
+	
+	def record(self, kind, data):
+		self._recorder.write(self.id, self._flags | kind, data)
+	
+	def record_incoming(self, m, body):
+		# `m`: command and arguments as received (still URL-quoted), without payload length
+		m, body = scrub(self.front, Kind.Incoming, list(m), body)
+		self.record(Kind.Incoming, _encode(m, body))
+	
+	def record_outgoing(self, m):
+		# `m`: as passed to `MSNPWriter._write`
+		body = None
+		if isinstance(m[-1], bytes):
+			body = m[-1]
+			m = m[:-1]
+		m = [str(x).replace(' ', '%20') for x in m if x is not None]
+		m, body = scrub(self.front, Kind.Outgoing, m, body)
+		self.record(Kind.Outgoing, _encode(m, body))
+	
+	def record_outgoing_encoded(self, data):
+		for m, body in _split_frames(data):
+			m, body = scrub(self.front, Kind.Outgoing, m, body)
+			self.record(Kind.Outgoing, _encode(m, body))
+	
+	def close(self):
+		self.record(Kind.Close, b'')
+
+def read_trace(path):
+	with open(path, 'rb') as fh:
+		if fh.read(len(MAGIC)) != MAGIC:
+			raise ValueError("Not an MSNP trace", path)
+		while True:
+			header = fh.read(_RECORD.size)
+			if len(header) < _RECORD.size:
+				return
+			(t, session_id, flags, length) = _RECORD.unpack(header)
+			data = fh.read(length)
+			yield TraceRecord(
+				t, session_id, _FRONTS[(flags >> 2) & 0x3], bool(flags & _FLAG_GATEWAY),
+				Kind(flags & 0x3), data,
+			)
+
+def scrub(front, kind, m, body):
+	# Remove passwords, auth tokens and IPs; blank out chat text
+	cmd = m[0]
+	if kind is Kind.Incoming:
+		if front == 'NS' and cmd == 'USR' and len(m) > 4 and m[3] == 'S':
+			#>>> USR trid MD5/TWN/SSO S secret...
+			m[4:] = [SCRUBBED] * (len(m) - 4)
+		elif front == 'SB' and cmd in ('USR', 'ANS') and len(m) > 3:
+			#>>> USR trid email token
+			#>>> ANS trid email token sessid
+			m[3] = SCRUBBED
+		elif front == 'SB' and cmd == 'MSG' and body:
+			body = _scrub_chat_text(body)
+	else:
+		if cmd == 'XFR' and len(m) > 5:
+			m[5] = SCRUBBED
+		elif cmd == 'RNG' and len(m) > 4:
+			m[4] = SCRUBBED
+		elif cmd == 'MSG' and body:
+			if front == 'NS':
+				body = _scrub_profile(body)
+			else:
+				body = _scrub_chat_text(body)
+	return m, body
+
+def _scrub_profile(body):
+	lines = body.split(b'\r\n')
+	for i, line in enumerate(lines):
+		name = line.split(b':', 1)[0]
+		if name in _PROFILE_SECRETS:
+			lines[i] = name + b': ' + SCRUBBED.encode('ascii')
+	return b'\r\n'.join(lines)
+
+_PROFILE_SECRETS = { b'MSPAuth', b'ClientIP', b'ClientPort' }
+
+def _scrub_chat_text(body):
+	# Keeps the MIME header (and the payload length) intact
+	i = body.find(b'\r\n\r\n')
+	if i < 0: return body
+	if b'text/plain' not in body[:i]: return body
+	i += 4
+	return body[:i] + b'x' * (len(body) - i)
+
+def _split_frames(data):
+	i = 0
+	while i < len(data):
+		e = data.index(b'\r\n', i)
+		m = data[i:e].decode('utf-8').split()
+		i = e + 2
+		body = None
+		if m[0] in _OUTGOING_PAYLOAD_COMMANDS and m[-1].isdigit():
+			n = int(m.pop())
+			body = data[i:i + n]
+			i += n
+		yield m, body
+
+_OUTGOING_PAYLOAD_COMMANDS = {
+	'MSG', 'UBX', 'GCF', 'NOT', 'IPG', 'UBN', 'UUN', 'NFY',
+}
+
+def _encode(m, body):
+	if body is not None:
+		m = m + [str(len(body))]
+	data = ' '.join(m).encode('utf-8') + b'\r\n'
+	if body is not None:
+		data += body
+	return data
+
+def _time_builtin():
+	return time.time()
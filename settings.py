@@ -6,6 +6,55 @@ DEBUG = False
 DEBUG_MSNP = False
 DEBUG_HTTP_REQUEST = False
 DEBUG_HTTP_REQUEST_FULL = False
+# Collect per-command timings etc. in `util.perf.metrics`, served at /etc/perf
+PERF_METRICS = False
+# Record MSNP sessions (scrubbed of secrets) to this file; see `front/msn/trace.py`
+MSNP_TRACE_PATH = None
+# Contact list changes remembered per user, so SYN can send MSNP2-9 clients just what they missed
+LIST_CHANGE_LOG_SIZE = 100
+# Contacts per block of initial ILNs; longer lists are sent over several event loop iterations
+ILN_CHUNK_SIZE = 200
+# Seconds during which presence changes of a user are merged into one notification per contact; 0 to disable
+PRESENCE_COALESCE_WINDOW = 0.1
+# Token bucket limits for state-changing NS commands, per session: command -> (per second, burst).
+# Over the limit, CHG/UUX/PRP are delayed (keeping only the latest); the others get error 800.
+MSNP_NS_RATE_LIMITS = {
+	'CHG': (2, 10), 'UUX': (2, 10), 'PRP': (2, 10),
+	'ADC': (10, 100), 'ADD': (10, 100), 'REM': (10, 100), 'ADG': (2, 20),
+}
+# Largest payload accepted per MSNP command; connections sending more are closed
+MSNP_MAX_PAYLOAD_SIZES = {
+	'MSG': 65536, 'UUX': 16384, 'UUN': 16384,
+	'ADL': 16384, 'RML': 16384, 'FQY': 16384,
+}
+# Seconds an HTTP gateway poll with nothing to send is held open waiting for events (long polling);
+# 0 to answer right away. Keep it well under the gateway session timeout (30s).
+GATEWAY_LONG_POLL = 0
+# Most bytes queued for an HTTP gateway session between polls; sessions going over are closed
+GATEWAY_QUEUE_MAX_BYTES = 256 * 1024
+# Largest SOAP request bodies accepted (bytes); storage requests carry display pictures
+SOAP_MAX_BODY_SIZE = 64 * 1024
+SOAP_MAX_STORAGE_BODY_SIZE = 1024 * 1024
+# Usertiles kept in memory, and the largest one that is (bigger ones are sent straight from their file)
+USERTILE_CACHE_SIZE = 1000
+USERTILE_CACHE_MAX_BYTES = 64 * 1024
+# Largest display picture accepted (decoded bytes), and its most pixels
+USERTILE_MAX_BYTES = 512 * 1024
+USERTILE_MAX_PIXELS = 1024 * 1024
+# Processes resizing display pictures, and uploads waiting for them beyond which more are refused
+USERTILE_WORKERS = 2
+USERTILE_MAX_PENDING = 16
+# Seconds Messenger Plus sound files may be cached by clients
+SOUND_CACHE_MAX_AGE = 24 * 60 * 60
+# Seconds between checks for changes to the files behind responses kept in memory (MsgrConfig, SOAP faults)
+STATIC_RESPONSE_POLL = 5
+# Directory where compiled templates are kept between restarts; `None` to compile them on every start
+JINJA_BYTECODE_CACHE_DIR = None
+# Seconds a switchboard message may be held up on the way to a recipient (backed up connection,
+# gateway client between polls) before the sender gets NAK
+MSG_DELIVERY_TIMEOUT = 10
+# Seconds during which further typing notifications from the same switchboard session are dropped; 0 to disable
+SB_TYPING_INTERVAL = 3
 
 ENABLE_FRONT_MSN = True
 ENABLE_FRONT_YMSG = False
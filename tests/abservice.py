@@ -0,0 +1,203 @@
+import asyncio
+import os
+
+from core.backend import Backend
+from core.models import User, UserDetail, UserStatus, Contact, Group, Lst, ListChangeKind
+from front.msn import http
+
+class Request:
+	def __init__(self, app, *, method = 'POST', headers = None):
+		self.app = app
+		self.method = method
+		self.headers = headers or {}
+
+def _find_all(req, backend, user, deltas, last_change):
+	fields = { 'deltasOnly': ('true' if deltas else 'false'), 'lastChange': last_change }
+	resp = http._ab_find(req, backend, fields, 'ABFindAll', user)
+	return resp.body.decode('utf-8')
+
+def test_ab_last_change():
+	for version in (0, 1, 12345):
+		assert http._decode_ab_last_change(http._encode_ab_last_change(version)) == version
+	assert http._decode_ab_last_change('2001-01-01T00:00:00Z') is None
+	assert http._decode_ab_last_change('garbage') is None
+
+def test_ab_find_all():
+	backend = Backend(asyncio.new_event_loop())
+	req = Request(http.create_app(backend))
+	user = User('uuid0', 'me@example.com', True, UserStatus("Me"), None)
+	user.detail = UserDetail({})
+	user.detail.groups['1'] = Group('1', "Friends")
+	contacts = []
+	for i in (1, 2):
+		ctc_head = User('uuid{}'.format(i), 'u{}@example.com'.format(i), True, UserStatus('U{}'.format(i)), None)
+		user.detail.contacts[ctc_head.uuid] = Contact(ctc_head, set(), Lst.FL, UserStatus(ctc_head.status.name))
+		contacts.append(ctc_head)
+	
+	full = _find_all(req, backend, user, False, '')
+	assert 'u1@example.com' in full and 'u2@example.com' in full and 'Friends' in full
+	assert http._ab_find_cache.get((user.uuid, 'ABFindAll'))[1].decode('utf-8') == full
+	last_change = http._encode_ab_last_change(user.list_version)
+	
+	# Nothing missing
+	delta = _find_all(req, backend, user, True, last_change)
+	assert '<Contact>' not in delta and '<Group>' not in delta
+	
+	del user.detail.contacts['uuid2']
+	backend._log_list_change(user, ListChangeKind.ContactRemove, lst = Lst.FL, contact = contacts[1])
+	backend._log_list_change(user, ListChangeKind.GroupEdit, group_id = '1', value = "Friends")
+	delta = _find_all(req, backend, user, True, last_change)
+	assert 'u1@example.com' not in delta and 'Friends' in delta
+	assert '<contactId>uuid2</contactId>' in delta and '<fDeleted>true</fDeleted>' in delta
+	assert http._encode_ab_last_change(user.list_version) in delta
+	
+	# Changes no longer in the log
+	assert 'fullsync' in _find_all(req, backend, user, True, http._encode_ab_last_change(user.list_version + 1)).lower()
+
+def test_ab_find_delta_contacts(monkeypatch):
+	from util.misc import LRUCache
+	
+	# Not what `test_ab_find_all` left behind for the same uuid
+	monkeypatch.setattr(http, '_ab_find_cache', LRUCache(10))
+	monkeypatch.setattr(http, '_ab_sent_names', LRUCache(10))
+	backend = Backend(asyncio.new_event_loop())
+	req = Request(http.create_app(backend))
+	user = User('uuid0', 'me@example.com', True, UserStatus("Me"), None)
+	user.detail = UserDetail({})
+	user.detail.groups['1'] = Group('1', "Friends")
+	heads = []
+	for i, lists in ((1, Lst.FL), (2, Lst.RL), (3, Lst.FL)):
+		ctc_head = User('uuid{}'.format(i), 'u{}@example.com'.format(i), True, UserStatus('U{}'.format(i)), None)
+		ctc_head.detail = UserDetail({})
+		user.detail.contacts[ctc_head.uuid] = Contact(ctc_head, ({'1'} if i == 3 else set()), lists, UserStatus(ctc_head.status.name))
+		heads.append(ctc_head)
+	backend._user_by_uuid[user.uuid] = user
+	_find_all(req, backend, user, False, '')
+	last_change = http._encode_ab_last_change(user.list_version)
+	
+	# Someone who added this user, then removed them: not in the AB at all
+	del user.detail.contacts['uuid2']
+	backend._log_list_change(user, ListChangeKind.ContactRemove, lst = Lst.RL, contact = heads[1])
+	# A contact changing their name isn't a change to the list
+	list_version = user.list_version
+	heads[0].status.name = 'New Name'
+	backend._sync_contact_statuses()
+	assert user.list_version == list_version
+	delta = _find_all(req, backend, user, True, last_change)
+	assert 'uuid2' not in delta and '<fDeleted>true</fDeleted>' not in delta
+	assert 'New Name' in delta and 'u3@example.com' not in delta
+	# Already sent
+	assert 'New Name' not in _find_all(req, backend, user, True, last_change)
+	
+	# Favorite groups' contacts are favorites
+	last_change = http._encode_ab_last_change(user.list_version)
+	sess = type('Sess', (), { 'user': user })()
+	backend.me_group_edit(sess, '1', None, is_favorite = True)
+	delta = _find_all(req, backend, user, True, last_change)
+	assert 'u3@example.com' in delta and 'u1@example.com' not in delta
+
+_SOAP = b'''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+	<soap:Header><ABAuthHeader><TicketToken>t=0123456789abcdefghij&amp;p=</TicketToken></ABAuthHeader></soap:Header>
+	<soap:Body><ABContactAdd xmlns="http://www.msn.com/webservices/AddressBook">
+		<contacts><Contact><contactInfo>
+			<passportName>a@example.com</passportName>
+			<isMessengerUser>true</isMessengerUser>
+		</contactInfo></Contact><Contact><contactInfo>
+			<passportName>b@example.com</passportName>
+		</contactInfo></Contact></contacts>
+	</ABContactAdd></soap:Body>
+</soap:Envelope>'''
+
+def test_parse_soap():
+	import pytest
+	
+	(header, action, fields, token) = http.parse_soap(_SOAP)
+	assert token == '0123456789abcdefghij'
+	assert http._get_tag_localname(action) == 'ABContactAdd'
+	assert fields['passportName'] == 'a@example.com'
+	assert http._parse_bool(fields['isMessengerUser'])
+	with pytest.raises(ValueError):
+		http.parse_soap(b'<Envelope><Body/></Envelope>')
+
+def test_soap_size_limit():
+	from aiohttp import web
+	import pytest
+	
+	class Content:
+		# Like aiohttp's `StreamReader`, hands the body out a piece at a time
+		def __init__(self):
+			self.i = 0
+		
+		async def readany(self):
+			chunk = _SOAP[self.i:self.i + 100]
+			self.i += len(chunk)
+			return chunk
+	
+	class Backend:
+		def util_get_sess_by_token(self, token):
+			return None
+	
+	class LimitedRequest(Request):
+		def __init__(self, content_length):
+			super().__init__({ 'backend': Backend() })
+			self.content_length = content_length
+			self.content = Content()
+	
+	loop = asyncio.new_event_loop()
+	(_, _, fields, _, _) = loop.run_until_complete(http._preprocess_soap(LimitedRequest(None), max_size = len(_SOAP)))
+	assert fields['passportName'] == 'a@example.com'
+	for content_length in (None, len(_SOAP)):
+		with pytest.raises(web.HTTPRequestEntityTooLarge):
+			loop.run_until_complete(http._preprocess_soap(LimitedRequest(content_length), max_size = len(_SOAP) - 1))
+	loop.close()
+
+def test_jinja_env_shared():
+	backend = Backend(asyncio.new_event_loop())
+	jinja_env = http.create_app(backend)['jinja_env']
+	assert http.create_app(backend)['jinja_env'] is jinja_env
+	# Already compiled at startup
+	assert len(jinja_env.cache) == len(jinja_env.list_templates())
+
+def test_cached_body(tmp_path, monkeypatch):
+	import gzip
+	import settings
+	
+	monkeypatch.setattr(settings, 'STATIC_RESPONSE_POLL', 0)
+	path = tmp_path / 'config.xml'
+	path.write_text('<config>' + 'x' * 2000 + '</config>')
+	def get(headers = None):
+		cached = http._get_cached_body('test', (str(path),), path.read_text)
+		return http._cached_response(Request(None, method = 'GET', headers = headers), cached)
+	
+	resp = get()
+	etag = resp.headers['ETag']
+	assert resp.body.startswith(b'<config>')
+	assert get({ 'If-None-Match': etag }).status == 304
+	resp = get({ 'Accept-Encoding': 'deflate, gzip' })
+	assert resp.headers['Content-Encoding'] == 'gzip'
+	assert gzip.decompress(resp.body).startswith(b'<config>')
+	assert 'Content-Encoding' not in get({ 'Accept-Encoding': 'gzip;q=0' }).headers
+	
+	path.write_text('<config/>')
+	os.utime(str(path), ns = (0, 0))
+	resp = get({ 'If-None-Match': etag })
+	assert resp.status == 200
+	assert resp.body == b'<config/>'
+
+def test_render_cached(tmp_path, monkeypatch):
+	import settings
+	from util.misc import create_jinja_env
+	
+	monkeypatch.setattr(settings, 'STATIC_RESPONSE_POLL', 0)
+	monkeypatch.setattr(http, 'TMPL_DIR', str(tmp_path))
+	path = tmp_path / 'Test.xml'
+	path.write_text('<old>{{ x }}</old>')
+	jinja_env = create_jinja_env(str(tmp_path), auto_reload = False)
+	req = Request({ 'jinja_env': jinja_env }, method = 'GET')
+	assert http.render_cached(req, 'Test.xml', { 'x': 1 }, 1).body == b'<old>1</old>'
+	
+	# Not DEBUG, so the environment won't notice the change itself
+	path.write_text('<new>{{ x }}</new>')
+	os.utime(str(path), ns = (0, 0))
+	assert http.render_cached(req, 'Test.xml', { 'x': 1 }, 1).body == b'<new>1</new>'
@@ -0,0 +1,161 @@
+from core import event
+from core.models import User, UserStatus
+from core.session import PersistentSession
+from front.msn.msnp import MSNPWriter
+
+class Logger:
+	def info(self, *args):
+		pass
+
+class State:
+	def __init__(self, dialect):
+		self.dialect = dialect
+
+def test_chat_message_encoded_once():
+	sender = User('uuid', 'a@example.com', True, UserStatus('A B'), None)
+	msg = event.ChatMessage(sender, b'MIME-Version: 1.0\r\n\r\nhi')
+	outputs = []
+	for dialect in (12, 12, 18):
+		writer = MSNPWriter(Logger(), State(dialect))
+		writer.write(msg)
+		outputs.append(writer.flush())
+	assert outputs[0] == b'MSG a@example.com A%20B 23\r\nMIME-Version: 1.0\r\n\r\nhi'
+	assert outputs[1] is outputs[0]
+	assert outputs[2] == outputs[0]
+
+class Stats:
+	def __getattr__(self, name):
+		return lambda *args: None
+
+class Transport:
+	def __init__(self):
+		self.data = []
+		self.closing = False
+	
+	def write(self, data):
+		self.data.append(data)
+	
+	def is_closing(self):
+		return self.closing
+	
+	def close(self):
+		self.closing = True
+
+class SenderState(State):
+	def __init__(self, chat):
+		super().__init__(12)
+		self.chat = chat
+		self.time_last_typing = float('-inf')
+
+class Sender:
+	def __init__(self, user, chat):
+		self.user = user
+		self.client = None
+		self.closed = False
+		self.state = SenderState(chat)
+		self.replies = []
+	
+	def send_reply(self, *data):
+		self.replies.append(data)
+
+def test_msg_ack_nak(monkeypatch):
+	import asyncio
+	import settings
+	from core.backend import Chat
+	from front.msn import msg_sb
+	
+	monkeypatch.setattr(settings, 'MSG_DELIVERY_TIMEOUT', 0.05)
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	chat = Chat(Stats())
+	sender = Sender(User('uuid0', 'a@example.com', True, UserStatus('A'), None), chat)
+	chat.add_session(sender)
+	recipient = PersistentSession(State(12), MSNPWriter(Logger(), State(12)), Transport())
+	recipient.user = User('uuid1', 'b@example.com', True, UserStatus('B'), None)
+	chat.add_session(recipient)
+	
+	msg_sb.apply(['MSG', 1, 'A', b'hi'], sender)
+	assert sender.replies == [('ACK', 1)]
+	
+	# Backed up connection: ACK once it drains, NAK if it doesn't in time
+	recipient.pause_writing()
+	msg_sb.apply(['MSG', 2, 'A', b'hi'], sender)
+	assert sender.replies == [('ACK', 1)]
+	loop.call_soon(recipient.resume_writing)
+	loop.run_until_complete(asyncio.sleep(0.01))
+	recipient.pause_writing()
+	msg_sb.apply(['MSG', 3, 'N', b'hi'], sender)
+	loop.run_until_complete(asyncio.sleep(0.1))
+	assert sender.replies == [('ACK', 1), ('ACK', 2), ('NAK', 3)]
+	
+	recipient.transport.closing = True
+	msg_sb.apply(['MSG', 4, 'N', b'hi'], sender)
+	assert sender.replies[-1] == ('NAK', 4)
+	asyncio.set_event_loop(None)
+	loop.close()
+
+def test_roster_frames():
+	from front.msn.misc import build_msnp_iro_block
+	from front.msn.msnp import MSNP_SB_SessState, MSNPReader
+	
+	sessions = []
+	for i, dialect in enumerate((12, 18)):
+		state = MSNP_SB_SessState(MSNPReader(Logger()), None)
+		state.dialect = dialect
+		state.front_specific['msn_capabilities'] = i + 1
+		state.pop_id = '{pop}'
+		sess = Sender(User('uuid{}'.format(i), 'u{}@example.com'.format(i), True, UserStatus('U {}'.format(i)), None), None)
+		sess.state = state
+		sessions.append(sess)
+	roster = [(sess, sess.user) for sess in sessions]
+	
+	assert build_msnp_iro_block(7, roster, 13) == b'IRO 7 1 2 u0@example.com U%200 1\r\nIRO 7 2 2 u1@example.com U%201 2\r\n'
+	sessions[1].user.status.name = 'V'
+	assert build_msnp_iro_block(8, roster, 9) == b'IRO 8 1 2 u0@example.com U%200\r\nIRO 8 2 2 u1@example.com V\r\n'
+	
+	joined = event.ChatParticipantJoined(sessions[1])
+	outputs = []
+	for dialect in (13, 13, 18):
+		writer = MSNPWriter(Logger(), State(dialect))
+		writer.write(joined)
+		outputs.append(writer.flush())
+	assert outputs[0] == b'JOI u1@example.com V 2\r\n'
+	assert outputs[1] is outputs[0]
+	assert outputs[2] == b'JOI u1@example.com;{pop} V 2\r\nJOI u1@example.com V 2\r\n'
+
+def test_typing_notifications_coalesced(monkeypatch):
+	import settings
+	from core.backend import Chat
+	from front.msn import msg_sb
+	
+	class CountingStats:
+		def __init__(self):
+			self.sent = 0
+		
+		def on_message_sent(self, user, client):
+			self.sent += 1
+		
+		def __getattr__(self, name):
+			return lambda *args: None
+	
+	monkeypatch.setattr(settings, 'SB_TYPING_INTERVAL', 60)
+	stats = CountingStats()
+	chat = Chat(stats)
+	sender = Sender(User('uuid0', 'a@example.com', True, UserStatus('A'), None), chat)
+	chat.add_session(sender)
+	recipient = PersistentSession(State(12), MSNPWriter(Logger(), State(12)), Transport())
+	recipient.user = User('uuid1', 'b@example.com', True, UserStatus('B'), None)
+	chat.add_session(recipient)
+	
+	typing = b'MIME-Version: 1.0\r\nContent-Type: text/x-msmsgscontrol\r\nTypingUser: a@example.com\r\n\r\n\r\n'
+	text = b'MIME-Version: 1.0\r\nContent-Type: text/plain; charset=UTF-8\r\n\r\ntext/x-msmsgscontrol'
+	for i in range(3):
+		msg_sb.apply(['MSG', i, 'U', typing], sender)
+	msg_sb.apply(['MSG', 3, 'A', text], sender)
+	assert len(recipient.transport.data) == 2
+	assert stats.sent == 1
+	assert sender.replies == [('ACK', 3)]
+	
+	# Typing again after a message is shown again
+	msg_sb.apply(['MSG', 4, 'U', typing], sender)
+	assert len(recipient.transport.data) == 3
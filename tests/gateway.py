@@ -0,0 +1,95 @@
+import asyncio
+
+from core.event import ReplyEvent, PresenceNotificationEvent
+from core.models import Contact, User, UserStatus
+from core.session import PollingSession
+
+class Logger:
+	def info(self, *args):
+		pass
+	
+	def log_connect(self):
+		pass
+	
+	def log_disconnect(self):
+		pass
+
+class Writer:
+	def __init__(self):
+		self.events = []
+	
+	def write(self, outgoing_event):
+		self.events.append(outgoing_event)
+	
+	def flush(self):
+		data = b''.join(map(_encode, self.events))
+		self.events = []
+		return data
+
+def _encode(outgoing_event):
+	if isinstance(outgoing_event, PresenceNotificationEvent):
+		changed = ','.join(sorted(outgoing_event.changed or ['*']))
+		return 'NLN {} {}\r\n'.format(outgoing_event.contact.head.email, changed).encode('utf-8')
+	return ' '.join(map(str, outgoing_event.data)).encode('utf-8') + b'\r\n'
+
+def _make_session():
+	return PollingSession(None, Logger(), Writer(), 'gw.example.com')
+
+def test_long_poll():
+	loop = asyncio.new_event_loop()
+	sess = _make_session()
+	
+	t0 = loop.time()
+	loop.run_until_complete(sess.wait_for_events(0.05))
+	assert loop.time() - t0 >= 0.05
+	assert sess.on_disconnect() == b''
+	
+	# Answered as soon as something is queued
+	loop.call_later(0.01, sess.send_event, ReplyEvent(('QNG', 50)))
+	t0 = loop.time()
+	loop.run_until_complete(sess.wait_for_events(10))
+	assert loop.time() - t0 < 1
+	assert sess.on_disconnect() == b'QNG 50\r\n'
+	
+	# ... or the client sends another request
+	loop.call_later(0.01, sess.wake)
+	t0 = loop.time()
+	loop.run_until_complete(sess.wait_for_events(10))
+	assert loop.time() - t0 < 1
+	assert sess.on_disconnect() == b''
+	loop.close()
+
+def test_queue_presence_superseded():
+	sess = _make_session()
+	contacts = [
+		Contact(User('uuid{}'.format(i), 'u{}@example.com'.format(i), True, UserStatus('U'), None), set(), 0, UserStatus('U'))
+		for i in range(2)
+	]
+	sess.send_event(PresenceNotificationEvent(contacts[0]))
+	sess.send_event(PresenceNotificationEvent(contacts[1], changed = {'message'}))
+	sess.send_event(ReplyEvent(('QNG', 50)))
+	sess.send_event(PresenceNotificationEvent(contacts[0], changed = {'substatus'}))
+	sess.send_event(PresenceNotificationEvent(contacts[1], changed = {'message', 'media'}))
+	sess.send_event(PresenceNotificationEvent(contacts[0], changed = {'substatus', 'name'}))
+	assert sess.queue_bytes == sum(map(len, (
+		b'NLN u0@example.com *\r\n', b'QNG 50\r\n', b'NLN u1@example.com media,message\r\n', b'NLN u0@example.com name,substatus\r\n',
+	)))
+	assert sess.on_disconnect() == (
+		b'NLN u0@example.com *\r\n'
+		b'QNG 50\r\n'
+		b'NLN u1@example.com media,message\r\n'
+		b'NLN u0@example.com name,substatus\r\n'
+	)
+	assert sess.queue_bytes == 0
+
+def test_queue_overflow(monkeypatch):
+	import settings
+	
+	monkeypatch.setattr(settings, 'GATEWAY_QUEUE_MAX_BYTES', 100)
+	sess = _make_session()
+	for i in range(20):
+		sess.send_event(ReplyEvent(('QNG', i)))
+	assert sess.overflowed
+	assert sess.queue_bytes == 0
+	assert sess.delivery_status() is False
+	assert sess.on_disconnect() == b''
@@ -0,0 +1,32 @@
+from util.perf import Histogram, Metrics
+
+def test_histogram_percentiles():
+	h = Histogram()
+	for _ in range(98):
+		h.add(0.0002)
+	h.add(0.003)
+	h.add(0.2, error = True)
+	assert h.count == 100
+	assert h.errors == 1
+	assert h.percentile(50) == 0.00025
+	assert h.percentile(99) == 0.005
+	assert h.percentile(100) == 0.2
+	assert h.max == 0.2
+
+def test_histogram_overflow_bucket():
+	h = Histogram()
+	h.add(30)
+	assert h.buckets[-1] == 1
+	assert h.percentile(50) == 30
+
+def test_metrics_json():
+	m = Metrics()
+	m.incr(('a', 'b'))
+	m.incr(('a', 'b'), 2)
+	m.observe(('msnp', 'NS', 12, 'USR'), 0.001)
+	json = m.to_json()
+	assert json['counters'] == [{ 'key': ['a', 'b'], 'value': 3 }]
+	assert json['histograms'][0]['key'] == ['msnp', 'NS', 12, 'USR']
+	assert json['histograms'][0]['count'] == 1
+	m.reset()
+	assert not m.to_json()['counters']
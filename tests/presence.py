@@ -0,0 +1,102 @@
+from front.msn.misc import encode_msnp_block
+
+def test_encode_msnp_block():
+	data = encode_msnp_block([
+		('ILN', 5, 'NLN', 'a@example.com', None, 'A B', 0),
+		('UBX', 'a@example.com', b'<Data/>'),
+	])
+	assert data == b'ILN 5 NLN a@example.com A%20B 0\r\nUBX a@example.com 7\r\n<Data/>'
+
+class FakeSession:
+	def __init__(self, user):
+		self.user = user
+		self.closed = False
+		self.events = []
+	
+	def send_event(self, outgoing_event):
+		self.events.append(outgoing_event)
+
+def _make_backend():
+	import asyncio
+	from core.backend import Backend
+	from core.models import User, UserDetail, UserStatus, Contact, Lst
+	
+	backend = Backend(asyncio.new_event_loop())
+	users = [User('uuid{}'.format(i), 'u{}@example.com'.format(i), True, UserStatus('U{}'.format(i)), None) for i in range(2)]
+	for user, other in (users, users[::-1]):
+		user.detail = UserDetail({})
+		user.detail.contacts[other.uuid] = Contact(other, set(), Lst.FL | Lst.AL | Lst.RL, UserStatus(other.status.name))
+		backend._user_by_uuid[user.uuid] = user
+	sessions = [FakeSession(user) for user in users]
+	for sess in sessions:
+		backend._sc.add_session(sess)
+	return backend, sessions
+
+def test_me_update_skips_unchanged(monkeypatch):
+	import settings
+	from core.models import Substatus
+	
+	monkeypatch.setattr(settings, 'PRESENCE_COALESCE_WINDOW', 0)
+	backend, (sess, watcher) = _make_backend()
+	backend.me_update(sess, { 'substatus': Substatus.NLN })
+	assert [e.changed for e in watcher.events] == [None]
+	
+	watcher.events.clear()
+	backend._unsynced_db.clear()
+	backend.me_update(sess, { 'substatus': Substatus.NLN, 'message': None, 'media': None })
+	assert watcher.events == []
+	assert not backend._unsynced_db
+	
+	backend.me_update(sess, { 'message': 'hi', 'media': None })
+	assert [e.changed for e in watcher.events] == [{ 'message' }]
+	assert sess.user in backend._unsynced_db
+	
+	watcher.events.clear()
+	backend.me_update(sess, { 'name': 'New' })
+	assert [e.changed for e in watcher.events] == [{ 'name' }]
+	
+	watcher.events.clear()
+	backend.me_update(sess, { 'name': 'New' }, force_notify = True)
+	assert [e.changed for e in watcher.events] == [{ 'front_specific' }]
+
+def test_presence_coalescing(monkeypatch):
+	import asyncio
+	import settings
+	from core.models import Substatus
+	
+	monkeypatch.setattr(settings, 'PRESENCE_COALESCE_WINDOW', 0.01)
+	backend, (sess, watcher) = _make_backend()
+	backend.me_update(sess, { 'substatus': Substatus.NLN })
+	backend._loop.run_until_complete(asyncio.sleep(0.05))
+	assert [e.changed for e in watcher.events] == [None]
+	
+	watcher.events.clear()
+	backend.me_update(sess, { 'substatus': Substatus.AWY })
+	backend.me_update(sess, { 'message': 'brb' })
+	backend.me_update(sess, { 'name': 'New' })
+	assert watcher.events == []
+	backend._loop.run_until_complete(asyncio.sleep(0.05))
+	assert [e.changed for e in watcher.events] == [{ 'substatus', 'message', 'name' }]
+
+def test_parse_uux():
+	from front.msn.msg_ns import parse_uux
+	
+	assert parse_uux(b'<Data><PSM>hi</PSM><CurrentMedia/><MachineGuid>{X}</MachineGuid></Data>') == {
+		'PSM': 'hi', 'CurrentMedia': '', 'MachineGuid': '{X}',
+	}
+	# Goes through lxml
+	assert parse_uux(b'<?xml version="1.0"?>\r\n<Data><PSM>a &amp; b</PSM></Data>') == { 'PSM': 'a & b' }
+
+def test_parse_ml(monkeypatch):
+	import pytest
+	import settings
+	from core.models import Lst
+	from front.msn.msg_ns import _parse_ml
+	
+	assert _parse_ml('ADL', b'<ml l="1"><d n="example.com"><c n="a" l="3" t="1" /><c n="b" l="4" t="1" /></d><d n="x.org"><c n="c" /></d></ml>') == [
+		('a@example.com', Lst.FL | Lst.AL), ('b@example.com', Lst.BL), ('c@x.org', Lst(0)),
+	]
+	monkeypatch.setattr(settings, 'MSNP_MAX_PAYLOAD_SIZES', { 'ADL': 100, 'FQY': 10 })
+	assert _parse_ml('ADL', b'<ml />') == []
+	with pytest.raises(ValueError):
+		_parse_ml('FQY', b'<ml><d n="example.com" /></ml>')
@@ -0,0 +1,93 @@
+import asyncio
+
+from util.misc import TokenBucket
+from front.msn.misc import MSNPHandlers, Err
+
+class Clock:
+	def __init__(self):
+		self.now = 0.0
+	
+	def __call__(self):
+		return self.now
+
+def test_token_bucket():
+	clock = Clock()
+	bucket = TokenBucket(2, 3, time = clock)
+	assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+	assert bucket.wait_time() == 0.5
+	clock.now = 0.5
+	assert bucket.take()
+	assert not bucket.take()
+	clock.now = 100
+	assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+class State:
+	def __init__(self):
+		self.dialect = 12
+		self.rate_buckets = {}
+		self.deferred_msgs = {}
+
+class Session:
+	def __init__(self):
+		self.closed = False
+		self.user = None
+		self.state = State()
+		self.replies = []
+	
+	def send_reply(self, *m):
+		self.replies.append(m)
+
+def test_rate_limits():
+	handlers = MSNPHandlers('NS',
+		rate_limits = { 'ADG': (0.001, 2), 'CHG': (100, 1) },
+		rate_limits_deferred = { 'CHG' },
+	)
+	applied = []
+	
+	@handlers
+	def _m_adg(sess, trid, name):
+		applied.append(('ADG', trid))
+	
+	@handlers
+	def _m_chg(sess, trid, status):
+		applied.append(('CHG', trid, status))
+	
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	try:
+		sess = Session()
+		for i in range(3):
+			handlers.apply(['ADG', i, 'x'], sess)
+		assert applied == [('ADG', 0), ('ADG', 1)]
+		assert sess.replies == [(Err.ChangingTooRapidly, 2)]
+		
+		applied.clear()
+		handlers.apply(['CHG', 10, 'NLN'], sess)
+		handlers.apply(['CHG', 11, 'BSY'], sess)
+		handlers.apply(['CHG', 12, 'AWY'], sess)
+		assert applied == [('CHG', 10, 'NLN')]
+		loop.run_until_complete(asyncio.sleep(0.05))
+		assert applied == [('CHG', 10, 'NLN'), ('CHG', 12, 'AWY')]
+	finally:
+		asyncio.set_event_loop(None)
+		loop.close()
+
+def test_throttled_users(monkeypatch):
+	from util.misc import LRUCache
+	from front.msn import misc
+	
+	class User:
+		email = 'a@example.com'
+	
+	monkeypatch.setattr(misc, 'throttled_users', LRUCache(10))
+	handlers = MSNPHandlers('NS', rate_limits = { 'ADG': (0.001, 1) })
+	
+	@handlers
+	def _m_adg(sess, trid, name):
+		pass
+	
+	sess = Session()
+	sess.user = User()
+	for i in range(3):
+		handlers.apply(['ADG', i, 'x'], sess)
+	assert misc.throttled_users.items() == [('a@example.com', { 'ADG': 2 })]
@@ -0,0 +1,86 @@
+import tracemalloc
+
+import pytest
+
+from front.msn.msnp import MSNPReader, ProtocolError
+
+class Logger:
+	def info(self, *args):
+		pass
+
+def _read_in_pieces(reader, data, size):
+	msgs = []
+	for i in range(0, len(data), size):
+		msgs.extend(reader.data_received(data[i:i + size]))
+	return msgs
+
+def test_reader_pieces():
+	data = b'CHG 1 NLN 0\r\n\r\nMSG 2 A 5\r\nhello' + b'UUX 3 0\r\nOUT\r\n'
+	for size in (1, 2, 7, len(data)):
+		msgs = _read_in_pieces(MSNPReader(Logger()), data, size)
+		assert msgs == [['CHG', '1', 'NLN', '0'], ['MSG', '2', 'A', b'hello'], ['UUX', '3'], ['OUT']]
+
+def test_reader_limits(monkeypatch):
+	import settings
+	
+	monkeypatch.setattr(settings, 'MSNP_MAX_PAYLOAD_SIZES', { 'MSG': 10 })
+	reader = MSNPReader(Logger())
+	assert list(reader.data_received(b'MSG 1 U 10\r\n0123456789')) == [['MSG', '1', 'U', b'0123456789']]
+	with pytest.raises(ProtocolError):
+		list(reader.data_received(b'MSG 1 U 11\r\n'))
+	with pytest.raises(ProtocolError):
+		list(MSNPReader(Logger()).data_received(b'CHG 1 NLN 0' * 10000))
+
+def _relay_peak_memory(mb):
+	# Relays `mb` MB of P2P-sized MSGs, arriving in TCP-sized pieces, to two others in a chat.
+	# Returns the peak memory allocated meanwhile.
+	from core.backend import Chat
+	from core.models import User, UserStatus
+	from core.session import PersistentSession
+	from front.msn.msnp import MSNP_SB_SessState, MSNPWriter
+	
+	class Stats:
+		def __getattr__(self, name):
+			return lambda *args: None
+	
+	class Transport:
+		def write(self, data):
+			pass
+		
+		def is_closing(self):
+			return False
+	
+	chat = Chat(Stats())
+	sessions = []
+	for i in range(3):
+		state = MSNP_SB_SessState(MSNPReader(Logger()), None)
+		state.dialect = 12
+		state.chat = chat
+		sess = PersistentSession(state, MSNPWriter(Logger(), state), Transport())
+		sess.user = User('uuid{}'.format(i), 'u{}@example.com'.format(i), True, UserStatus('U'), None)
+		chat.add_session(sess)
+		sessions.append(sess)
+	
+	payload = b'MIME-Version: 1.0\r\nContent-Type: application/x-msnmsgrp2p\r\nP2P-Dest: u1@example.com\r\n\r\n' + b'x' * 1250
+	frame = 'MSG 1 D {}\r\n'.format(len(payload)).encode('utf-8') + payload
+	stream = frame * ((mb << 20) // len(frame))
+	
+	sender = sessions[0]
+	# Get one-time allocations (metrics etc.) out of the way
+	sender.state.data_received(frame, sender)
+	tracemalloc.start()
+	try:
+		for i in range(0, len(stream), 1460):
+			sender.state.data_received(stream[i:i + 1460], sender)
+		(_, peak) = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return peak
+
+def test_relay_memory_per_mb():
+	peaks = {}
+	for mb in (4, 16):
+		peaks[mb] = _relay_peak_memory(mb)
+	# Memory use doesn't grow with the amount of data relayed
+	assert peaks[16] < peaks[4] * 2, "peak {} bytes for 4MB, {} bytes for 16MB".format(peaks[4], peaks[16])
+	assert peaks[16] / 16 < 64 * 1024, "{:.0f} bytes per MB relayed".format(peaks[16] / 16)
@@ -0,0 +1,70 @@
+import io
+import os
+
+from aiohttp import web
+
+from front.msn import http_sound
+
+class Request:
+	def __init__(self, **query):
+		self.rel_url = self
+		self.query = query
+
+def _sound(file_hash, data = b'mp3'):
+	tag = bytearray(128)
+	tag[0:3] = b'TAG'
+	tag[3:8] = b'Title'
+	tag[93] = 1
+	tag[109:121] = file_hash.encode('utf-8')
+	tag[127] = 2
+	return io.BytesIO(data + bytes(tag))
+
+def test_store_and_get(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr(http_sound, '_index', http_sound._SoundIndex())
+	
+	metadata = http_sound._store_file(_sound('abcdef123456'), False)
+	assert metadata.hash == 'abcdef123456'
+	assert metadata.title == 'Title'
+	file_path = http_sound._get_file_path('abcdef123456')
+	assert open(file_path, 'rb').read().startswith(b'mp3TAG')
+	
+	# Not overwritten unless asked to
+	assert http_sound._store_file(_sound('abcdef123456', b'new'), False) is None
+	assert http_sound._store_file(_sound('abcdef123456', b'new'), True) is not None
+	assert open(file_path, 'rb').read().startswith(b'newTAG')
+	assert os.listdir(os.path.dirname(file_path)) == ['abcdef123456.mp3']
+	
+	assert http_sound._store_file(_sound('../../abcdef'), False) is None
+	assert http_sound._store_file(io.BytesIO(b'short'), False) is None
+	
+	resp = http_sound.get(Request(hash = 'abcdef123456'))
+	assert isinstance(resp, web.FileResponse)
+	assert resp.headers['Cache-Control'].startswith('public')
+	assert http_sound.get(Request(hash = '123456abcdef')).text == '0'
+	assert http_sound.get(Request(hash = '../x')).text == '0'
+	assert http_sound.check(Request(hash = 'abcdef123456')).text == '0'
+	http_sound._index.add(metadata)
+	assert http_sound.check(Request(hash = 'abcdef123456')).text == '1'
+	assert http_sound.builtin(Request(code = '../../x')).text == '0'
+
+def test_index():
+	index = http_sound._SoundIndex()
+	for i in range(6):
+		index.add(http_sound.Metadata('Title', 'hash{}'.format(i), i % 2, i % 3, i != 5))
+	
+	assert 'hash5' in index.hashes
+	assert index.choose(7, None) is None
+	for _ in range(20):
+		assert index.choose(0, 0) == 'hash0'
+		assert index.choose(1, None) in ('hash1', 'hash3')
+		assert index.choose(None, 2) == 'hash2'
+		assert index.choose(None, None) != 'hash5'
+	
+	# Moved to another category, and made private
+	index.add(http_sound.Metadata('Title', 'hash1', 0, 1, True))
+	index.add(http_sound.Metadata('Title', 'hash3', 1, 0, False))
+	assert index.choose(1, None) is None
+	assert index.choose(0, 1) in ('hash1', 'hash4')
+	assert sorted(index._buckets[(None, None)]) == ['hash0', 'hash1', 'hash2', 'hash4']
+	assert sum(map(len, index._buckets.values())) == 4 * 4
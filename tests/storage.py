@@ -0,0 +1,94 @@
+import asyncio
+
+from aiohttp import web
+import pytest
+
+import settings
+from core.models import User, UserStatus
+from front.msn import http
+
+class Request:
+	def __init__(self, uuid, headers = None):
+		self.match_info = { 'uuid': uuid }
+		self.headers = headers or {}
+
+class RenderRequest:
+	def __init__(self):
+		self.app = { 'jinja_env': http._get_jinja_env() }
+
+def test_usertile(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	loop = asyncio.new_event_loop()
+	def get(uuid, headers = None, small = False):
+		return loop.run_until_complete(http.handle_usertile(Request(uuid, headers), small = small))
+	
+	uuid = '0123-a'
+	path = tmp_path / http._get_storage_path(uuid)
+	path.mkdir(parents = True)
+	# Another user's tile in the same directory
+	(path / '0123-b.jpeg').write_bytes(b'other')
+	(path / '0123-a.png').write_bytes(b'tile')
+	(path / '0123-a_thumb.png').write_bytes(b'thumb')
+	
+	resp = get(uuid)
+	assert resp.body == b'tile'
+	assert resp.content_type == 'image/png'
+	assert get(uuid, small = True).body == b'thumb'
+	assert get(uuid, { 'If-None-Match': resp.headers['ETag'] }).status == 304
+	with pytest.raises(web.HTTPNotFound):
+		get('0123-c')
+	
+	# Served from memory until the tiles change
+	(path / '0123-a.png').write_bytes(b'new tile')
+	assert get(uuid).body == b'tile'
+	http._forget_usertiles(uuid)
+	resp = get(uuid, { 'If-None-Match': resp.headers['ETag'] })
+	assert resp.status == 200
+	assert resp.body == b'new tile'
+	
+	monkeypatch.setattr(settings, 'USERTILE_CACHE_MAX_BYTES', 4)
+	assert isinstance(get(uuid), web.FileResponse)
+	loop.close()
+
+def _image(size, color):
+	import io
+	from PIL import Image
+	
+	out = io.BytesIO()
+	Image.new('RGB', size, color).save(out, format = 'PNG')
+	return out.getvalue()
+
+def test_create_document(tmp_path, monkeypatch):
+	import base64
+	import os
+	
+	# Templates are loaded before leaving the repo's directory
+	req = RenderRequest()
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr(settings, 'USERTILE_MAX_PIXELS', 200 * 200)
+	loop = asyncio.new_event_loop()
+	def upload(uuid, data):
+		user = User(uuid, 'a@example.com', True, UserStatus('A'), None)
+		fields = { 'DocumentStreamType': 'UserTileStatic', 'Data': base64.b64encode(data).decode('ascii') }
+		return loop.run_until_complete(http.handle_create_document(req, fields, user, 'cid', 'token', 'timestamp'))
+	
+	data = _image((96, 96), 'red')
+	for uuid in ('0123-a', '0123-b'):
+		assert upload(uuid, data).status == 200
+		path = http._get_storage_path(uuid)
+		assert open('{}/{}.png'.format(path, uuid), 'rb').read() == data
+	thumbs = [os.stat('{}/{}_thumb.png'.format(path, uuid)) for uuid in ('0123-a', '0123-b')]
+	# Stored once
+	assert thumbs[0].st_ino == thumbs[1].st_ino
+	assert len(os.listdir('storage/dp/sha256')) == 1
+	
+	from PIL import Image
+	assert Image.open('{}/0123-a_thumb.png'.format(path)).size == (21, 21)
+	
+	for bad in (b'not an image', _image((300, 300), 'blue')):
+		with pytest.raises(web.HTTPBadRequest):
+			upload('0123-a', bad)
+	monkeypatch.setattr(settings, 'USERTILE_MAX_BYTES', len(data) - 1)
+	with pytest.raises(web.HTTPRequestEntityTooLarge):
+		upload('0123-a', data)
+	loop.close()
@@ -0,0 +1,91 @@
+from util.misc import LRUCache
+from front.msn.misc import MSNPTemplate, Slot
+
+def test_template_render():
+	tmpl = MSNPTemplate([
+		('SYN', Slot('trid'), Slot('ser'), 1, 0),
+		('GTC', 'A'),
+		('PRP', 'MFN', 'My Name', None),
+	])
+	assert tmpl.count == 3
+	assert tmpl.render(trid = 5, ser = 9) == b'SYN 5 9 1 0\r\nGTC A\r\nPRP MFN My%20Name\r\n'
+	assert tmpl.render(trid = 6, ser = 10) == b'SYN 6 10 1 0\r\nGTC A\r\nPRP MFN My%20Name\r\n'
+
+def test_lru_cache():
+	cache = LRUCache(2)
+	cache.put('a', 1)
+	cache.put('b', 2)
+	assert cache.get('a') == 1
+	cache.put('c', 3)
+	assert cache.get('b') is None
+	assert cache.get('a') == 1
+	assert cache.get('c') == 3
+	assert len(cache) == 2
+
+def test_list_change_log(monkeypatch):
+	import asyncio
+	import settings
+	from core.backend import Backend
+	from core.models import User, UserStatus, ListChangeKind
+	
+	monkeypatch.setattr(settings, 'LIST_CHANGE_LOG_SIZE', 3)
+	loop = asyncio.new_event_loop()
+	backend = Backend(loop)
+	user = User('uuid', 'a@example.com', True, UserStatus('A'), None, list_version = 10)
+	assert backend.util_get_list_changes(user, 10) == []
+	assert backend.util_get_list_changes(user, 9) is None
+	for i in range(4):
+		backend._log_list_change(user, ListChangeKind.GroupAdd, group_id = str(i), value = 'G')
+	assert user.list_version == 14
+	assert [c.version for c in backend.util_get_list_changes(user, 12)] == [13, 14]
+	assert [c.version for c in backend.util_get_list_changes(user, 11)] == [12, 13, 14]
+	assert backend.util_get_list_changes(user, 10) is None
+	assert backend.util_get_list_changes(user, 15) is None
+	loop.close()
+
+def test_syn_0_sends_whole_list():
+	import asyncio
+	from core.backend import Backend
+	from core.models import User, UserDetail, UserStatus, Contact, Lst
+	from front.msn import msg_ns
+	
+	class State:
+		def __init__(self, backend):
+			self.backend = backend
+			self.dialect = 8
+	
+	class Sess:
+		def __init__(self, user, backend):
+			self.user = user
+			self.state = State(backend)
+			self.sent = []
+		
+		def send_reply(self, *m):
+			self.sent.append(m)
+		
+		def send_event(self, outgoing_event):
+			self.sent.append(outgoing_event.data)
+	
+	loop = asyncio.new_event_loop()
+	# Existing users' lists all have version 0
+	user = User('uuid0', 'a@example.com', True, UserStatus('A'), None)
+	user.detail = UserDetail({})
+	ctc_head = User('uuid1', 'b@example.com', True, UserStatus('B'), None)
+	user.detail.contacts[ctc_head.uuid] = Contact(ctc_head, set(), Lst.FL | Lst.AL, UserStatus('B'))
+	sess = Sess(user, Backend(loop))
+	msg_ns.apply(['SYN', 1, '0'], sess)
+	(data,) = sess.sent
+	assert b'LST b@example.com B 3 0\r\n' in data
+	loop.close()
+
+def test_list_change_group_add():
+	from core.models import User, UserStatus, Lst, ListChange, ListChangeKind
+	from front.msn.msg_ns import _build_list_change
+	
+	user = User('uuid0', 'a@example.com', True, UserStatus('A'), None)
+	contact = User('uuid1', 'b@example.com', True, UserStatus('B'), None)
+	add = ListChange(5, ListChangeKind.ContactAdd, lst = Lst.FL, contact = contact, value = 'B')
+	group_add = ListChange(6, ListChangeKind.ContactAdd, lst = Lst.FL, contact = contact, group_id = '1')
+	assert _build_list_change(add, user, 5) == ('ADD', 0, 'FL', 5, 'b@example.com', 'B', None)
+	assert _build_list_change(group_add, user, 5) is None
+	assert _build_list_change(group_add, user, 7) == ('ADD', 0, 'FL', 6, 'b@example.com', 'b@example.com', '1')
@@ -0,0 +1,50 @@
+from front.msn.trace import TraceRecorder, Kind, read_trace, SCRUBBED
+
+def test_roundtrip(tmpdir):
+	path = str(tmpdir.join('trace.bin'))
+	recorder = TraceRecorder(path, time = MockTime())
+	t1 = recorder.open_session('NS')
+	t2 = recorder.open_session('SB', gateway = True)
+	t1.record_incoming(['VER', '1', 'MSNP12'], None)
+	t1.record_outgoing(('VER', 1, 'MSNP12'))
+	t2.record_incoming(['MSG', '2', 'U'], b'MIME-Version: 1.0\r\n\r\n')
+	t1.close()
+	recorder.close()
+	
+	recs = list(read_trace(path))
+	assert [(r.session_id, r.kind) for r in recs] == [
+		(1, Kind.Open), (2, Kind.Open), (1, Kind.Incoming), (1, Kind.Outgoing), (2, Kind.Incoming), (1, Kind.Close),
+	]
+	assert recs[1].front == 'SB' and recs[1].gateway
+	assert recs[2].data == b'VER 1 MSNP12\r\n'
+	assert recs[4].data == b'MSG 2 U 21\r\nMIME-Version: 1.0\r\n\r\n'
+	assert recs[0].time < recs[-1].time
+
+def test_scrub_secrets(tmpdir):
+	path = str(tmpdir.join('trace.bin'))
+	recorder = TraceRecorder(path)
+	ns = recorder.open_session('NS')
+	sb = recorder.open_session('SB')
+	ns.record_incoming(['USR', '4', 'TWN', 'S', 't=secret'], None)
+	ns.record_incoming(['USR', '3', 'TWN', 'I', 'a@example.com'], None)
+	ns.record_outgoing(('XFR', 5, 'SB', 'host:1864', 'CKI', 'secret'))
+	ns.record_outgoing(('MSG', 'Hotmail', 'Hotmail', b'LoginTime: 1\r\nMSPAuth: t=secret\r\nClientIP: 1.2.3.4\r\n\r\n'))
+	sb.record_incoming(['ANS', '1', 'a@example.com', 'secret', '123'], None)
+	sb.record_incoming(['MSG', '2', 'A'], b'Content-Type: text/plain\r\n\r\nhello')
+	recorder.close()
+	
+	data = [r.data for r in read_trace(path) if r.kind is Kind.Incoming or r.kind is Kind.Outgoing]
+	for d in data:
+		assert b'secret' not in d
+		assert b'1.2.3.4' not in d
+	assert data[0] == 'USR 4 TWN S {}\r\n'.format(SCRUBBED).encode('utf-8')
+	assert data[1] == b'USR 3 TWN I a@example.com\r\n'
+	assert data[5] == b'MSG 2 A 33\r\nContent-Type: text/plain\r\n\r\nxxxxx'
+
+class MockTime:
+	def __init__(self):
+		self.t = 0
+	
+	def __call__(self):
+		self.t += 1
+		return self.t
@@ -1,5 +1,8 @@
 import asyncio
 import functools
+import os
+from collections import OrderedDict
+from time import monotonic
 from uuid import uuid4
 
 EMPTY_SET = frozenset()
@@ -11,6 +14,64 @@ def first_in_iterable(iterable):
 	for x in iterable: return x
 	return None
 
+class LRUCache:
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self._d = OrderedDict()
+	
+	def __len__(self):
+		return len(self._d)
+	
+	def get(self, key, default = None):
+		try:
+			self._d.move_to_end(key)
+		except KeyError:
+			return default
+		return self._d[key]
+	
+	def put(self, key, value):
+		self._d[key] = value
+		self._d.move_to_end(key)
+		if len(self._d) > self.maxsize:
+			self._d.popitem(last = False)
+	
+	def pop(self, key, default = None):
+		return self._d.pop(key, default)
+	
+	def items(self):
+		# Least recently used first
+		return list(self._d.items())
+	
+	def clear(self):
+		self._d.clear()
+
+class TokenBucket:
+	# Allows `burst` actions at once, refilled at `rate` per second
+	
+	def __init__(self, rate, burst, *, time = None):
+		self.rate = rate
+		self.burst = burst
+		self._time = time or monotonic
+		self._tokens = burst
+		self._last = self._time()
+	
+	def _refill(self):
+		now = self._time()
+		self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+		self._last = now
+	
+	def take(self):
+		self._refill()
+		if self._tokens < 1:
+			return False
+		self._tokens -= 1
+		return True
+	
+	def wait_time(self):
+		# Seconds until `take` would succeed
+		self._refill()
+		return max(0, (1 - self._tokens) / self.rate)
+
 class Runner:
 	def __init__(self, host, port, *, ssl = None):
 		self.host = host
@@ -102,12 +163,28 @@ async def _windows_ctrl_c_workaround():
 	while True:
 		await asyncio.sleep(0.1)
 
-def create_jinja_env(tmpl_dir, globals = None):
+def create_jinja_env(tmpl_dir, globals = None, *, bytecode_cache_dir = None, auto_reload = True):
 	import jinja2
+	bytecode_cache = None
+	if bytecode_cache_dir is not None:
+		os.makedirs(bytecode_cache_dir, exist_ok = True)
+		bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
 	jinja_env = jinja2.Environment(
 		loader = jinja2.FileSystemLoader(tmpl_dir),
 		autoescape = jinja2.select_autoescape(default = True),
+		bytecode_cache = bytecode_cache,
+		auto_reload = auto_reload,
+		# Keep every template once loaded, see `precompile_jinja_env`
+		cache_size = -1,
 	)
 	if globals:
 		jinja_env.globals.update(globals)
 	return jinja_env
+
+def precompile_jinja_env(jinja_env):
+	# Loads (compiling, or reading from the bytecode cache) all templates up front,
+	# so the first request using each one doesn't pay for it. Returns how many there are.
+	names = jinja_env.list_templates()
+	for name in names:
+		jinja_env.get_template(name)
+	return len(names)
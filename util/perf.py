@@ -0,0 +1,95 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+# Upper bounds (in seconds) of `Histogram` buckets; the last bucket is unbounded.
+BUCKET_BOUNDS = (
+	0.0001, 0.00025, 0.0005,
+	0.001, 0.0025, 0.005,
+	0.01, 0.025, 0.05,
+	0.1, 0.25, 0.5,
+	1.0, 2.5, 5.0, 10.0,
+)
+
+class Histogram:
+	__slots__ = ('count', 'errors', 'total', 'max', 'buckets')
+	
+	def __init__(self):
+		self.count = 0
+		self.errors = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+	
+	def add(self, dt, *, error = False):
+		self.count += 1
+		if error:
+			self.errors += 1
+		self.total += dt
+		if dt > self.max:
+			self.max = dt
+		self.buckets[bisect_left(BUCKET_BOUNDS, dt)] += 1
+	
+	def percentile(self, p):
+		# Returns the upper bound of the bucket containing the `p`th percentile
+		if not self.count: return None
+		target = self.count * p / 100
+		seen = 0
+		for i, n in enumerate(self.buckets):
+			seen += n
+			if seen >= target:
+				if i < len(BUCKET_BOUNDS):
+					return min(BUCKET_BOUNDS[i], self.max)
+				return self.max
+		return self.max
+	
+	def to_json(self):
+		return {
+			'count': self.count,
+			'errors': self.errors,
+			'total': self.total,
+			'max': self.max,
+			'p50': self.percentile(50),
+			'p99': self.percentile(99),
+			'buckets': self.buckets,
+		}
+
+class Metrics:
+	# In-process counters and latency histograms, keyed by tuples of labels.
+	# Unlike `core.stats.Stats`, nothing here is persisted.
+	
+	def __init__(self):
+		self.started = time.time()
+		# Dict[Tuple[str, ...], int]
+		self.counters = defaultdict(int)
+		# Dict[Tuple[str, ...], Histogram]
+		self.histograms = defaultdict(Histogram)
+	
+	def incr(self, key, n = 1):
+		self.counters[key] += n
+	
+	def observe(self, key, dt, *, error = False):
+		self.histograms[key].add(dt, error = error)
+	
+	def reset(self):
+		self.started = time.time()
+		self.counters.clear()
+		self.histograms.clear()
+	
+	def to_json(self):
+		return {
+			'started': self.started,
+			'counters': [
+				{ 'key': list(key), 'value': value }
+				for key, value in sorted(self.counters.items(), key = _sort_key)
+			],
+			'histograms': [
+				{ 'key': list(key), **h.to_json() }
+				for key, h in sorted(self.histograms.items(), key = _sort_key)
+			],
+		}
+
+def _sort_key(item):
+	return tuple(str(x) for x in item[0])
+
+metrics = Metrics()